@@ -20,6 +20,13 @@ import xml.etree.cElementTree as ET
 import pprint
 from collections import defaultdict
 import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import offset_index
+import pbf
+import tag_index
 
 OSM_FILE = 'london_england.osm'
 OUTPUT_FILE = 'output_post_codes.json'
@@ -31,13 +38,19 @@ POST_CODES = re.compile(r"""[A-Z]{2}\d[A-Z]\ \d[A-Z]{2}
                         |   [A-Z]{2}\d\ \d[A-Z]{2}
                         |   [A-Z]{2}\d{2}\ \d[A-Z]{2}""", re.VERBOSE)
 
+# Keys of the post code tags
+POST_CODE_KEYS = ["addr:postcode", "postcode", "postal_code"]
+
+# (type, key) of the post code tags once shaped, see is_post_code
+POST_CODE_TAGS = [('addr', 'postcode'), ('regular', 'postcode'), ('regular', 'postal_code')]
+
 def is_post_code(tag):
     """
     Usage: if is_post_code(tag): ...
 
     Returns whether the key value of tag element is of type post code.
     """
-    return tag.attrib['k'] in ["addr:postcode", "postcode", "postal_code"]
+    return tag.attrib['k'] in POST_CODE_KEYS
 
 def audit_post_code(invalid_post_codes, post_code):
     """
@@ -51,8 +64,16 @@ def audit_post_code(invalid_post_codes, post_code):
     if (len(matches) == 0):
         invalid_post_codes.add(post_code)
 
-def audit_post_codes(osm_file=OSM_FILE):
-    invalid_post_codes = set()
+def get_element(osm_file, tags=("node", "way")):
+    """
+    Usage: for element in get_element(osm_file): ...
+
+    Yields the node and way elements of an .osm or .osm.pbf file.
+    """
+    if pbf.is_pbf(osm_file):
+        for element in pbf.iter_elements(osm_file, tags=tags):
+            yield element
+        return
 
     with open(osm_file, 'r') as file:
         context = ET.iterparse(file, events=("start", "end"))
@@ -60,17 +81,54 @@ def audit_post_codes(osm_file=OSM_FILE):
         event, root = context.next()
 
         for event, element in context:
-            if event == "end" and element.tag in ["node", "way"]:
-                for tag in element.iter("tag"):
-                    if is_post_code(tag):
-                        audit_post_code(invalid_post_codes, tag.attrib['v'])
-
+            if event == "end" and element.tag in tags:
+                yield element
                 root.clear()
 
+def audit_post_codes(osm_file=OSM_FILE):
+    invalid_post_codes = set()
+
+    for element in get_element(osm_file):
+        for tag in element.iter("tag"):
+            if is_post_code(tag):
+                audit_post_code(invalid_post_codes, tag.attrib['v'])
+
     with open(OUTPUT_FILE, 'w') as output_file:
         pprint.pprint(invalid_post_codes)
         post_codes = {'post_codes': list(invalid_post_codes)}
         json.dump(post_codes, output_file)
 
+def audit_post_codes_index(index_dir=tag_index.TAG_INDEX_DIR):
+    """
+    Usage: invalid_post_codes = audit_post_codes_index()
+
+    Audits the distinct post codes of the tag index built by
+    tag_index.py, instead of parsing the osm file.
+    """
+    index = tag_index.TagIndex(index_dir)
+    invalid_post_codes = set()
+    for tag_type, key in POST_CODE_TAGS:
+        for post_code, count in index.values(tag_type, key):
+            audit_post_code(invalid_post_codes, post_code)
+    return invalid_post_codes
+
+def post_code_sources(post_codes, osm_file=OSM_FILE, index_dir=tag_index.TAG_INDEX_DIR,
+                      offsets_dir=offset_index.OFFSET_INDEX_DIR):
+    """
+    Usage: sources = post_code_sources(audit_post_codes_index(), osm_file)
+
+    Returns {post code: [(type, id, offset, length), ...]} with the
+    elements of osm_file holding each post code and where they are in
+    the file, from the tag index and the offset index of osm_file.
+    """
+    index = tag_index.TagIndex(index_dir)
+    offsets = offset_index.OffsetIndex(osm_file, offsets_dir)
+    try:
+        return {post_code: offsets.locate_refs(tag_index.any_of(*[
+                    index.lookup(tag_type, key, post_code) for tag_type, key in POST_CODE_TAGS]))
+                for post_code in post_codes}
+    finally:
+        offsets.close()
+
 if __name__ == '__main__':
     audit_post_codes()
@@ -20,6 +20,13 @@ import xml.etree.cElementTree as ET
 import pprint
 from collections import defaultdict
 import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import offset_index
+import pbf
+import tag_index
 
 OSM_FILE = 'london_england.osm'
 STREET_TYPE = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -51,25 +58,69 @@ def audit_street_type(street_types, street_name):
         if street_type not in expected:
             street_types[street_type].append(street_name)
 
-def audit_street(osm_file):
-    street_types = defaultdict(list)
+def get_element(osm_file, tags=("node", "way")):
+    """
+    Usage: for element in get_element(osm_file): ...
+
+    Yields the node and way elements of an .osm or .osm.pbf file.
+    """
+    if pbf.is_pbf(osm_file):
+        for element in pbf.iter_elements(osm_file, tags=tags):
+            yield element
+        return
+
     with open(osm_file, 'r') as file:
         context = ET.iterparse(file, events=("start", "end"))
         context = iter(context)
         event, root = context.next()
 
         for event, element in context:
-            if event == "end" and element.tag in ["node", "way"]:
-                for tag in element.iter("tag"):
-                    if is_street_name(tag):
-                        audit_street_type(street_types, tag.attrib['v'])
-
+            if event == "end" and element.tag in tags:
+                yield element
                 root.clear()
 
+def audit_street(osm_file):
+    street_types = defaultdict(list)
+    for element in get_element(osm_file):
+        for tag in element.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
+
     with open(OUTPUT_FILE, 'w') as output_file:
         pprint.pprint(street_types)
         json.dump(street_types, output_file)
 
+def audit_street_index(index_dir=tag_index.TAG_INDEX_DIR):
+    """
+    Usage: street_types = audit_street_index()
+
+    Audits the distinct street names of the tag index built by
+    tag_index.py, instead of parsing the osm file.
+    """
+    index = tag_index.TagIndex(index_dir)
+    street_types = defaultdict(list)
+    for street_name, count in index.values('addr', 'street'):
+        for _ in range(count):
+            audit_street_type(street_types, street_name)
+    return street_types
+
+def street_sources(street_names, osm_file=OSM_FILE, index_dir=tag_index.TAG_INDEX_DIR,
+                   offsets_dir=offset_index.OFFSET_INDEX_DIR):
+    """
+    Usage: sources = street_sources(street_types['false>>'], osm_file)
+
+    Returns {street name: [(type, id, offset, length), ...]} with the
+    elements of osm_file holding each street name and where they are
+    in the file, from the tag index and the offset index of osm_file.
+    """
+    index = tag_index.TagIndex(index_dir)
+    offsets = offset_index.OffsetIndex(osm_file, offsets_dir)
+    try:
+        return {street_name: offsets.locate_refs(index.lookup('addr', 'street', street_name))
+                for street_name in street_names}
+    finally:
+        offsets.close()
+
 def load_street_types(input_file=OUTPUT_FILE):
 	with open(input_file) as input:
 		street_types = json.load(input)
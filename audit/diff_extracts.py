@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: diff_extracts.py
+---------------------------
+
+This program compares two versions of the London extract, e.g. the
+previous and the refreshed download, without loading either of them
+into the database.
+
+Both files (.osm or .osm.pbf) are streamed side by side and merged on
+(type, id), the order the openstreetmap extracts are sorted in, so
+only the current element of each file is held in memory whatever the
+size of the files. Every node and way which was added, removed or
+modified is written as one json line to the output file, with
+
+- the tags added, removed and changed
+- whether a node moved or the nodes of a way changed
+- the problems the audit rules of audit_street_names.py and
+  audit_post_codes.py find in the changed element: the ones the new
+  version introduced and the ones it resolved
+
+Only the changed elements are audited. The counts of the changes are
+printed at the end.
+
+Usage: python diff_extracts.py old.osm new.osm [diff.json]
+"""
+
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import data
+from audit_street_names import audit_street_type
+from audit_post_codes import audit_post_code, POST_CODE_KEYS
+
+OUTPUT_FILE = 'diff.json'
+
+TYPE_ORDER = {'node': 0, 'way': 1}
+
+
+def sorted_records(osm_file):
+    """
+    Usage: for key, record in sorted_records(osm_file): ...
+
+    Yields ((type order, id), record) for the nodes and ways of
+    osm_file, and checks they are sorted.
+    """
+    last_key = None
+    for record in data.iter_records(osm_file):
+        element_type, attrib = record[0], record[1]
+        key = (TYPE_ORDER[element_type], int(attrib['id']))
+        if last_key is not None and key <= last_key:
+            raise ValueError("%s is not sorted by type and id at %s %s" % (
+                osm_file, element_type, attrib['id']))
+        last_key = key
+        yield key, record
+
+
+def merge(old_records, new_records):
+    """
+    Usage: for old, new in merge(old_records, new_records): ...
+
+    Merges two sorted streams of records. Yields (old, new) pairs,
+    with None for the side an element is missing from.
+    """
+    end = (len(TYPE_ORDER), 0)
+    old_key, old = next(old_records, (end, None))
+    new_key, new = next(new_records, (end, None))
+    while old is not None or new is not None:
+        if old_key == new_key:
+            yield old, new
+            old_key, old = next(old_records, (end, None))
+            new_key, new = next(new_records, (end, None))
+        elif old_key < new_key:
+            yield old, None
+            old_key, old = next(old_records, (end, None))
+        else:
+            yield None, new
+            new_key, new = next(new_records, (end, None))
+
+
+def audit_tags(tags):
+    """
+    Usage: problems = audit_tags({'addr:street': 'High Strret'})
+
+    Returns the set of (rule, value) problems the audit rules find in
+    the tags of an element.
+    """
+    street_types = defaultdict(list)
+    invalid_post_codes = set()
+    for k, v in tags.iteritems():
+        if k == 'addr:street':
+            audit_street_type(street_types, v)
+        elif k in POST_CODE_KEYS:
+            audit_post_code(invalid_post_codes, v)
+
+    problems = set(('street_type', name) for names in street_types.itervalues() for name in names)
+    problems.update(('post_code', post_code) for post_code in invalid_post_codes)
+    return problems
+
+
+def diff_tags(old_tags, new_tags):
+    added = {k: v for k, v in new_tags.iteritems() if k not in old_tags}
+    removed = {k: v for k, v in old_tags.iteritems() if k not in new_tags}
+    changed = {k: [v, new_tags[k]] for k, v in old_tags.iteritems()
+               if k in new_tags and new_tags[k] != v}
+    return added, removed, changed
+
+
+def diff_elements(old, new):
+    """
+    Usage: change = diff_elements(old_record, new_record)
+
+    Returns the change between two versions of an element (either of
+    them None if it was added or removed) as a dictionary, or None
+    if the element did not change.
+    """
+    record = new or old
+    element_type, attrib = record[0], record[1]
+    old_tags = dict(old[2]) if old else {}
+    new_tags = dict(new[2]) if new else {}
+
+    change = {}
+    if old is not None and new is not None:
+        if element_type == 'node':
+            old_position = (float(old[1]['lat']), float(old[1]['lon']))
+            if old_position != (float(new[1]['lat']), float(new[1]['lon'])):
+                change['moved'] = True
+        elif list(old[3]) != list(new[3]):
+            change['nodes_changed'] = True
+        if old[1].get('version') != new[1].get('version'):
+            change['version'] = [old[1].get('version'), new[1].get('version')]
+
+    added, removed, changed = diff_tags(old_tags, new_tags)
+    for name, tags in (('tags_added', added), ('tags_removed', removed), ('tags_changed', changed)):
+        if tags:
+            change[name] = tags
+
+    if old is not None and new is not None and not change:
+        return None
+
+    change['type'] = element_type
+    change['id'] = int(attrib['id'])
+    change['change'] = 'added' if old is None else 'removed' if new is None else 'modified'
+
+    # audit the changed element only, both versions of it
+    old_problems = audit_tags(old_tags)
+    new_problems = audit_tags(new_tags)
+    if new_problems - old_problems:
+        change['problems_introduced'] = sorted(new_problems - old_problems)
+    if old_problems - new_problems:
+        change['problems_resolved'] = sorted(old_problems - new_problems)
+    return change
+
+
+def diff_extracts(old_file, new_file, output_file=OUTPUT_FILE):
+    """
+    Usage: counts = diff_extracts('london_2016.osm', 'london_2017.osm')
+
+    Writes the changes between two extracts as json lines to
+    output_file and returns the counts of the changes.
+    """
+    counts = Counter()
+    with open(output_file, 'w') as output:
+        for old, new in merge(sorted_records(old_file), sorted_records(new_file)):
+            change = diff_elements(old, new)
+            if change is None:
+                continue
+
+            counts[change['type'] + 's ' + change['change']] += 1
+            for name in ('tags_added', 'tags_removed', 'tags_changed',
+                         'problems_introduced', 'problems_resolved'):
+                if name in change:
+                    counts[name.replace('_', ' ')] += len(change[name])
+
+            output.write(json.dumps(change, sort_keys=True) + '\n')
+    return counts
+
+
+if __name__ == '__main__':
+    counts = diff_extracts(*sys.argv[1:4])
+    for name in sorted(counts):
+        print "%-24s %d" % (name, counts[name])
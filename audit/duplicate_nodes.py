@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: duplicate_nodes.py
+---------------------------
+
+This program finds duplicate points of interest: nodes at (almost) the
+same position with the same name or amenity, often added again by
+another user who did not see the first one.
+
+Instead of comparing every pair of nodes (a self join of the nodes
+table) the nodes are hashed to cells of a grid about DISTANCE metres
+a side, by quantised latitude and longitude. Nodes closer than
+DISTANCE are in the same or a neighbouring cell, so each node is only
+compared with the nodes of the 3 x 3 cells around it. Two nodes are
+
+- duplicates: within DISTANCE, with the same name, no different
+  values of a CATEGORY_KEYS tag, and added by two different users
+- similar: within DISTANCE, sharing the name or a category without
+  being duplicates. Two benches or post boxes of a street are
+  different places, and a user rarely adds the same place twice.
+- co-located: within COLOCATED metres, with tags which differ (a post
+  box stacked on a bakery)
+
+The clusters are written to DUPLICATES_PATH. The nodes linked by
+duplicates are grouped, and each group is split around the node to
+keep (the one with the most tags, the oldest id first): its
+duplicates are to 'remove', so a chain of same-named shops does not
+become one place, and no cluster is wider than DISTANCE. The other
+nodes of the group start clusters of their own, or are listed to
+'review' when alone. Similar and co-located nodes are only listed to
+'review', with the cluster of the node they are next to, or in a
+'similar' or 'co-located' cluster of their own, with nothing to
+remove.
+"""
+
+import json
+import math
+import os
+import re
+import sys
+from collections import defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'db'))
+import backend
+
+DUPLICATES_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'duplicate_nodes.json')
+
+# Metres between nodes of the same point of interest
+DISTANCE = 25.0
+# Metres between nodes stacked on each other
+COLOCATED = 0.5
+
+NAME_KEYS = ('name',)
+CATEGORY_KEYS = ('amenity', 'shop', 'tourism', 'leisure', 'office', 'craft', 'healthcare', 'historic')
+
+SELECT_POINTS_OF_INTEREST = """
+SELECT n.id, n.lat, n.lon, n.username, t.key, t.value
+FROM node_tags t JOIN nodes n ON n.id = t.node_id
+WHERE t.type = 'regular' AND t.key IN ('name', 'amenity', 'shop', 'tourism', 'leisure',
+                                       'office', 'craft', 'healthcare', 'historic');
+"""
+
+METRES_PER_DEGREE = 111320.0
+
+NOT_WORD = re.compile(r'[^\w]+', re.UNICODE)
+
+
+def normalize_name(name):
+    """"The Crown & Anchor" -> 'thecrownanchor'"""
+    return NOT_WORD.sub('', name.lower())
+
+
+def distance(a, b):
+    """Metres between two nodes, equirectangular"""
+    x = (b['lon'] - a['lon']) * math.cos(math.radians((a['lat'] + b['lat']) / 2))
+    y = b['lat'] - a['lat']
+    return METRES_PER_DEGREE * math.sqrt(x * x + y * y)
+
+
+def same_point_of_interest(a, b):
+    """Returns whether the tags of two nodes may describe the same place"""
+    if a['name'] and b['name'] and a['name'] != b['name']:
+        return False
+    categories = a['categories']
+    if any(categories.get(key, value) != value for key, value in b['categories'].iteritems()):
+        return False
+    shares_category = any(key in categories for key in b['categories'])
+    return bool(a['name'] and a['name'] == b['name']) or shares_category
+
+
+def pair_kind(a, b, metres, max_distance=DISTANCE, colocated=COLOCATED):
+    """Returns 'duplicate', 'similar' or 'co-located' for two nodes, or None"""
+    if metres <= max_distance and same_point_of_interest(a, b):
+        # only a name tells two places of a kind apart, and only
+        # another user would add a place again
+        if (a['name'] and a['name'] == b['name'] and
+                a['user'] is not None and b['user'] is not None and a['user'] != b['user']):
+            return 'duplicate'
+        return 'similar'
+    if metres <= colocated:
+        return 'co-located'
+    return None
+
+
+def load_points_of_interest(db, con):
+    """Returns the nodes with a name or category tag, one dictionary each"""
+    cur = db.dict_cursor(con)
+    cur.execute(SELECT_POINTS_OF_INTEREST)
+    nodes = {}
+    for row in cur.fetchall():
+        node = nodes.get(row['id'])
+        if node is None:
+            node = nodes[row['id']] = {'id': row['id'], 'lat': row['lat'], 'lon': row['lon'],
+                                       'user': row['username'], 'tags': {},
+                                       'name': None, 'categories': {}}
+        node['tags'][row['key']] = row['value']
+        if row['key'] in NAME_KEYS:
+            node['name'] = normalize_name(row['value'])
+        else:
+            node['categories'][row['key']] = row['value']
+    return [nodes[node_id] for node_id in sorted(nodes)]
+
+
+class Clusters(object):
+    """Union-find over the positions of the nodes"""
+
+    def __init__(self, size):
+        self.parent = range(size)
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+    def groups(self):
+        groups = defaultdict(list)
+        for i in range(len(self.parent)):
+            groups[self.find(i)].append(i)
+        return [group for group in groups.itervalues() if len(group) > 1]
+
+
+def find_pairs(nodes, max_distance=DISTANCE, colocated=COLOCATED):
+    """
+    Usage: for i, j, kind, metres in find_pairs(nodes): ...
+
+    Yields the pairs of nodes (positions in nodes) which are duplicates,
+    similar or co-located, comparing the nodes of neighbouring cells
+    only.
+    """
+    if not nodes:
+        return
+    # cells are max_distance high, and at least as wide, nearest to
+    # the poles where a degree of longitude is the shortest
+    max_lat = max(abs(node['lat']) for node in nodes)
+    cell_lat = max_distance / METRES_PER_DEGREE
+    cell_lon = cell_lat / max(math.cos(math.radians(max_lat)), 0.01)
+
+    cells = defaultdict(list)
+    for i, node in enumerate(nodes):
+        cells[(int(math.floor(node['lat'] / cell_lat)), int(math.floor(node['lon'] / cell_lon)))].append(i)
+
+    # each pair of cells once: the cell itself and half its neighbours
+    neighbours = ((0, 1), (1, -1), (1, 0), (1, 1))
+    for (row, column), members in cells.iteritems():
+        others = [(members[k + 1:], i) for k, i in enumerate(members)]
+        for dy, dx in neighbours:
+            neighbour = cells.get((row + dy, column + dx))
+            if neighbour:
+                others.extend((neighbour, i) for i in members)
+        for candidates, i in others:
+            for j in candidates:
+                metres = distance(nodes[i], nodes[j])
+                kind = pair_kind(nodes[i], nodes[j], metres, max_distance, colocated)
+                if kind is not None:
+                    yield i, j, kind, metres
+
+
+def _priority(node):
+    """The node to keep: the most tags, the oldest id first"""
+    return len(node['tags']), -node['id']
+
+
+def _split(nodes, group, pairs):
+    """
+    Yields (keep, [node, ...]) splitting a group of linked nodes around
+    the node to keep and the nodes it is linked to, then around the
+    best of the rest, so a chain of links is not taken for one place.
+    """
+    remaining = sorted(group, key=lambda i: _priority(nodes[i]), reverse=True)
+    while remaining:
+        keep = remaining[0]
+        linked = [i for i in remaining[1:] if (keep, i) in pairs]
+        if linked:
+            yield keep, linked
+        remaining = [i for i in remaining[1:] if (keep, i) not in pairs]
+
+
+def find_duplicates(nodes, max_distance=DISTANCE, colocated=COLOCATED):
+    """
+    Usage: clusters = find_duplicates(load_points_of_interest(db, con))
+
+    Returns the clusters of duplicate, similar or co-located nodes, the
+    ones added by several users first.
+    """
+    duplicates, nearby = Clusters(len(nodes)), Clusters(len(nodes))
+    duplicate_pairs, review_pairs = set(), {}
+    for i, j, kind, _ in find_pairs(nodes, max_distance, colocated):
+        if kind == 'duplicate':
+            duplicates.union(i, j)
+            duplicate_pairs.update(((i, j), (j, i)))
+        else:
+            review_pairs[i, j] = review_pairs[j, i] = kind
+
+    clusters = []
+    cluster_of = {}
+
+    def review_leftovers(pairs):
+        # nodes linked to a node of a cluster but to no node to keep,
+        # the far end of a chain, are reviewed with its cluster
+        for i, j in pairs:
+            if i in cluster_of and j not in cluster_of:
+                cluster_of[i]['review'].add(j)
+
+    # duplicates to remove, around the node to keep
+    for group in duplicates.groups():
+        for keep, remove in _split(nodes, group, duplicate_pairs):
+            cluster = {'kind': 'duplicate', 'keep': keep, 'remove': remove, 'review': set()}
+            clusters.append(cluster)
+            for i in [keep] + remove:
+                cluster_of[i] = cluster
+    review_leftovers(duplicate_pairs)
+
+    # similar and co-located nodes are reviewed with the cluster of the
+    # node they are next to, or grouped by themselves
+    for (i, j), kind in review_pairs.iteritems():
+        if i in cluster_of:
+            if cluster_of.get(j) is not cluster_of[i]:
+                cluster_of[i]['review'].add(j)
+        elif j not in cluster_of:
+            nearby.union(i, j)
+    for group in nearby.groups():
+        for keep, review in _split(nodes, group, review_pairs):
+            kinds = set(review_pairs[keep, i] for i in review)
+            cluster = {'kind': 'similar' if 'similar' in kinds else 'co-located',
+                       'keep': keep, 'remove': [], 'review': set(review)}
+            clusters.append(cluster)
+            for i in [keep] + review:
+                cluster_of[i] = cluster
+    review_leftovers(review_pairs)
+
+    report = []
+    for cluster in clusters:
+        keep = nodes[cluster['keep']]
+        remove = [nodes[i] for i in cluster['remove']]
+        review = [nodes[i] for i in sorted(cluster['review'])]
+        members = [keep] + remove + review
+        report.append({
+            'kind': cluster['kind'],
+            'keep': keep['id'],
+            'remove': sorted(node['id'] for node in remove),
+            'review': sorted(node['id'] for node in review),
+            'users': sorted(set(node['user'] for node in members if node['user'] is not None)),
+            'spread': round(max([distance(keep, node) for node in remove or review] or [0.0]), 1),
+            'nodes': [{'id': node['id'], 'lat': node['lat'], 'lon': node['lon'],
+                       'user': node['user'], 'tags': node['tags']} for node in members]
+        })
+    report.sort(key=lambda cluster: (-len(cluster['users']), cluster['keep']))
+    return report
+
+
+def save_duplicates(clusters, output_file=DUPLICATES_PATH):
+    with open(output_file, 'w') as output:
+        json.dump(clusters, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Connection to an exisiting database
+        con = db.connect()
+
+        nodes = load_points_of_interest(db, con)
+        clusters = find_duplicates(nodes)
+        save_duplicates(clusters)
+
+        for cluster in clusters[:20]:
+            names = set(node['tags'].get('name', '') for node in cluster['nodes'])
+            print "%-10s %12d %2d nodes %2d users %6.1f m  %s" % (
+                cluster['kind'], cluster['keep'], len(cluster['nodes']), len(cluster['users']),
+                cluster['spread'], ' / '.join(sorted(names)).encode('utf-8'))
+        print "%d clusters in %d points of interest" % (len(clusters), len(nodes))
+
+    except db.DatabaseError, e:
+
+        print "Error %s" % e
+        sys.exit(1)
+
+    finally:
+
+        if con:
+            con.close()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: sample_audit.py
+---------------------------
+
+This program gives a quick estimate of the street type and post code
+problems of an .osm file by auditing a random sample of its elements
+instead of all of them, in seconds rather than the time of a full
+parse of the London file.
+
+Random byte offsets are drawn uniformly over the elements of the
+memory-mapped file. Each offset is resynchronised on the top level
+element it falls into: the last element start before it, found with
+the pattern of offset_index.py. An element is drawn with probability
+proportional to its span in bytes, so every sampled element is
+weighted by 1 / span (Horvitz-Thompson), which makes
+
+- the estimated rates of invalid post codes and unexpected street
+  types ratio estimates, with a 95% confidence interval from their
+  linearized variance
+- the estimated numbers of street names and post codes in the file,
+  and of each offender, unbiased
+
+The most common offenders are counted in SpaceSaving sketches, and
+any value's estimated count can be read from a CountMin sketch (see
+sketches.py), so the memory used does not grow with the sample.
+
+Usage: python sample_audit.py osm_file [samples] [seed]
+"""
+
+import math
+import mmap
+import os
+import random
+import sys
+import time
+import xml.etree.cElementTree as ET
+from collections import defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import offset_index
+import pbf
+from audit_street_names import audit_street_type, is_street_name
+from audit_post_codes import audit_post_code, is_post_code
+from sketches import SpaceSaving, CountMin
+
+SAMPLES = 5000
+
+# z of a two sided 95% confidence interval
+Z_95 = 1.96
+
+# Bytes searched back from an offset for the start of its element,
+# doubled until one is found
+WINDOW = 4096
+
+# Offenders kept by the heavy hitter sketches
+TOP_K = 100
+
+AUDITED_TYPES = ('node', 'way')
+
+
+class RatioEstimate(object):
+    """
+    Weighted ratio estimate sum(w * y) / sum(w * x) of a rate, e.g.
+    y invalid post codes out of x post codes per sampled element.
+    """
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, weight, y, x):
+        self.samples.append((weight, y, x))
+
+    def rate(self):
+        wx = sum(w * x for w, _, x in self.samples)
+        return sum(w * y for w, y, _ in self.samples) / wx if wx else float('nan')
+
+    def interval(self, z=Z_95):
+        """Returns (low, high) of the confidence interval of the rate"""
+        n = len(self.samples)
+        wx = sum(w * x for w, _, x in self.samples)
+        if n < 2 or not wx:
+            return float('nan'), float('nan')
+        rate = self.rate()
+        residuals = sum((w * (y - rate * x)) ** 2 for w, y, x in self.samples)
+        error = z * math.sqrt(n / (n - 1.0) * residuals) / wx
+        return max(rate - error, 0.0), min(rate + error, 1.0)
+
+    def total(self, size):
+        """Estimated sum of x over the file, for weights 1 / span"""
+        n = len(self.samples)
+        return size * sum(w * x for w, _, x in self.samples) / n if n else 0.0
+
+
+def element_range(data):
+    """Offsets of the first element and of the end of the elements"""
+    match = offset_index.ELEMENT_START.search(data)
+    if match is None:
+        raise ValueError("no elements found")
+    end_of_elements = data.rfind('</osm>')
+    return match.start(), end_of_elements if end_of_elements >= 0 else len(data)
+
+
+def element_at(data, offset, first, end):
+    """
+    Usage: start, span = element_at(data, offset, first, end)
+
+    Returns the start and span in bytes of the top level element
+    holding offset: from its start to the start of the next one.
+    """
+    window = WINDOW
+    while True:
+        lo = max(offset - window, first)
+        start = None
+        for match in offset_index.ELEMENT_START.finditer(data, lo, min(offset + window, end)):
+            if match.start() > offset:
+                break
+            start = match.start()
+        if start is not None or lo == first:
+            break
+        window *= 2
+
+    next_element = offset_index.ELEMENT_START.search(data, start + 1, end)
+    next_start = next_element.start() if next_element else end
+    return start, next_start - start
+
+
+def parse_element(data, start, span):
+    return ET.fromstring(data[start:data.rfind('>', start, start + span) + 1])
+
+
+def sample_audit(osm_file, samples=SAMPLES, seed=None):
+    """
+    Usage: results = sample_audit(osm_file, 2000)
+
+    Audits samples elements of osm_file drawn at random byte offsets.
+    Returns a dictionary of the estimates.
+    """
+    if pbf.is_pbf(osm_file):
+        raise ValueError("%s: only .osm files can be sampled by offset" % osm_file)
+
+    rng = random.Random(seed)
+    post_codes = RatioEstimate()
+    street_names = RatioEstimate()
+    top_post_codes = SpaceSaving(TOP_K)
+    top_street_types = SpaceSaving(TOP_K)
+    offenders = CountMin()
+
+    with open(osm_file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        first, end = element_range(data)
+        size = end - first
+
+        # sorted offsets read the file front to back
+        for offset in sorted(rng.randrange(first, end) for _ in range(samples)):
+            start, span = element_at(data, offset, first, end)
+            element = parse_element(data, start, span)
+            # drawn with probability span / size
+            weight = 1.0 / span
+            scale = float(size) / span / samples
+
+            post_code_count, street_count = 0, 0
+            invalid_post_codes = set()
+            street_types = defaultdict(list)
+            if element.tag in AUDITED_TYPES:
+                for tag in element.iter('tag'):
+                    if is_post_code(tag):
+                        post_code_count += 1
+                        audit_post_code(invalid_post_codes, tag.attrib['v'])
+                    elif is_street_name(tag):
+                        street_count += 1
+                        audit_street_type(street_types, tag.attrib['v'])
+
+            for post_code in invalid_post_codes:
+                top_post_codes.add(post_code, scale)
+                offenders.add('post_code:' + post_code, scale)
+            for street_type, names in street_types.iteritems():
+                top_street_types.add(street_type, scale * len(names))
+                offenders.add('street_type:' + street_type, scale * len(names))
+
+            post_codes.add(weight, len(invalid_post_codes), post_code_count)
+            street_names.add(weight, sum(len(names) for names in street_types.itervalues()), street_count)
+    finally:
+        data.close()
+
+    return {
+        'samples': samples,
+        'post_codes': post_codes.total(size),
+        'invalid_post_code_rate': post_codes.rate(),
+        'invalid_post_code_interval': post_codes.interval(),
+        'street_names': street_names.total(size),
+        'unexpected_street_type_rate': street_names.rate(),
+        'unexpected_street_type_interval': street_names.interval(),
+        'top_post_codes': top_post_codes.most_common(10),
+        'top_street_types': top_street_types.most_common(10),
+        'offenders': offenders
+    }
+
+
+if __name__ == '__main__':
+    osm_file = sys.argv[1]
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else SAMPLES
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    start = time.time()
+    results = sample_audit(osm_file, samples, seed)
+
+    print "%d elements sampled in %.2f s" % (samples, time.time() - start)
+    for label, rate, (low, high) in (
+            ('invalid post codes', results['invalid_post_code_rate'], results['invalid_post_code_interval']),
+            ('unexpected street types', results['unexpected_street_type_rate'],
+             results['unexpected_street_type_interval'])):
+        print "%-24s %6.2f%%  (95%% CI %.2f%% - %.2f%%)" % (label, 100 * rate, 100 * low, 100 * high)
+    print "~%d post codes, ~%d street names in the file" % (results['post_codes'], results['street_names'])
+
+    for name, label in (('top_street_types', 'street type'), ('top_post_codes', 'post code')):
+        print
+        print "%-24s %s" % (label, 'estimated count')
+        for value, count, error in results[name]:
+            print "%-24s ~%.1f" % (value.encode('utf-8'), count)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: sketches.py
+---------------------------
+
+Fixed size summaries of a stream of values, for counting the most
+common offenders (street types, post codes) of an audit without
+keeping every distinct value.
+
+- SpaceSaving keeps k counters and finds the heavy hitters: any value
+  making up more than 1/k of the total is guaranteed to be kept, and
+  its count is overestimated by at most the error reported with it.
+- CountMin estimates the count of any value from a width x depth
+  table of counters, overestimating by at most total * e / width with
+  probability 1 - exp(-depth).
+
+Both take weighted updates, so sampled values can be scaled up to
+estimates for the whole file.
+"""
+
+import math
+import zlib
+from array import array
+
+
+class SpaceSaving(object):
+    """
+    Usage: top = SpaceSaving(50); top.add('Rd'); top.most_common(10)
+
+    Space-Saving heavy hitters with k counters.
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+
+    def add(self, value, weight=1):
+        self.total += weight
+        if value in self.counts:
+            self.counts[value] += weight
+        elif len(self.counts) < self.k:
+            self.counts[value] = weight
+            self.errors[value] = 0
+        else:
+            # the value takes over the smallest counter, whose count
+            # bounds how often it may have been seen before
+            smallest = min(self.counts, key=self.counts.get)
+            count = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[value] = count + weight
+            self.errors[value] = count
+
+    def most_common(self, n=None):
+        """Returns [(value, count, error), ...], largest count first"""
+        ranked = sorted(self.counts.iteritems(), key=lambda (value, count): -count)
+        return [(value, count, self.errors[value]) for value, count in ranked[:n]]
+
+
+class CountMin(object):
+    """
+    Usage: counts = CountMin(); counts.add('SG4 X'); counts['SG4 X']
+
+    Count-Min sketch of width x depth counters.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = [array('d', [0.0]) * width for _ in range(depth)]
+        self.total = 0
+
+    @classmethod
+    def for_error(cls, epsilon=0.001, delta=0.01):
+        """Sketch overestimating by at most epsilon * total with probability 1 - delta"""
+        return cls(int(math.ceil(math.e / epsilon)), int(math.ceil(math.log(1 / delta))))
+
+    def _columns(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # double hashing: the i-th row uses h1 + i * h2
+        h1 = zlib.crc32(value) & 0xffffffff
+        h2 = zlib.adler32(value) & 0xffffffff | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, value, weight=1):
+        self.total += weight
+        for row, column in zip(self.table, self._columns(value)):
+            row[column] += weight
+
+    def __getitem__(self, value):
+        return min(row[column] for row, column in zip(self.table, self._columns(value)))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: suggest_street_types.py
+---------------------------
+
+This program proposes corrections for the unexpected street types
+found by audit_street_names.py ("Rpad", "Strret", "Rd", "road,"), to
+build the mapping used by update_street_names.py.
+
+The targets are the expected street types plus the types which are
+frequent in the data (Close, Gardens, Mews, ...). They are stored in
+a BK-tree, so each unexpected type is only compared with the few
+targets its edit distance bounds cannot rule out. A type is matched
+
+- as is, once case and punctuation are removed ('road,' -> Road)
+- as a misspelling of a target, for the rare types (at most
+  MAX_MISSPELLED street names). The edit distance follows typing
+  mistakes: a letter typed twice, left out, swapped with its
+  neighbour or replaced by a neighbouring key costs one edit, any
+  other replacement two, so 'Rpad' is one edit from Road but 'Hall'
+  two from Hill. Plurals ('Lanes', 'Cottage') are not misspellings,
+  and a frequent type is only proposed for types at least
+  FREQUENCY_RATIO times rarer.
+- as an abbreviation of a target, for types of at most
+  MAX_ABBREVIATION letters which keep the first letter and the order
+  of the letters ('Rd' -> Road, 'Sq' -> Square, 'Ave' -> Avenue)
+
+Types which are the whole street name ('Packway') are left out.
+
+The suggestions of each type are ranked, best first, and written to
+SUGGESTED_MAPPING_PATH. Review it and remove the wrong ones ('Brow'
+is no misspelling of Row), then run update_street_names.py with
+--suggested-mapping, which loads the best suggestion of each type
+from it. Without the flag the file is not used.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+from audit_street_names import expected, audit_street_index
+
+STREET_TYPES_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'street_types.json')
+SUGGESTED_MAPPING_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'street_mapping.json')
+
+# Street names a type needs to be a target itself
+MIN_FREQUENCY = 10
+# A misspelling is rarely repeated more often
+MAX_MISSPELLED = 2
+# How much more frequent a target has to be than the type it corrects
+FREQUENCY_RATIO = 10
+# Longest abbreviation considered
+MAX_ABBREVIATION = 3
+
+# Ranking of the kinds of suggestions
+KINDS = ('normalized', 'misspelling', 'abbreviation')
+
+NOT_LETTERS = re.compile(r'[^a-z]')
+
+KEYBOARD_ROWS = ('qwertyuiop', 'asdfghjkl', 'zxcvbnm')
+
+
+def _neighbouring_keys():
+    """Pairs of letters next to each other on a qwerty keyboard"""
+    pairs = set()
+    for above, below in zip(KEYBOARD_ROWS, KEYBOARD_ROWS[1:] + ('',)):
+        for i, key in enumerate(above):
+            for neighbour in above[i + 1:i + 2] + below[max(i - 1, 0):i + 1]:
+                pairs.add((key, neighbour))
+                pairs.add((neighbour, key))
+    return pairs
+
+NEIGHBOURING_KEYS = _neighbouring_keys()
+
+
+def normalize(street_type):
+    """Lower case letters of a street type, 'Road--' -> 'road'"""
+    return NOT_LETTERS.sub('', street_type.lower())
+
+
+def max_distance(word):
+    """Edits allowed for a misspelling of word"""
+    return 1 if len(word) < 8 else 2
+
+
+def is_plural(a, b):
+    a, b = sorted((a, b), key=len)
+    return b in (a + 's', a + 'es')
+
+
+def edit_distance(a, b, transpositions=True):
+    """
+    Usage: edit_distance('wqalk', 'walk')
+
+    Optimal string alignment distance: insertions, deletions and
+    transpositions of adjacent letters cost one edit, substitutions one
+    edit for neighbouring keys and two otherwise. Without transpositions
+    this is a (weighted Levenshtein) metric.
+    """
+    previous2 = None
+    previous = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+            elif (a[i - 1], b[j - 1]) in NEIGHBOURING_KEYS:
+                cost = 1
+            else:
+                cost = 2
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if transpositions and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+
+def is_abbreviation(short, word):
+    """
+    Usage: is_abbreviation('sq', 'square')
+
+    Returns whether short keeps the first letter and letter order of
+    word, and is either its start ('ave') or has no vowels after the
+    first letter ('rd').
+    """
+    if not short or len(short) >= len(word) or short[0] != word[0]:
+        return False
+    if not word.startswith(short) and any(letter in 'aeiou' for letter in short[1:]):
+        return False
+    letters = iter(word[1:])
+    return all(letter in letters for letter in short[1:])
+
+
+def abbreviates(word, targets=None):
+    """Returns the normalized (expected) types word may abbreviate"""
+    if len(word) > MAX_ABBREVIATION:
+        return []
+    if targets is None:
+        targets = [normalize(target) for target in expected]
+    return [target for target in targets if is_abbreviation(word, target)]
+
+
+class BKTree(object):
+    """
+    Usage: tree = BKTree(words); tree.search('strret', 2)
+
+    Burkhard-Keller tree over edit_distance without transpositions.
+    Each child hangs off its parent at its distance from it, and the
+    triangle inequality limits a search to the children at parent
+    distance +- the search radius. The distance with transpositions
+    is no metric, so search for those with twice the radius (a
+    transposition is at most two edits without) and check the results.
+    """
+
+    def __init__(self, words=()):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            parent, children = node
+            distance = edit_distance(word, parent, transpositions=False)
+            if distance == 0:
+                return
+            if distance not in children:
+                children[distance] = (word, {})
+                return
+            node = children[distance]
+
+    def search(self, word, radius):
+        """Returns [(distance, target), ...] of the targets within radius of word"""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            target, children = nodes.pop()
+            distance = edit_distance(word, target, transpositions=False)
+            if distance <= radius:
+                found.append((distance, target))
+            for child_distance, child in children.iteritems():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        return found
+
+
+def suggest(street_types):
+    """
+    Usage: suggestions = suggest({'Rpad': ['Church Rpad'], ...})
+
+    Returns {street type: [suggestion, ...]} for the unexpected street
+    types with at least one suggestion. Each suggestion is a dictionary
+    with the corrected type, kind, edit distance and the number of
+    street names with the corrected type.
+    """
+    counts = {street_type: len(names) for street_type, names in street_types.iteritems()}
+
+    # normalized target -> (target, count), count None for the expected
+    # types. Frequent abbreviations ('Rd', 'St') are not targets.
+    targets = {normalize(street_type): (street_type, counts[street_type])
+               for street_type in counts
+               if counts[street_type] >= MIN_FREQUENCY and not abbreviates(normalize(street_type))}
+    targets.update((normalize(street_type), (street_type, None)) for street_type in expected)
+    tree = BKTree(targets)
+
+    suggestions = {}
+    for street_type, count in counts.iteritems():
+        word = normalize(street_type)
+        if not word or street_types[street_type] == [street_type]:
+            continue
+
+        ranked = []
+        if word in targets and targets[word][0] != street_type:
+            ranked.append((KINDS.index('normalized'), 0, word))
+
+        if count <= MAX_MISSPELLED:
+            for _, target in tree.search(word, 2 * max_distance(word)):
+                target_count = targets[target][1]
+                distance = edit_distance(word, target)
+                if distance == 0 or distance > max_distance(word) or is_plural(word, target):
+                    continue
+                if target_count is None or target_count >= FREQUENCY_RATIO * count:
+                    ranked.append((KINDS.index('misspelling'), distance, target))
+
+        # abbreviations keep their letters, '5A' is not one
+        if word not in targets and street_type[:1].isalpha() and not any(c.isdigit() for c in street_type):
+            for target in abbreviates(word, targets):
+                ranked.append((KINDS.index('abbreviation'), edit_distance(word, target), target))
+
+        if ranked:
+            # rank by kind and distance, the most frequent target
+            # first; abbreviations of expected types come first
+            def rank((kind, distance, target)):
+                target_count = targets[target][1]
+                return (kind, KINDS[kind] == 'abbreviation' and target_count is not None,
+                        distance, -(target_count or sys.maxint))
+            ranked.sort(key=rank)
+            suggestions[street_type] = [
+                {'type': targets[target][0], 'kind': KINDS[kind], 'distance': distance, 'count': targets[target][1]}
+                for kind, distance, target in ranked
+            ]
+    return suggestions
+
+
+def load_street_types(input_file=STREET_TYPES_PATH):
+    with open(input_file) as input:
+        return json.load(input)
+
+
+def save_suggestions(suggestions, output_file=SUGGESTED_MAPPING_PATH):
+    with open(output_file, 'w') as output:
+        json.dump(suggestions, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    # --index audits the street names of the tag index instead of
+    # reading the street types saved by audit_street_names.py
+    if '--index' in sys.argv:
+        street_types = audit_street_index()
+    else:
+        street_types = load_street_types()
+
+    start = time.time()
+    suggestions = suggest(street_types)
+    elapsed = time.time() - start
+
+    for street_type in sorted(suggestions):
+        best = suggestions[street_type][0]
+        print "%-16s -> %-12s %s" % (street_type, best['type'], best['kind'])
+    print "%d of %d street types corrected in %.3f s" % (len(suggestions), len(street_types), elapsed)
+
+    save_suggestions(suggestions)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: address_index.py
+---------------------------
+
+This script builds an address index from the addr tags of the
+database, once the update scripts have cleaned the street names and
+post codes, so addresses are looked up without joining the tag tables
+with the nodes.
+
+Every node and way with an addr:street, addr:postcode or
+addr:housenumber tag becomes an address record with a position: the
+node's, or the centroid (mean position) of a way's nodes. The records
+are stored as numpy arrays in ADDRESS_INDEX_DIR:
+
+- ref, lat, lon               element (id << 1 | kind, as in the tag
+                              index), position
+- housenumber, street, postcode
+                              the number of the value in strings.bin
+                              (-1 when the tag is missing)
+- strings.bin, strings_offsets.npy
+                              the distinct values, as utf-8
+- postcode_order, street_order
+                              the records sorted by normalised post
+                              code ('SE17PB') and street name
+                              ('baker street'), with the sorted keys
+                              in postcode_keys.bin and street_keys.bin
+                              (with their _offsets.npy)
+- cell_order, cells           the records sorted by grid cell of
+                              CELL_DEGREES
+
+Everything is memory-mapped when the index is loaded. Post code and
+street lookups are binary searches (exact or prefix) over the sorted
+keys, and the nearest address to a position is found by searching the
+grid cells in rings around it.
+
+Usage: python address_index.py
+"""
+
+import math
+import mmap
+import os
+import re
+import sys
+
+import numpy as np
+
+import backend
+
+ADDRESS_INDEX_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'address_index')
+
+KINDS = ('node', 'way')
+
+ADDRESS_KEYS = ('housenumber', 'street', 'postcode')
+
+SELECT_NODE_ADDRESSES = """
+SELECT t.node_id AS id, t.key, t.value, n.lat, n.lon
+FROM node_tags t JOIN nodes n ON n.id = t.node_id
+WHERE t.type = 'addr' AND t.key IN ('housenumber', 'street', 'postcode');
+"""
+
+SELECT_WAY_ADDRESSES = """
+SELECT way_id AS id, key, value
+FROM way_tags
+WHERE type = 'addr' AND key IN ('housenumber', 'street', 'postcode');
+"""
+
+# Mean position of the distinct nodes of the ways with an address
+SELECT_WAY_CENTROIDS = """
+SELECT w.way_id AS id, AVG(n.lat) AS lat, AVG(n.lon) AS lon
+FROM (SELECT DISTINCT way_id, node_id FROM way_nodes
+      WHERE way_id IN (SELECT way_id FROM way_tags
+                       WHERE type = 'addr' AND key IN ('housenumber', 'street', 'postcode'))) w
+JOIN nodes n ON n.id = w.node_id
+GROUP BY w.way_id;
+"""
+
+# Grid cells of about 1 km for the nearest address lookup
+CELL_DEGREES = 0.01
+CELL_COLUMNS = int(round(360 / CELL_DEGREES))
+
+# Rings of cells searched for the nearest address, about 50 km
+MAX_RINGS = 50
+
+METRES_PER_DEGREE = 111320.0
+
+NOT_WORD = re.compile(r'[^\w ]+', re.UNICODE)
+SPACES = re.compile(r'\s+', re.UNICODE)
+
+
+def _decode(value):
+    # psycopg2 returns text as utf-8 encoded str, sqlite as unicode
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+
+def normalize_post_code(post_code):
+    """'se1 7pb' -> u'SE17PB'"""
+    return SPACES.sub('', _decode(post_code)).upper()
+
+
+def normalize_street(street):
+    """"Baker  St." -> u'baker st'"""
+    return SPACES.sub(' ', NOT_WORD.sub('', _decode(street))).strip().lower()
+
+
+def cell_of(lat, lon):
+    """Grid cell (row * CELL_COLUMNS + column) of positions"""
+    rows = np.floor((np.asarray(lat) + 90) / CELL_DEGREES).astype(np.int64)
+    columns = np.floor((np.asarray(lon) + 180) / CELL_DEGREES).astype(np.int64)
+    return rows * CELL_COLUMNS + columns
+
+
+def distance(lat, lon, lats, lons):
+    """Distances in metres from a position, equirectangular"""
+    x = (np.asarray(lons) - lon) * math.cos(math.radians(lat))
+    y = np.asarray(lats) - lat
+    return METRES_PER_DEGREE * np.sqrt(x * x + y * y)
+
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def _write_strings(path, offsets_path, strings):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(path, 'wb') as output_file:
+        for i, string in enumerate(strings):
+            string = _encode(string)
+            output_file.write(string)
+            offsets[i + 1] = offsets[i] + len(string)
+    np.save(offsets_path, offsets)
+
+
+# ================================================== #
+#               Building                             #
+# ================================================== #
+class AddressIndexBuilder(object):
+    """Collects address records, see build_from_db"""
+
+    def __init__(self):
+        self.addresses = []
+
+    def add(self, kind, element_id, tags, lat, lon):
+        """tags is a dictionary of the addr keys of the element"""
+        tags = {key: _decode(value) for key, value in tags.iteritems()}
+        self.addresses.append((int(element_id) << 1 | KINDS.index(kind), tags, float(lat), float(lon)))
+
+    def save(self, directory=ADDRESS_INDEX_DIR):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        def save_array(name, values):
+            np.save(os.path.join(directory, name + '.npy'), values)
+
+        self.addresses.sort(key=lambda address: address[0])
+        strings = {}
+        columns = {key: np.zeros(len(self.addresses), dtype=np.int64) for key in ADDRESS_KEYS}
+        for i, (_, tags, _, _) in enumerate(self.addresses):
+            for key in ADDRESS_KEYS:
+                value = tags.get(key)
+                columns[key][i] = -1 if value is None else strings.setdefault(value, len(strings))
+
+        values = sorted(strings, key=strings.get)
+        _write_strings(os.path.join(directory, 'strings.bin'),
+                       os.path.join(directory, 'strings_offsets.npy'), values)
+
+        lats = np.array([address[2] for address in self.addresses], dtype=np.float64)
+        lons = np.array([address[3] for address in self.addresses], dtype=np.float64)
+        save_array('ref', np.array([address[0] for address in self.addresses], dtype=np.int64))
+        save_array('lat', lats)
+        save_array('lon', lons)
+        for key in ADDRESS_KEYS:
+            save_array(key, columns[key])
+
+        for key, normalize in (('postcode', normalize_post_code), ('street', normalize_street)):
+            keyed = [(normalize(values[code]), i) for i, code in enumerate(columns[key]) if code >= 0]
+            keyed.sort()
+            save_array(key + '_order', np.array([i for _, i in keyed], dtype=np.int64))
+            _write_strings(os.path.join(directory, key + '_keys.bin'),
+                           os.path.join(directory, key + '_keys_offsets.npy'),
+                           [normalized for normalized, _ in keyed])
+
+        cells = cell_of(lats, lons)
+        order = np.argsort(cells, kind='mergesort')
+        save_array('cell_order', order)
+        save_array('cells', cells[order])
+
+
+def build_from_db(db, con):
+    """
+    Usage: build_from_db(db, con).save()
+
+    Builds the index from the addr tags of the nodes and ways tables.
+    """
+    cur = db.dict_cursor(con)
+    builder = AddressIndexBuilder()
+
+    cur.execute(SELECT_NODE_ADDRESSES)
+    nodes = {}
+    for row in cur.fetchall():
+        tags, _, _ = nodes.setdefault(row['id'], ({}, row['lat'], row['lon']))
+        tags[row['key']] = row['value']
+    for node_id, (tags, lat, lon) in nodes.iteritems():
+        builder.add('node', node_id, tags, lat, lon)
+
+    cur.execute(SELECT_WAY_ADDRESSES)
+    ways = {}
+    for row in cur.fetchall():
+        ways.setdefault(row['id'], {})[row['key']] = row['value']
+    cur.execute(SELECT_WAY_CENTROIDS)
+    for row in cur.fetchall():
+        # ways whose nodes are all outside the extract have no position
+        if row['id'] in ways and row['lat'] is not None:
+            builder.add('way', row['id'], ways[row['id']], row['lat'], row['lon'])
+
+    return builder
+
+
+# ================================================== #
+#               Queries                              #
+# ================================================== #
+def _mmap(path):
+    if os.path.getsize(path) == 0:
+        return ''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _Strings(object):
+    """Memory-mapped strings.bin style file"""
+
+    def __init__(self, path, offsets_path):
+        self.data = _mmap(path)
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def bisect(self, key, right=False):
+        """Returns the position of the first string >= key (> key if right)"""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            string = self[mid]
+            if string < key or (right and string == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix):
+        # every string starting with prefix sorts below prefix + '\xff'
+        return self.bisect(prefix), self.bisect(prefix + '\xff')
+
+
+class AddressIndex(object):
+    """Memory-mapped address index written by AddressIndexBuilder.save"""
+
+    def __init__(self, directory=ADDRESS_INDEX_DIR):
+        def load_array(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+        def load_strings(name):
+            return _Strings(os.path.join(directory, name + '.bin'),
+                            os.path.join(directory, name + '_offsets.npy'))
+
+        self.ref = load_array('ref')
+        self.lat = load_array('lat')
+        self.lon = load_array('lon')
+        self.columns = {key: load_array(key) for key in ADDRESS_KEYS}
+        self.strings = load_strings('strings')
+        self.orders = {key: load_array(key + '_order') for key in ('postcode', 'street')}
+        self.keys = {key: load_strings(key + '_keys') for key in ('postcode', 'street')}
+        self.cell_order = load_array('cell_order')
+        self.cells = load_array('cells')
+
+    def __len__(self):
+        return len(self.ref)
+
+    def address(self, i):
+        """Returns the i-th address record as a dictionary"""
+        ref = int(self.ref[i])
+        address = {'type': KINDS[ref & 1], 'id': ref >> 1,
+                   'lat': float(self.lat[i]), 'lon': float(self.lon[i])}
+        for key in ADDRESS_KEYS:
+            code = self.columns[key][i]
+            address[key] = self.strings[code].decode('utf-8') if code >= 0 else None
+        return address
+
+    def _lookup(self, key, normalized, prefix, limit):
+        keys = self.keys[key]
+        if prefix:
+            lo, hi = keys.prefix_range(normalized)
+        else:
+            lo, hi = keys.bisect(normalized), keys.bisect(normalized, right=True)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return [self.address(i) for i in self.orders[key][lo:hi]]
+
+    def by_post_code(self, post_code, prefix=False, limit=None):
+        """
+        Usage: index.by_post_code('SE1', prefix=True)
+
+        Returns the addresses with a post code, or starting with it.
+        """
+        return self._lookup('postcode', _encode(normalize_post_code(post_code)), prefix, limit)
+
+    def by_street(self, street, prefix=False, limit=None):
+        """
+        Usage: index.by_street('Baker Street')
+
+        Returns the addresses in a street, or in the streets starting
+        with it.
+        """
+        return self._lookup('street', _encode(normalize_street(street)), prefix, limit)
+
+    def _cell_records(self, row, first_column, last_column):
+        """Records in the cells of a row, the cells of a row are contiguous"""
+        lo = np.searchsorted(self.cells, row * CELL_COLUMNS + first_column, side='left')
+        hi = np.searchsorted(self.cells, row * CELL_COLUMNS + last_column, side='right')
+        return self.cell_order[lo:hi]
+
+    def nearest(self, lat, lon, k=1):
+        """
+        Usage: index.nearest(51.5237, -0.1585)
+
+        Returns [(distance in metres, address), ...] of the k nearest
+        addresses to a position, searching up to MAX_RINGS cells away.
+        """
+        row, column = divmod(int(cell_of(lat, lon)), CELL_COLUMNS)
+        candidates = []
+        for ring in range(MAX_RINGS + 1):
+            # top and bottom rows of the ring, then its sides
+            spans = [(row - ring, column - ring, column + ring)]
+            if ring:
+                spans.append((row + ring, column - ring, column + ring))
+            for dy in range(-ring + 1, ring):
+                spans.append((row + dy, column - ring, column - ring))
+                spans.append((row + dy, column + ring, column + ring))
+
+            for span in spans:
+                records = self._cell_records(*span)
+                if len(records):
+                    records = np.asarray(records)
+                    distances = distance(lat, lon, self.lat[records], self.lon[records])
+                    candidates.extend(zip(distances.tolist(), records.tolist()))
+            candidates.sort()
+            del candidates[k:]
+
+            # anything outside the rings searched is further than this
+            reach = ring * CELL_DEGREES * METRES_PER_DEGREE * math.cos(math.radians(lat))
+            if len(candidates) == k and candidates[-1][0] <= reach:
+                break
+        return [(d, self.address(i)) for d, i in candidates]
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Connection to an exisiting database
+        con = db.connect()
+
+        builder = build_from_db(db, con)
+        builder.save()
+        print "%d addresses indexed" % len(builder.addresses)
+
+    except db.DatabaseError, e:
+
+        print "Error %s" % e
+        sys.exit(1)
+
+    finally:
+
+        if con:
+            con.close()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: backend.py
+---------------------------
+
+Storage backends for the osm tables. The scripts that create, load,
+clean and report on the database talk to a backend instead of to
+psycopg2 directly, so they run against either
+
+- PostgresBackend: the osm_playground postgresql database, or
+- SQLiteBackend: an embedded sqlite database file, which needs no
+  running server for analysis on a laptop or a quick test run.
+
+The backend is chosen with the OSM_BACKEND environment variable
+('postgres', the default, or 'sqlite'); the sqlite database file can
+be set with OSM_SQLITE_PATH.
+
+Statements are written for postgresql with pyformat parameters
+(%(name)s); backend.sql adapts them where needed. The sqlite backend
+registers a regexp_replace function so the report queries run
+unchanged.
+"""
+
+import csv
+import os
+import re
+import sqlite3
+import Queue
+
+DSN = "dbname=osm_playground user=abkds"
+SQLITE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'osm_playground.db')
+
+# Rows per executemany while loading csv files into sqlite
+LOAD_BATCH_SIZE = 50000
+
+PYFORMAT_PARAM = re.compile(r'%\((\w+)\)s')
+
+# A table of the dictionary encoded layout, see create_db.py --coded
+CODED_TABLE = 'nodes_coded'
+
+
+def get_backend(name=None):
+    """
+    Usage: backend = get_backend()
+
+    Returns the backend named by name or by the OSM_BACKEND environment
+    variable.
+    """
+    name = name or os.environ.get('OSM_BACKEND', 'postgres')
+    if name == 'postgres':
+        return PostgresBackend(os.environ.get('OSM_DSN', DSN))
+    elif name == 'sqlite':
+        return SQLiteBackend(os.environ.get('OSM_SQLITE_PATH', SQLITE_PATH))
+    raise ValueError("Unknown backend %s" % name)
+
+
+def check_plain_layout(db, con):
+    """
+    Raise db.DatabaseError if the database holds the dictionary encoded
+    layout. Its nodes, ways and tag tables are views, which the update
+    scripts cannot write to and create_indexes.py cannot index.
+    """
+    if CODED_TABLE in db.tables(con):
+        raise db.DatabaseError("The database holds the dictionary encoded layout "
+                               "(create_db.py --coded), its tag tables are read only views. "
+                               "Load the plain layout to update or index the data.")
+
+
+class PostgresBackend(object):
+    """The osm_playground postgresql database, through psycopg2"""
+
+    name = 'postgres'
+
+    def __init__(self, dsn=DSN):
+        import psycopg2
+        import psycopg2.extras
+        import psycopg2.pool
+        self.psycopg2 = psycopg2
+        self.DatabaseError = psycopg2.DatabaseError
+        self.dsn = dsn
+
+    def connect(self):
+        return self.psycopg2.connect(self.dsn)
+
+    def dict_cursor(self, con):
+        return con.cursor(cursor_factory=self.psycopg2.extras.RealDictCursor)
+
+    def sql(self, statement):
+        return statement
+
+    def pool(self, size):
+        return self.psycopg2.pool.ThreadedConnectionPool(1, size, self.dsn)
+
+    def load_csv(self, con, file_table_tuples):
+        """Copy (path, table) csv files into their tables and commit"""
+        cur = con.cursor()
+        for path, table in file_table_tuples:
+            with open(path) as f:
+                sql_copy = "COPY %s FROM STDIN WITH (FORMAT CSV, HEADER, QUOTE '\"')" % (table)
+                cur.copy_expert(sql_copy, f)
+        con.commit()
+
+    def table_stamps(self, con):
+        """
+        Returns a stamp per table that changes whenever its rows do: its
+        version, bumped by the triggers create_db.py sets up. These are
+        committed with the change itself, unlike the statistics
+        counters, which are updated later and can be reset.
+
+        Returns None for a database created without them.
+        """
+        cur = con.cursor()
+        cur.execute("SELECT to_regclass('table_versions');")
+        if cur.fetchone()[0] is None:
+            stamps = None
+        else:
+            cur.execute("SELECT name, version FROM table_versions;")
+            stamps = {name: str(version) for name, version in cur.fetchall()}
+        # ends the transaction of the select, the connection is pooled
+        con.rollback()
+        return stamps
+
+    def tables(self, con):
+        """Returns the names of the tables (not the views)"""
+        cur = con.cursor()
+        cur.execute("""SELECT table_name FROM information_schema.tables
+                       WHERE table_schema = current_schema() AND table_type = 'BASE TABLE';""")
+        return set(name for name, in cur.fetchall())
+
+    def seq_scans(self, cur, statement):
+        """Returns the tables the plan of a statement reads with a seq scan"""
+        cur.execute("EXPLAIN (FORMAT JSON) " + statement)
+        return _pg_seq_scans(cur.fetchone()[0][0]['Plan'])
+
+
+def _pg_seq_scans(plan):
+    relations = []
+    if plan['Node Type'] == 'Seq Scan':
+        relations.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        relations.extend(_pg_seq_scans(child))
+    return relations
+
+
+def _regexp_replace(value, pattern, replacement):
+    # postgres replaces the first match unless the 'g' flag is given
+    if value is None:
+        return None
+    return re.sub(pattern, replacement, value, count=1)
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class _SQLitePool(object):
+    """Fixed set of sqlite connections shared by threads"""
+
+    def __init__(self, backend, size):
+        self.connections = Queue.Queue()
+        for _ in range(size):
+            self.connections.put(backend.connect(check_same_thread=False))
+
+    def getconn(self):
+        return self.connections.get()
+
+    def putconn(self, con):
+        self.connections.put(con)
+
+    def closeall(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class SQLiteBackend(object):
+    """An embedded sqlite database file"""
+
+    name = 'sqlite'
+    DatabaseError = sqlite3.DatabaseError
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+
+    def connect(self, check_same_thread=True):
+        con = sqlite3.connect(self.path, check_same_thread=check_same_thread)
+        con.create_function('regexp_replace', 3, _regexp_replace)
+        con.execute("PRAGMA journal_mode = WAL;")
+        return con
+
+    def dict_cursor(self, con):
+        cur = con.cursor()
+        cur.row_factory = _dict_factory
+        return cur
+
+    def sql(self, statement):
+        return PYFORMAT_PARAM.sub(r':\1', statement)
+
+    def pool(self, size):
+        return _SQLitePool(self, size)
+
+    def load_csv(self, con, file_table_tuples):
+        """
+        Usage: backend.load_csv(con, [(NODES_PATH, 'nodes'), ...])
+
+        Inserts (path, table) csv files with executemany in batches,
+        all in one transaction. Syncing is switched off for the load
+        and switched back on once it is committed.
+        """
+        con.commit()
+        con.execute("PRAGMA synchronous = OFF;")
+        try:
+            for path, table in file_table_tuples:
+                self._insert_csv(con, table, path)
+            con.commit()
+        except:
+            # the pragma cannot be changed inside the failed transaction
+            con.rollback()
+            raise
+        finally:
+            con.execute("PRAGMA synchronous = FULL;")
+
+    def _insert_csv(self, con, table, path):
+        with open(path) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            insert = "INSERT INTO %s VALUES (%s)" % (table, ', '.join('?' * len(header)))
+
+            batch = []
+            for row in reader:
+                # empty fields are NULL, as with COPY ... FORMAT CSV
+                batch.append([value.decode('utf-8') if value else None for value in row])
+                if len(batch) >= LOAD_BATCH_SIZE:
+                    con.executemany(insert, batch)
+                    batch = []
+            con.executemany(insert, batch)
+
+    def table_stamps(self, con):
+        """
+        sqlite keeps no per table counters, stamp with the file instead.
+
+        The -wal file is rewritten by every connection, so the changes
+        it holds are checkpointed into the database file first, which
+        is then only written when the data changes.
+        """
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        stamp = '%r:%d' % (os.path.getmtime(self.path), os.path.getsize(self.path))
+        # the views of the coded layout too, the report reads them
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');")
+        return {name: stamp for name, in cur.fetchall()}
+
+    def tables(self, con):
+        """Returns the names of the tables (not the views)"""
+        return self._tables(con.cursor())
+
+    def _tables(self, cur):
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+        return set(name for name, in cur.fetchall())
+
+    def seq_scans(self, cur, statement):
+        """Returns the tables the plan of a statement reads with a full scan"""
+        tables = self._tables(cur)
+        cur.execute("EXPLAIN QUERY PLAN " + self.sql(statement))
+        relations = []
+        for row in cur.fetchall():
+            detail = row[-1].split()
+            # 'SCAN node_tags' (or 'SCAN TABLE node_tags' in older
+            # versions) without 'USING ... INDEX' is a full table scan,
+            # scans of subqueries are left out
+            if detail[0] == 'SCAN' and 'USING' not in detail:
+                relation = detail[2] if detail[1] == 'TABLE' else detail[1]
+                if relation in tables:
+                    relations.append(relation)
+        return relations
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: compare_layouts.py
+---------------------------
+
+This script compares the typed layout of the nodes table (lat/lon as
+DOUBLE PRECISION, version as INTEGER, NULL for a missing user) with
+the previous layout (lat/lon as NUMERIC, version as TEXT and the
+"__BLANK__"/"00000000" placeholders for a missing user).
+
+nodes.csv is copied once into a temporary staging table, and each
+layout is filled from it with a single INSERT ... SELECT, so no layout
+holds dead rows from an UPDATE. Then the size of each table and the
+time of a scan that reads every column are printed. The scan compares
+the version with a literal of the layout's column type, so both
+layouts do the same work.
+"""
+
+import os
+import psycopg2
+import sys
+import time
+
+NODES_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'nodes.csv')
+
+CREATE_STAGING = """
+CREATE TEMPORARY TABLE nodes_csv (
+    id BIGINT,
+    lat DOUBLE PRECISION,
+    lon DOUBLE PRECISION,
+    username TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    moment TIMESTAMP
+);
+"""
+
+# (name, create, fill, version literal of the scan)
+LAYOUTS = [
+    ('text', """
+CREATE TEMPORARY TABLE nodes_text (
+    id BIGINT PRIMARY KEY,
+    lat NUMERIC,
+    lon NUMERIC,
+    username TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    moment TIMESTAMP
+);
+""", """
+INSERT INTO nodes_text
+SELECT id, lat, lon, COALESCE(username, '__BLANK__'), COALESCE(uid, 0),
+       version::TEXT, changeset, moment
+FROM nodes_csv;
+""", '1'),
+    ('typed', """
+CREATE TEMPORARY TABLE nodes_typed (
+    id BIGINT PRIMARY KEY,
+    lat DOUBLE PRECISION,
+    lon DOUBLE PRECISION,
+    username TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    moment TIMESTAMP
+);
+""", """
+INSERT INTO nodes_typed
+SELECT id, lat, lon, username, uid, version, changeset, moment
+FROM nodes_csv;
+""", 1)
+]
+
+SCAN = """
+SELECT MIN(lat), MAX(lon), MAX(version), COUNT(DISTINCT(username)), MAX(moment)
+FROM nodes_%s
+WHERE lat > 51.5 AND version > %%(version)s;
+"""
+
+SIZE = "SELECT pg_total_relation_size('nodes_%s');"
+
+
+def compare_layouts(cur, nodes_path=NODES_PATH, repeat=3):
+    cur.execute(CREATE_STAGING)
+    with open(nodes_path) as f:
+        cur.copy_expert("COPY nodes_csv FROM STDIN WITH (FORMAT CSV, HEADER, QUOTE '\"')", f)
+
+    for name, create, fill, version in LAYOUTS:
+        cur.execute(create)
+        cur.execute(fill)
+        cur.execute("ANALYZE nodes_%s;" % name)
+
+        cur.execute(SIZE % name)
+        size = cur.fetchone()[0]
+
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            cur.execute(SCAN % name, {'version': version})
+            cur.fetchall()
+            timings.append(time.time() - start)
+
+        print "%-6s %10.1f MB %10.3f s (best of %d scans)" % (
+            name, size / (1024.0 * 1024.0), min(timings), repeat)
+
+
+if __name__ == '__main__':
+    con = None
+
+    try:
+        # Connection to an exisiting database
+        con = psycopg2.connect("dbname=osm_playground user=abkds")
+        cur = con.cursor()
+
+        compare_layouts(cur)
+
+        # Nothing to keep, the tables are temporary
+        con.rollback()
+
+    except psycopg2.DatabaseError, e:
+
+        if con:
+            con.rollback()
+
+        print "Error %s" % e
+        sys.exit(1)
+
+    finally:
+
+        if con:
+            con.close()
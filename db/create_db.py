@@ -9,20 +9,30 @@ This script creates a connection to a postgresql database and
 creates the tables for the open street map data.
 
 It assumes that a database has been already created and connects
-to an existing database.
+to an existing database. With OSM_BACKEND=sqlite the tables are
+created in a sqlite database file instead (see backend.py).
+
+Run with --coded to create the dictionary encoded layout instead. It
+is a read only layout for reporting: the update scripts and
+create_indexes.py refuse to run on it.
+
+In postgresql every statement that writes to a table bumps its version
+in table_versions, from a trigger and so in the same transaction. The
+report cache (reports/generate_report.py) is stamped with them.
 """
 
-import psycopg2
 import sys
 
+import backend
+
 CREATE_NODE = """
 CREATE TABLE nodes (
     id BIGINT PRIMARY KEY,
-    lat NUMERIC,
-    lon NUMERIC,
+    lat DOUBLE PRECISION,
+    lon DOUBLE PRECISION,
     username TEXT,
     uid INTEGER,
-    version TEXT,
+    version INTEGER,
     changeset INTEGER,
     moment TIMESTAMP
 );
@@ -42,7 +52,7 @@ CREATE TABLE ways (
     id BIGINT PRIMARY KEY,
     username TEXT,
     uid INTEGER,
-    version TEXT,
+    version INTEGER,
     changeset INTEGER,
     moment TIMESTAMP
 );
@@ -66,34 +76,196 @@ CREATE TABLE way_nodes (
 );
 """
 
-con = None
+TABLES = [CREATE_NODE, CREATE_NODE_TAGS, CREATE_WAY, CREATE_WAY_NODES, CREATE_WAY_TAGS]
+
+# Dictionary encoded layout, for the csvs written by
+# process_map(..., dictionary_encode=True). Tag keys, tag types and
+# user names are stored once in the dimension tables, the views give
+# back the plain layout for reading.
+CODED_TABLES = [
+    """
+CREATE TABLE tag_keys (
+    code INTEGER PRIMARY KEY,
+    key TEXT
+);
+""",
+    """
+CREATE TABLE tag_types (
+    code INTEGER PRIMARY KEY,
+    type TEXT
+);
+""",
+    """
+CREATE TABLE users (
+    code INTEGER PRIMARY KEY,
+    username TEXT
+);
+""",
+    """
+CREATE TABLE nodes_coded (
+    id BIGINT PRIMARY KEY,
+    lat DOUBLE PRECISION,
+    lon DOUBLE PRECISION,
+    user_code INTEGER REFERENCES users (code),
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    moment TIMESTAMP
+);
+""",
+    """
+CREATE TABLE node_tags_coded (
+    node_id BIGINT REFERENCES nodes_coded (id),
+    key_code INTEGER REFERENCES tag_keys (code),
+    value TEXT,
+    type_code INTEGER REFERENCES tag_types (code)
+);
+""",
+    """
+CREATE TABLE ways_coded (
+    id BIGINT PRIMARY KEY,
+    user_code INTEGER REFERENCES users (code),
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    moment TIMESTAMP
+);
+""",
+    """
+CREATE TABLE way_nodes (
+    way_id BIGINT REFERENCES ways_coded (id),
+    node_id BIGINT REFERENCES nodes_coded (id),
+    position INTEGER,
+    PRIMARY KEY (way_id, node_id, position)
+);
+""",
+    """
+CREATE TABLE way_tags_coded (
+    way_id BIGINT REFERENCES ways_coded (id),
+    key_code INTEGER REFERENCES tag_keys (code),
+    value TEXT,
+    type_code INTEGER REFERENCES tag_types (code)
+);
+""",
+    """
+CREATE VIEW nodes AS
+SELECT n.id, n.lat, n.lon, u.username, n.uid, n.version, n.changeset, n.moment
+FROM nodes_coded n LEFT JOIN users u ON u.code = n.user_code;
+""",
+    """
+CREATE VIEW node_tags AS
+SELECT t.node_id, k.key, t.value, y.type
+FROM node_tags_coded t
+JOIN tag_keys k ON k.code = t.key_code
+JOIN tag_types y ON y.code = t.type_code;
+""",
+    """
+CREATE VIEW ways AS
+SELECT w.id, u.username, w.uid, w.version, w.changeset, w.moment
+FROM ways_coded w LEFT JOIN users u ON u.code = w.user_code;
+""",
+    """
+CREATE VIEW way_tags AS
+SELECT t.way_id, k.key, t.value, y.type
+FROM way_tags_coded t
+JOIN tag_keys k ON k.code = t.key_code
+JOIN tag_types y ON y.code = t.type_code;
+"""
+]
+
+
+# Versions of the tables, postgresql only. A trigger argument is the
+# table (of the plain layout) whose version the statement bumps.
+CREATE_TABLE_VERSIONS = [
+    """
+CREATE TABLE table_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+""",
+    """
+CREATE OR REPLACE FUNCTION bump_table_versions() RETURNS trigger AS $$
+DECLARE
+    name TEXT;
+BEGIN
+    FOREACH name IN ARRAY TG_ARGV LOOP
+        INSERT INTO table_versions VALUES (name, 1)
+        ON CONFLICT ON CONSTRAINT table_versions_pkey
+        DO UPDATE SET version = table_versions.version + 1;
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+]
+
+CREATE_VERSION_TRIGGER = """
+CREATE TRIGGER %s_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_table_versions(%s);
+"""
+
+VERSIONED_TABLES = {
+    'nodes': ['nodes'],
+    'node_tags': ['node_tags'],
+    'ways': ['ways'],
+    'way_nodes': ['way_nodes'],
+    'way_tags': ['way_tags']
+}
+
+# The views of the coded layout read the dimension tables as well
+CODED_VERSIONED_TABLES = {
+    'tag_keys': ['node_tags', 'way_tags'],
+    'tag_types': ['node_tags', 'way_tags'],
+    'users': ['nodes', 'ways'],
+    'nodes_coded': ['nodes'],
+    'node_tags_coded': ['node_tags'],
+    'ways_coded': ['ways'],
+    'way_nodes': ['way_nodes'],
+    'way_tags_coded': ['way_tags']
+}
 
-try:
-    # Connection to an exisiting database
-    con = psycopg2.connect("dbname=osm_playground user=abkds")
 
+def create_tables(con, coded=False, versioned=False):
     # Open a cursor to perform db operations
     cur = con.cursor()
 
     # Create the tables
-    cur.execute(CREATE_NODE);
-    cur.execute(CREATE_NODE_TAGS);
-    cur.execute(CREATE_WAY);
-    cur.execute(CREATE_WAY_NODES)
-    cur.execute(CREATE_WAY_TAGS);
+    for create_table in (CODED_TABLES if coded else TABLES):
+        cur.execute(create_table)
+
+    # Count the changes of the tables
+    if versioned:
+        for statement in CREATE_TABLE_VERSIONS:
+            cur.execute(statement)
+        tables = CODED_VERSIONED_TABLES if coded else VERSIONED_TABLES
+        for table, versions in sorted(tables.iteritems()):
+            cur.execute(CREATE_VERSION_TRIGGER % (
+                table, table, ', '.join("'%s'" % name for name in versions)))
 
     # Commit the changes
     con.commit()
 
-except psycopg2.DatabaseError, e:
 
-    if con:
-        con.rollback()
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Connection to an exisiting database
+        con = db.connect()
+
+        create_tables(con, coded='--coded' in sys.argv, versioned=db.name == 'postgres')
+
+    except db.DatabaseError, e:
+
+        if con:
+            con.rollback()
 
-    print "Error %s" % e
-    sys.exit(1)
+        print "Error %s" % e
+        sys.exit(1)
 
-finally:
+    finally:
 
-    if con:
-        con.close()
+        if con:
+            con.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: create_indexes.py
+---------------------------
+
+This script creates the indexes on the tag tables after the data has
+been inserted with insert_data.py (building them after the COPY is a
+lot faster than maintaining them during it), then checks the plans of
+the pipeline queries.
+
+The indexes match the way the tables are queried:
+
+- the update scripts filter on key and type (key = 'postcode' AND
+  type = 'addr'), and the report filters on key before grouping by
+  value, so the tag tables get a composite (key, type) index
+- update_phone_number.py searches with key LIKE '%phone%', which no
+  btree can serve, so the key also gets a trigram index (pg_trgm)
+- the report groups street names by their last word, which gets an
+  expression index restricted to the addr:street rows
+- the element id columns referenced by the tag and way_nodes tables
+
+The sqlite backend gets the btree indexes only. Indexes which exist
+already are left as they are, so the script can be run again, e.g.
+after the update scripts. The dictionary encoded layout is refused,
+its tag tables are views.
+
+Afterwards every pipeline query is run through EXPLAIN and the ones
+whose plan still contains a sequential scan are reported, e.g.
+counting all the rows of a table always does.
+"""
+
+import os
+import sys
+
+import backend
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'reports'))
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'update'))
+import generate_report
+import update_phone_number
+import update_post_codes
+import update_street_names
+
+# Indexes both backends can build
+CREATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS node_tags_node_id_idx ON node_tags (node_id);",
+    "CREATE INDEX IF NOT EXISTS way_tags_way_id_idx ON way_tags (way_id);",
+    "CREATE INDEX IF NOT EXISTS way_nodes_node_id_idx ON way_nodes (node_id);",
+    "CREATE INDEX IF NOT EXISTS node_tags_key_type_idx ON node_tags (key, type);",
+    "CREATE INDEX IF NOT EXISTS way_tags_key_type_idx ON way_tags (key, type);"
+]
+
+# Trigram and expression indexes, postgresql only
+CREATE_POSTGRES_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+    "CREATE INDEX IF NOT EXISTS node_tags_key_trgm_idx ON node_tags USING gin (key gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS way_tags_key_trgm_idx ON way_tags USING gin (key gin_trgm_ops);",
+    """CREATE INDEX IF NOT EXISTS node_tags_street_type_idx ON node_tags ((regexp_replace(value, '^.* ', '')))
+       WHERE key = 'street' AND type = 'addr';""",
+    """CREATE INDEX IF NOT EXISTS way_tags_street_type_idx ON way_tags ((regexp_replace(value, '^.* ', '')))
+       WHERE key = 'street' AND type = 'addr';"""
+]
+
+# Queries of the update scripts, checked along with the report queries
+UPDATE_QUERIES = [
+    ('update_phone_number', update_phone_number.SELECT_PHONE_NUMBERS),
+    ('update_post_codes', update_post_codes.SELECT_POST_CODES),
+    ('update_street_names', update_street_names.SELECT_STREETS)
+]
+
+
+def pipeline_queries():
+    queries = list(UPDATE_QUERIES)
+    queries.extend(('report:' + query.name, query.sql) for query in generate_report.QUERIES)
+    return queries
+
+
+def create_indexes(db, con):
+    cur = con.cursor()
+
+    statements = list(CREATE_INDEXES)
+    if db.name == 'postgres':
+        statements.extend(CREATE_POSTGRES_INDEXES)
+
+    # Create the indexes and refresh the planner statistics
+    for statement in statements:
+        cur.execute(statement)
+    cur.execute("ANALYZE;")
+
+    con.commit()
+
+
+def check_plans(db, con, queries):
+    """Print the pipeline queries whose plans still scan whole tables"""
+    cur = con.cursor()
+    for name, sql in queries:
+        relations = db.seq_scans(cur, sql)
+        if relations:
+            print "%-36s seq scan on %s" % (name, ', '.join(sorted(set(relations))))
+        else:
+            print "%-36s ok" % name
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Connection to an exisiting database
+        con = db.connect()
+        backend.check_plain_layout(db, con)
+
+        create_indexes(db, con)
+        check_plans(db, con, pipeline_queries())
+
+    except db.DatabaseError, e:
+
+        if con:
+            con.rollback()
+
+        print "Error %s" % e
+        sys.exit(1)
+
+    finally:
+
+        if con:
+            con.close()
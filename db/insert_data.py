@@ -7,12 +7,19 @@ File: insert_data.py
 
 This script creates a connection to a postgresql database and
 inserts the data from csv generated into the approriate tables.
+
+With OSM_BACKEND=sqlite the csv files are loaded into a sqlite
+database file instead, see backend.py. Create the indexes afterwards
+with create_indexes.py.
+
+Run with --coded to insert the dictionary encoded csvs from data/coded.
 """
 
 import os
-import psycopg2
 import sys
 
+import backend
+
 NODES_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'nodes.csv')
 NODE_TAGS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'node_tags.csv')
 WAYS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'ways.csv')
@@ -27,30 +34,49 @@ file_table_tuples = [
     (WAY_TAGS_PATH, 'way_tags')
 ]
 
-try:
-    # Connection to an exisiting database
-    con = psycopg2.connect("dbname=osm_playground user=abkds")
 
-    # Open a cursor to perform db operations
-    cur = con.cursor()
+CODED_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'coded')
+
+# Dimension tables first, the coded tables reference them
+coded_file_table_tuples = [
+    (os.path.join(CODED_DIR, 'keys.csv'), 'tag_keys'),
+    (os.path.join(CODED_DIR, 'types.csv'), 'tag_types'),
+    (os.path.join(CODED_DIR, 'users.csv'), 'users'),
+    (os.path.join(CODED_DIR, 'nodes.csv'), 'nodes_coded'),
+    (os.path.join(CODED_DIR, 'node_tags.csv'), 'node_tags_coded'),
+    (os.path.join(CODED_DIR, 'ways.csv'), 'ways_coded'),
+    (os.path.join(CODED_DIR, 'way_nodes.csv'), 'way_nodes'),
+    (os.path.join(CODED_DIR, 'way_tags.csv'), 'way_tags_coded')
+]
 
+
+def insert_data(db, con, file_table_tuples=file_table_tuples):
     # Copy csv data to respective tables
-    for file_table in file_table_tuples:
-        with open(file_table[0]) as f:
-            sql_copy = "COPY %s FROM STDIN WITH (FORMAT CSV, HEADER, QUOTE '\"')" % (file_table[1])
-            cur.copy_expert(sql_copy, f)
+    db.load_csv(con, file_table_tuples)
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Connection to an exisiting database
+        con = db.connect()
 
-    con.commit()
+        if '--coded' in sys.argv:
+            insert_data(db, con, coded_file_table_tuples)
+        else:
+            insert_data(db, con)
 
-except psycopg2.DatabaseError, e:
+    except db.DatabaseError, e:
 
-    if con:
-        con.rollback()
+        if con:
+            con.rollback()
 
-    print "Error %s" % e
-    sys.exit(1)
+        print "Error %s" % e
+        sys.exit(1)
 
-finally:
+    finally:
 
-    if con:
-        con.close()
+        if con:
+            con.close()
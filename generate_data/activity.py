@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: activity.py
+---------------------------
+
+Builds an index of editing activity while the osm file is converted,
+so questions like "edits by user X between two dates" or "what did
+changeset N touch" are answered from sorted arrays instead of by
+scanning the nodes and ways tables.
+
+Every node and way contributes one edit (kind, id, uid, timestamp,
+changeset). The index is stored as numpy arrays in ACTIVITY_DIR:
+
+- user_*.npy       edits sorted by (uid, timestamp, kind, id)
+- changeset_*.npy  edits sorted by (changeset, kind, id)
+- month_*.npy      number of edits per (uid, month)
+- users.json       user name -> uid
+
+The builder keeps at most RUN_SIZE edits in memory, 33 bytes each.
+Every RUN_SIZE edits it sorts them in both orders and spills the
+sorted run to a temporary directory; save merges the runs MERGE_CHUNK
+edits of each at a time. Besides the user names, that bounds the
+memory to about 100 bytes per edit of a run while it is sorted, and
+about 80 bytes per edit of a merge chunk of every run while they are
+merged, however large the file.
+
+The arrays are memory-mapped when the index is loaded, and every query
+is a binary search (numpy.searchsorted) over them.
+"""
+
+import calendar
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+ACTIVITY_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'activity')
+
+KINDS = ('node', 'way')
+
+# uid of anonymous edits
+NO_UID = -1
+# changeset of elements without one (extracts stripped of metadata)
+NO_CHANGESET = -1
+
+# Edits held in memory before they are sorted and spilled to disk
+RUN_SIZE = 2000000
+# Edits read from each run at a time while merging
+MERGE_CHUNK = 100000
+
+# Columns of the index and the order of their runs, sort keys first
+COLUMN_TYPES = {'uid': np.int64, 'timestamp': np.int64, 'kind': np.int8,
+                'id': np.int64, 'changeset': np.int64}
+ORDERS = [('user', ['uid', 'timestamp', 'kind', 'id']),
+          ('changeset', ['changeset', 'kind', 'id'])]
+
+
+def to_epoch(moment):
+    """Seconds since the epoch of a (naive utc) datetime"""
+    return calendar.timegm(moment.utctimetuple())
+
+
+def _months(timestamps):
+    """Months since January 1970 of epoch timestamps"""
+    return timestamps.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+
+
+def _month_name(month):
+    return '%04d-%02d' % (1970 + month // 12, month % 12 + 1)
+
+
+def _sort(columns, names):
+    """The columns sorted by the columns named, in that order"""
+    # lexsort sorts by the last key first
+    order = np.lexsort([columns[name] for name in reversed(names)])
+    return dict((name, columns[name][order]) for name in names)
+
+
+def _not_above(columns, names, bound):
+    """The number of rows of sorted columns whose key is <= bound"""
+    below = np.zeros(len(columns[names[0]]), dtype=bool)
+    equal = np.ones(len(below), dtype=bool)
+    for name, value in zip(names, bound):
+        below |= equal & (columns[name] < value)
+        equal &= columns[name] == value
+    return int(np.count_nonzero(below | equal))
+
+
+def merge_runs(runs, names, chunk_size=MERGE_CHUNK):
+    """
+    Yield the rows of runs (dicts of columns sorted by the columns
+    named) in one sorted order, as dicts of columns of at most
+    chunk_size rows per run.
+    """
+    positions = [0] * len(runs)
+    while True:
+        chunks = []
+        for i, run in enumerate(runs):
+            if positions[i] < len(run[names[0]]):
+                chunks.append((i, dict((name, run[name][positions[i]:positions[i] + chunk_size])
+                                       for name in names)))
+        if not chunks:
+            return
+
+        # every row up to the smallest of the last keys of the chunks
+        # is in the chunks, and all of the chunk of that key is taken
+        bound = min(tuple(chunk[name][-1] for name in names) for _, chunk in chunks)
+        pieces = []
+        for i, chunk in chunks:
+            taken = _not_above(chunk, names, bound)
+            positions[i] += taken
+            pieces.append(dict((name, chunk[name][:taken]) for name in names))
+        yield _sort(dict((name, np.concatenate([piece[name] for piece in pieces])) for name in names),
+                    names)
+
+
+class _NpyReader(object):
+    """
+    A one dimensional .npy file read a slice at a time. Unlike a
+    memory-mapped array, the slices read do not stay in memory.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        np.lib.format.read_magic(self.f)
+        shape, _, self.dtype = np.lib.format.read_array_header_1_0(self.f)
+        self.length = shape[0]
+        self.offset = self.f.tell()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, items):
+        start, stop, _ = items.indices(self.length)
+        self.f.seek(self.offset + start * self.dtype.itemsize)
+        return np.fromfile(self.f, dtype=self.dtype, count=max(stop - start, 0))
+
+    def close(self):
+        self.f.close()
+
+
+class _NpyWriter(object):
+    """Write a one dimensional .npy file a chunk at a time"""
+
+    def __init__(self, path, dtype, length):
+        self.f = open(path, 'wb')
+        self.dtype = np.dtype(dtype)
+        np.lib.format.write_array_header_1_0(self.f, {
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (length,)})
+
+    def write(self, values):
+        np.asarray(values, dtype=self.dtype).tofile(self.f)
+
+    def close(self):
+        self.f.close()
+
+
+class ActivityBuilder(object):
+    """
+    Collects the edits of shaped elements, see data.process_map
+
+    The edits are spilled to disk in sorted runs of run_size, which
+    save merges merge_chunk edits of each at a time, see the memory
+    bound above.
+    """
+
+    def __init__(self, run_size=RUN_SIZE, merge_chunk=MERGE_CHUNK):
+        self.run_size = run_size
+        self.merge_chunk = merge_chunk
+        self.runs = []
+        self.run_dir = None
+        self.users = {}
+        self._new_run()
+
+    def _new_run(self):
+        self.kinds = array('b')
+        self.ids = array('l')
+        self.uids = array('l')
+        self.timestamps = array('l')
+        self.changesets = array('l')
+
+    def add(self, el):
+        for kind_code, kind in enumerate(KINDS):
+            if kind in el:
+                attribs = el[kind]
+                break
+        else:
+            return
+        # elements stripped of their metadata have no time to index
+        if attribs['timestamp'] is None:
+            return
+
+        uid = attribs['uid']
+        if uid is None:
+            uid = NO_UID
+        elif attribs['user'] is not None:
+            self.users[attribs['user']] = uid
+
+        self.kinds.append(kind_code)
+        self.ids.append(attribs['id'])
+        self.uids.append(uid)
+        self.timestamps.append(to_epoch(attribs['timestamp']))
+        changeset = attribs['changeset']
+        self.changesets.append(NO_CHANGESET if changeset is None else changeset)
+        if len(self.ids) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        """Sort the edits in memory in both orders and write them to a run"""
+        if not self.ids:
+            return
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(prefix='activity')
+
+        columns = {'kind': self.kinds, 'id': self.ids, 'uid': self.uids,
+                   'timestamp': self.timestamps, 'changeset': self.changesets}
+        columns = dict((name, np.array(values, dtype=COLUMN_TYPES[name]))
+                       for name, values in columns.iteritems())
+        self._new_run()
+
+        run = len(self.runs)
+        for order, names in ORDERS:
+            for name, values in _sort(columns, names).iteritems():
+                np.save(os.path.join(self.run_dir, '%d_%s_%s.npy' % (run, order, name)), values)
+        self.runs.append(len(columns['id']))
+
+    def _load_run(self, run, order, names):
+        return dict((name, _NpyReader(os.path.join(self.run_dir, '%d_%s_%s.npy' % (run, order, name))))
+                    for name in names)
+
+    def save(self, directory=ACTIVITY_DIR):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._spill()
+        edits = sum(self.runs)
+        try:
+            self._save_user_order(directory, edits)
+            self._save_changeset_order(directory, edits)
+        finally:
+            if self.run_dir is not None:
+                shutil.rmtree(self.run_dir)
+            self.runs, self.run_dir = [], None
+
+        with open(os.path.join(directory, 'users.json'), 'w') as output_file:
+            json.dump(self.users, output_file)
+
+    def _merged(self, order, names):
+        runs = [self._load_run(run, order, names) for run in range(len(self.runs))]
+        try:
+            for chunk in merge_runs(runs, names, self.merge_chunk):
+                yield chunk
+        finally:
+            for run in runs:
+                for reader in run.itervalues():
+                    reader.close()
+
+    def _writers(self, directory, files, edits):
+        """_NpyWriter per column, files maps the file name to the column"""
+        return dict((column, _NpyWriter(os.path.join(directory, name + '.npy'),
+                                        COLUMN_TYPES[column], edits))
+                    for name, column in files.iteritems())
+
+    def _save_user_order(self, directory, edits):
+        writers = self._writers(directory, {'user_uid': 'uid', 'user_timestamp': 'timestamp',
+                                            'user_kind': 'kind', 'user_id': 'id'}, edits)
+        month_uids, months, month_counts = [], [], []
+        try:
+            for chunk in self._merged('user', ORDERS[0][1]):
+                for column, writer in writers.iteritems():
+                    writer.write(chunk[column])
+
+                # (uid, month) runs are contiguous in user order, the
+                # first of a chunk may carry on the last of the one before
+                uids, chunk_months = chunk['uid'], _months(chunk['timestamp'])
+                changes = (uids[1:] != uids[:-1]) | (chunk_months[1:] != chunk_months[:-1])
+                starts = np.flatnonzero(np.r_[True, changes])
+                counts = np.diff(np.r_[starts, len(uids)])
+                first = 0
+                if month_uids and (month_uids[-1], months[-1]) == (uids[0], chunk_months[0]):
+                    month_counts[-1] += int(counts[0])
+                    first = 1
+                month_uids.extend(uids[starts[first:]].tolist())
+                months.extend(chunk_months[starts[first:]].tolist())
+                month_counts.extend(counts[first:].tolist())
+        finally:
+            for writer in writers.itervalues():
+                writer.close()
+
+        np.save(os.path.join(directory, 'month_uid.npy'), np.array(month_uids, dtype=np.int64))
+        np.save(os.path.join(directory, 'month.npy'), np.array(months, dtype=np.int64))
+        np.save(os.path.join(directory, 'month_count.npy'), np.array(month_counts, dtype=np.int64))
+
+    def _save_changeset_order(self, directory, edits):
+        writers = self._writers(directory, {'changeset': 'changeset', 'changeset_kind': 'kind',
+                                            'changeset_id': 'id'}, edits)
+        try:
+            for chunk in self._merged('changeset', ORDERS[1][1]):
+                for column, writer in writers.iteritems():
+                    writer.write(chunk[column])
+        finally:
+            for writer in writers.itervalues():
+                writer.close()
+
+
+class ActivityIndex(object):
+    """Memory-mapped activity index written by ActivityBuilder.save"""
+
+    def __init__(self, directory=ACTIVITY_DIR):
+        def load_array(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+        self.user_uid = load_array('user_uid')
+        self.user_timestamp = load_array('user_timestamp')
+        self.user_kind = load_array('user_kind')
+        self.user_id = load_array('user_id')
+        self.changeset = load_array('changeset')
+        self.changeset_kind = load_array('changeset_kind')
+        self.changeset_id = load_array('changeset_id')
+        self.month_uid = load_array('month_uid')
+        self.month = load_array('month')
+        self.month_count = load_array('month_count')
+
+        with open(os.path.join(directory, 'users.json')) as input_file:
+            self.users = json.load(input_file)
+
+    def uid(self, user):
+        """Returns the uid of a user name or uid"""
+        if isinstance(user, basestring):
+            return self.users[user]
+        return user
+
+    def _user_range(self, user, start, end):
+        """Returns the slice of user order holding the edits in [start, end)"""
+        uid = self.uid(user)
+        lo = np.searchsorted(self.user_uid, uid, side='left')
+        hi = np.searchsorted(self.user_uid, uid, side='right')
+        timestamps = self.user_timestamp[lo:hi]
+        first = 0 if start is None else np.searchsorted(timestamps, to_epoch(start), side='left')
+        last = len(timestamps) if end is None else np.searchsorted(timestamps, to_epoch(end), side='left')
+        return lo + first, lo + max(first, last)
+
+    def edits(self, user, start=None, end=None):
+        """
+        Usage: index.edits('Eriks Zelenka', datetime(2012, 1, 1), datetime(2013, 1, 1))
+
+        Returns (kind, id, timestamp) of the edits of a user (name or
+        uid) with start <= timestamp < end, in time order.
+        """
+        lo, hi = self._user_range(user, start, end)
+        return [
+            (KINDS[kind], int(element_id), datetime.datetime.utcfromtimestamp(timestamp))
+            for kind, element_id, timestamp in zip(
+                self.user_kind[lo:hi], self.user_id[lo:hi], self.user_timestamp[lo:hi])
+        ]
+
+    def count_edits(self, user, start=None, end=None):
+        """Returns the number of edits of a user between start and end"""
+        lo, hi = self._user_range(user, start, end)
+        return int(hi - lo)
+
+    def monthly(self, user):
+        """Returns [('2012-05', edits), ...] for a user"""
+        uid = self.uid(user)
+        lo = np.searchsorted(self.month_uid, uid, side='left')
+        hi = np.searchsorted(self.month_uid, uid, side='right')
+        return [(_month_name(int(month)), int(count))
+                for month, count in zip(self.month[lo:hi], self.month_count[lo:hi])]
+
+    def changeset_elements(self, changeset):
+        """Returns (kind, id) of the elements a changeset touched"""
+        lo = np.searchsorted(self.changeset, changeset, side='left')
+        hi = np.searchsorted(self.changeset, changeset, side='right')
+        return [(KINDS[kind], int(element_id))
+                for kind, element_id in zip(self.changeset_kind[lo:hi], self.changeset_id[lo:hi])]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: benchmark.py
+---------------------------
+
+This script times
+
+- the conversion of an .osm or .osm.pbf file to csvs (process_map of
+  data.py) sequentially and as a pipeline with 1, 2, ... up to one
+  shaping process per cpu. The pipeline only pays off where its
+  processes get cpus of their own, so run it on the machine which
+  does the conversion.
+- writing the rows of the file with data.CsvBatchWriter and with the
+  UnicodeDictWriter it replaced, a row at a time. The rows are shaped
+  once, up front, and written to temporary files, which are checked
+  to be the same.
+
+and prints the best of a few runs of each. The csvs of the
+conversion are written to data/, as by data.py.
+
+Usage: python benchmark.py [osm file] [--validate]
+"""
+
+import csv
+import filecmp
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import data
+import pipeline
+
+TABLES = [('node', data.NODE_FIELDS), ('node_tags', data.NODE_TAGS_FIELDS), ('way', data.WAY_FIELDS),
+          ('way_nodes', data.WAY_NODES_FIELDS), ('way_tags', data.WAY_TAGS_FIELDS)]
+
+
+class UnicodeDictWriter(csv.DictWriter, object):
+    """Extend csv.DictWriter to handle Unicode input (the writer data.py used before)"""
+
+    def writerow(self, row):
+        super(UnicodeDictWriter, self).writerow({
+            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
+        })
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def best_of(repeat, function, *args, **kwargs):
+    """The shortest of repeat runs of function, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        function(*args, **kwargs)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def time_conversion(osm_file, validate, repeat=3):
+    """Returns (name, seconds) of the sequential and pipelined conversions"""
+    timings = [('sequential', best_of(repeat, data.process_map, osm_file, validate))]
+    for processes in range(1, max(multiprocessing.cpu_count(), 2) + 1):
+        seconds = best_of(repeat, data.process_map, osm_file, validate,
+                          pipelined=True, processes=processes)
+        timings.append(('pipelined, %d processes' % processes, seconds))
+    return timings
+
+
+def shaped_batches(osm_file):
+    """The rows of each table, per batch of shaped elements"""
+    return [data.batch_rows(batch, (), lambda field, rows: rows)
+            for batch in pipeline.batches(el for el in data.iter_shaped(osm_file) if el)]
+
+
+def write_csvs(writer_class, batches, directory):
+    files = [open(os.path.join(directory, table + '.csv'), 'wb') for table, _ in TABLES]
+    try:
+        writers = [writer_class(f, fields) for f, (_, fields) in zip(files, TABLES)]
+        for writer in writers:
+            writer.writeheader()
+        for rows in batches:
+            for writer, (table, _) in zip(writers, TABLES):
+                writer.writerows(rows[table])
+        for writer in writers:
+            if hasattr(writer, 'flush'):
+                writer.flush()
+    finally:
+        for f in files:
+            f.close()
+
+
+def time_writers(osm_file, repeat=3):
+    """Returns (name, seconds) of writing the rows of osm_file with each writer"""
+    batches = shaped_batches(osm_file)
+    directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+        timings = []
+        for (name, writer_class), directory in zip([('UnicodeDictWriter', UnicodeDictWriter),
+                                                    ('CsvBatchWriter', data.CsvBatchWriter)],
+                                                   directories):
+            timings.append((name, best_of(repeat, write_csvs, writer_class, batches, directory)))
+
+        names = [table + '.csv' for table, _ in TABLES]
+        _, mismatch, errors = filecmp.cmpfiles(directories[0], directories[1], names, shallow=False)
+        if mismatch or errors:
+            raise ValueError("The writers wrote different csvs: %s" % ', '.join(mismatch + errors))
+        return timings
+    finally:
+        for directory in directories:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    osm_file = args[0] if args else data.OSM_PATH
+    validate = '--validate' in sys.argv
+
+    timings = time_conversion(osm_file, validate)
+    print
+    print "%d cpus, %s%s" % (multiprocessing.cpu_count(), osm_file, ' (validated)' if validate else '')
+    sequential = timings[0][1]
+    for name, seconds in timings:
+        print "%-28s %8.2f s %6.2fx" % (name, seconds, sequential / seconds)
+
+    timings = time_writers(osm_file)
+    print
+    print "writing the csvs"
+    dict_writer = timings[0][1]
+    for name, seconds in timings:
+        print "%-28s %8.2f s %6.2fx" % (name, seconds, dict_writer / seconds)
@@ -3,6 +3,8 @@
 
 import xml.etree.cElementTree as ET
 
+import pbf
+
 OSM_FILE = "london_england.osm"
 SAMPLE_FILE = "sample.osm"
 
@@ -14,6 +16,11 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
+    if pbf.is_pbf(osm_file):
+        for elem in pbf.iter_elements(osm_file, tags=tags):
+            yield elem
+        return
+
     context = iter(ET.iterparse(osm_file, events=('start', 'end')))
     _, root = next(context)
     for event, elem in context:
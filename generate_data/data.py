@@ -156,12 +156,23 @@ The final return value for a "way" element should look something like:
 import os
 import csv
 import codecs
+import cStringIO
+import datetime
+import operator
 import re
+import sys
 import xml.etree.cElementTree as ET
 
 import cerberus
 
+import activity
+import dictionary
+import integrity
+import pbf
+import pipeline
 import schema
+import summary
+import tag_index
 
 OSM_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'osm', 'london_england.osm')
 
@@ -171,6 +182,9 @@ WAYS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'ways.csv
 WAY_NODES_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'way_nodes.csv')
 WAY_TAGS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'way_tags.csv')
 
+# Dictionary encoded csvs and their dimension tables, see process_map
+CODED_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'coded')
+
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
@@ -183,66 +197,109 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# Attributes an element may lack, see shape_record
+NULLABLE_FIELDS = frozenset(['user', 'uid', 'version', 'changeset', 'timestamp'])
+
+# Columns which may hold unicode, the only ones CsvBatchWriter encodes
+TEXT_FIELDS = frozenset(['user', 'key', 'value', 'type'])
+
+# Bytes CsvBatchWriter buffers before writing to the file
+FLUSH_SIZE = 4 * 1024 * 1024
+
+
+def parse_timestamp(timestamp):
+    """Parse an osm timestamp (2010-07-22T16:16:51Z), faster than strptime"""
+    return datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                             int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]))
+
+
+# Attributes are converted to their column types once, while shaping
+FIELD_TYPES = {
+    'id': int,
+    'lat': float,
+    'lon': float,
+    'uid': int,
+    'version': int,
+    'changeset': int,
+    'timestamp': parse_timestamp
+}
+
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     """Clean and shape node or way XML element to Python dict"""
 
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
+    return shape_record(*element_record(element),
+                        node_attr_fields=node_attr_fields, way_attr_fields=way_attr_fields,
+                        problem_chars=problem_chars, default_tag_type=default_tag_type)
+
 
+def element_record(element):
+    """(element_type, attrib, tags, refs) of an XML element, as the PBF reader yields"""
+
+    tags = [(tag.attrib['k'], tag.attrib['v']) for tag in element.findall('tag')]
+    refs = [nd.attrib['ref'] for nd in element.findall('nd')]
+    return element.tag, dict(element.attrib), tags, refs
+
+
+def shape_record(element_type, attrib, tags, refs=(), node_attr_fields=NODE_FIELDS,
+                 way_attr_fields=WAY_FIELDS, problem_chars=PROBLEMCHARS,
+                 default_tag_type='regular'):
+    """Clean and shape a decoded element to Python dict
+
+    Shared by the XML and PBF readers: attrib is the attribute dict of
+    the element, tags a list of (k, v) pairs and refs the node ids of a
+    way in order.
+    """
 
     # london_england osm has many node points with no username and
-    # user id. The missing user id is replaced by uid 0000000 and
-    # and user name __BLANK__
-    def process_element_attributes(attr_fields, element):
+    # user id, and extracts stripped of metadata have no version,
+    # changeset or timestamp either. The missing attributes are set
+    # to None and written as NULL.
+    def process_element_attributes(attr_fields, attrib):
         node_attribs = {}
         for k in attr_fields:
-            if k in element.attrib:
-                node_attribs[k] = element.attrib[k]
+            if k in attrib:
+                convert = FIELD_TYPES.get(k)
+                node_attribs[k] = convert(attrib[k]) if convert else attrib[k]
             else:
-                if k == 'uid':
-                    node_attribs[k] = "00000000"
-                if k == 'user':
-                    node_attribs[k] = "__BLANK__"
+                if k in NULLABLE_FIELDS:
+                    node_attribs[k] = None
 
-        # node_attribs = {k: element.attrib[k] for k in attr_fields}
+        # node_attribs = {k: attrib[k] for k in attr_fields}
         return node_attribs
 
-    def process_element_tags(id, element):
-        tags = []
-        for tag_element in element.findall('tag'):
-            tag_dict = {'id': id, 'type': 'regular', 'key': '', 'value': ''}
-            k = tag_element.attrib['k']
-            if PROBLEMCHARS.match(k):
+    def process_element_tags(id, tags):
+        shaped_tags = []
+        for k, v in tags:
+            tag_dict = {'id': id, 'type': default_tag_type, 'key': '', 'value': ''}
+            if problem_chars.match(k):
                 pass
             elif LOWER_COLON.match(k):
                 tag_dict['type'], tag_dict['key'] = k.split(':', 1)
-                tag_dict['value'] = tag_element.attrib['v']
-                tags.append(tag_dict)
+                tag_dict['value'] = v
+                shaped_tags.append(tag_dict)
             else:
                 tag_dict['key'] = k
-                tag_dict['value'] = tag_element.attrib['v']
-                tags.append(tag_dict)
-        return tags
+                tag_dict['value'] = v
+                shaped_tags.append(tag_dict)
+        return shaped_tags
 
-    def process_way_nodes(id, way_element):
+    def process_way_nodes(id, refs):
         way_nodes = [
-            {'id': id, 'node_id': way_node.attrib['ref'], 'position': position}
-                for position, way_node in enumerate(way_element.findall('nd'))
+            {'id': id, 'node_id': int(ref), 'position': position}
+                for position, ref in enumerate(refs)
         ]
         return way_nodes
 
-    if element.tag == 'node':
-        node_attribs = process_element_attributes(NODE_FIELDS, element)
-        tags = process_element_tags(node_attribs['id'], element)
+    if element_type == 'node':
+        node_attribs = process_element_attributes(node_attr_fields, attrib)
+        tags = process_element_tags(node_attribs['id'], tags)
         return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag == 'way':
-        way_attribs = process_element_attributes(WAY_FIELDS, element)
-        tags = process_element_tags(way_attribs['id'], element)
-        way_nodes = process_way_nodes(way_attribs['id'], element)
+    elif element_type == 'way':
+        way_attribs = process_element_attributes(way_attr_fields, attrib)
+        tags = process_element_tags(way_attribs['id'], tags)
+        way_nodes = process_way_nodes(way_attribs['id'], refs)
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
 
@@ -252,6 +309,11 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag"""
 
+    if pbf.is_pbf(osm_file):
+        for elem in pbf.iter_elements(osm_file, tags=tags):
+            yield elem
+        return
+
     context = ET.iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
     for event, elem in context:
@@ -260,6 +322,47 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             root.clear()
 
 
+def iter_records(osm_file, processes=None, pool=None):
+    """Yield node and way records from an .osm or .osm.pbf file
+
+    The blocks of an .osm.pbf file are decoded by pool, or by a pool
+    of their own, see pbf.iter_records.
+    """
+
+    if pbf.is_pbf(osm_file):
+        for record in pbf.iter_records(osm_file, types=('node', 'way'), processes=processes, pool=pool):
+            yield record
+    else:
+        for element in get_element(osm_file, tags=('node', 'way')):
+            yield element_record(element)
+
+
+def iter_shaped(osm_file):
+    """Yield shaped node and way dicts from an .osm or .osm.pbf file"""
+
+    if pbf.is_pbf(osm_file):
+        # Shape the decoded records directly, no need to build elements
+        for record in pbf.iter_records(osm_file, types=('node', 'way')):
+            yield shape_record(*record)
+    else:
+        for element in get_element(osm_file, tags=('node', 'way')):
+            yield shape_element(element)
+
+
+def shape_batch(records, validate):
+    """Shape (and validate) a batch of records, run by the pipeline workers"""
+
+    validator = cerberus.Validator()
+    shaped = []
+    for record in records:
+        el = shape_record(*record)
+        if el:
+            if validate is True:
+                validate_element(el, validator)
+            shaped.append(el)
+    return shaped
+
+
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
@@ -274,36 +377,128 @@ def validate_element(element, validator, schema=SCHEMA):
         )
 
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+def _encode_utf8(value):
+    return value.encode('utf-8') if value.__class__ is unicode else value
+
+
+class CsvBatchWriter(object):
+    """Write batches of row dicts to a csv file through a large buffer
+
+    Writes the same bytes as csv.DictWriter, with the unicode values
+    encoded to utf-8, but a batch at a time: the rows of a batch are
+    turned into tuples with one itemgetter call each, only the text
+    columns are encoded, and the whole batch goes through a single
+    csv writerows call into an in-memory buffer. The buffer is written
+    to the file once it holds flush_size bytes, and by flush.
+
+    The buffer is a cStringIO rather than a preallocated block: the
+    csv module writes to a file-like object. Truncating a cStringIO
+    keeps its memory, so once the first flush_size bytes have been
+    written the buffer is reused without growing again.
+    """
+
+    def __init__(self, f, fieldnames, text_fields=TEXT_FIELDS, flush_size=FLUSH_SIZE):
+        self.f = f
+        self.fieldnames = fieldnames
+        self.flush_size = flush_size
+        self.buffer = cStringIO.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.get_row = operator.itemgetter(*fieldnames)
+        self.text_columns = [i for i, field in enumerate(fieldnames) if field in text_fields]
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
 
     def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
+        self.writerows([row])
+
+    def _tuples(self, rows):
+        try:
+            return map(self.get_row, rows)
+        except KeyError:
+            # missing fields are written empty, as by csv.DictWriter
+            return [tuple(row.get(field, '') for field in self.fieldnames) for row in rows]
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        if not rows:
+            return
+        rows = self._tuples(rows)
+        if self.text_columns:
+            columns = zip(*rows)
+            for i in self.text_columns:
+                columns[i] = map(_encode_utf8, columns[i])
+            rows = zip(*columns)
+        self.writer.writerows(rows)
+        if self.buffer.tell() >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the file"""
+        self.f.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+def process_map(file_in, validate, collectors=(), dictionary_encode=False,
+                pipelined=False, processes=None, integrity=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    Each of the collectors (e.g. a summary.TagSummary) is handed every
+    shaped element through its add method, so statistics and indexes
+    are built in the same pass.
+
+    With dictionary_encode the csvs are written to CODED_DIR, with tag
+    keys, tag types and user names replaced by integer codes, and the
+    codes are written to keys.csv, types.csv and users.csv.
+
+    With pipelined the elements are parsed, shaped and validated, and
+    written concurrently (see pipeline.py): shaping and validation run
+    in processes (one per cpu unless processes is given) and each csv
+    gets its own writer thread. The csvs are the same either way. The
+    threads share one interpreter lock, so this only pays off with
+    several cpus free for the shaping processes; on one or two cpus
+    the sequential path is faster.
+
+    With an integrity.RefCheck the way_nodes rows referring to nodes
+    missing from the file are reported, dropped or quarantined to a
+    csv of their own, before they can break the load of the database.
+    """
+
+    paths = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
+    if dictionary_encode:
+        if not os.path.exists(CODED_DIR):
+            os.makedirs(CODED_DIR)
+        paths = [os.path.join(CODED_DIR, os.path.basename(path)) for path in paths]
+
+    keys = dictionary.Dictionary()
+    types = dictionary.Dictionary()
+    users = dictionary.Dictionary()
+    encodings = {
+        'node': {'user': users},
+        'node_tags': {'key': keys, 'type': types},
+        'way': {'user': users},
+        'way_tags': {'key': keys, 'type': types},
+    }
+
+    def encode(field, rows):
+        if dictionary_encode and field in encodings:
+            return [dictionary.encode_row(row, encodings[field]) for row in rows]
+        return rows
+
+    with codecs.open(paths[0], 'w') as nodes_file, \
+         codecs.open(paths[1], 'w') as nodes_tags_file, \
+         codecs.open(paths[2], 'w') as ways_file, \
+         codecs.open(paths[3], 'w') as way_nodes_file, \
+         codecs.open(paths[4], 'w') as way_tags_file:
+
+        nodes_writer = CsvBatchWriter(nodes_file, NODE_FIELDS)
+        node_tags_writer = CsvBatchWriter(nodes_tags_file, NODE_TAGS_FIELDS)
+        ways_writer = CsvBatchWriter(ways_file, WAY_FIELDS)
+        way_nodes_writer = CsvBatchWriter(way_nodes_file, WAY_NODES_FIELDS)
+        way_tags_writer = CsvBatchWriter(way_tags_file, WAY_TAGS_FIELDS)
 
         nodes_writer.writeheader()
         node_tags_writer.writeheader()
@@ -311,24 +506,125 @@ def process_map(file_in, validate):
         way_nodes_writer.writeheader()
         way_tags_writer.writeheader()
 
-        validator = cerberus.Validator()
+        writers = [('node', nodes_writer), ('node_tags', node_tags_writer), ('way', ways_writer),
+                   ('way_nodes', way_nodes_writer), ('way_tags', way_tags_writer)]
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
+        quarantine_file = None
+        if integrity is not None and integrity.policy == 'quarantine':
+            quarantine_file = codecs.open(integrity.quarantine_path, 'w')
+            quarantine_writer = CsvBatchWriter(quarantine_file, WAY_NODES_FIELDS)
+            quarantine_writer.writeheader()
+            writers.append(('dangling', quarantine_writer))
 
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+        try:
+            if pipelined:
+                process_pipelined(file_in, validate, collectors, encode, writers, processes, integrity)
+            else:
+                validator = cerberus.Validator()
+
+                # Rows are written a batch of elements at a time
+                for batch in pipeline.batches(el for el in iter_shaped(file_in) if el):
+                    if validate is True:
+                        for el in batch:
+                            validate_element(el, validator)
+
+                    rows = batch_rows(batch, collectors, encode, integrity)
+                    for field, writer in writers:
+                        writer.writerows(rows[field])
+
+            for _, writer in writers:
+                writer.flush()
+        finally:
+            if quarantine_file is not None:
+                quarantine_file.close()
+
+    if dictionary_encode:
+        keys.save(os.path.join(CODED_DIR, 'keys.csv'), 'key')
+        types.save(os.path.join(CODED_DIR, 'types.csv'), 'type')
+        users.save(os.path.join(CODED_DIR, 'users.csv'), 'user')
+
+
+def batch_rows(batch, collectors, encode, integrity=None):
+    """Hand a batch of shaped elements to the collectors, returns their rows per field
+
+    With an integrity.RefCheck the way_nodes rows are checked against
+    the nodes, and the quarantined ones returned as 'dangling' rows.
+    """
+
+    rows = {'node': [], 'node_tags': [], 'way': [], 'way_nodes': [], 'way_tags': [], 'dangling': []}
+    for el in batch:
+        for collector in collectors:
+            collector.add(el)
+
+        # encode element by element, the codes are given out in the
+        # order the values first appear
+        if 'node' in el:
+            rows['node'].extend(encode('node', [el['node']]))
+            rows['node_tags'].extend(encode('node_tags', el['node_tags']))
+        elif 'way' in el:
+            rows['way'].extend(encode('way', [el['way']]))
+            rows['way_nodes'].extend(el['way_nodes'])
+            rows['way_tags'].extend(encode('way_tags', el['way_tags']))
+
+    if integrity is not None:
+        # a batch holds the nodes before the ways which refer to them
+        integrity.add_nodes(rows['node'])
+        rows['way_nodes'], rows['dangling'] = integrity.check(rows['way_nodes'])
+    return rows
+
+
+def process_pipelined(file_in, validate, collectors, encode, writers, processes=None, integrity=None):
+    """
+    Usage: see process_map(..., pipelined=True)
+
+    Runs the stages of process_map as a pipeline:
+
+        parse (thread) -> shape + validate (processes)
+                       -> collectors and encoding (this thread)
+                       -> one writer thread per csv
+
+    writers is a list of (field, CsvBatchWriter) with the field of
+    the shaped elements each of them writes. Prints the metrics of the
+    stages at the end.
+    """
+
+    stages = pipeline.Pipeline(processes=processes)
+    # the blocks of a .pbf are decoded by the pool which shapes them
+    parsed = stages.source('parse', iter_records(file_in, processes, stages.pool()))
+    shaped = stages.map('shape', shape_batch, parsed, args=(validate,))
+    collect = stages.stage('collect')
+    queues = [(field, stages.sink('write ' + field, writer.writerows)) for field, writer in writers]
+
+    try:
+        for batch in collect.receive(shaped):
+            with collect.work(len(batch)):
+                rows = batch_rows(batch, collectors, encode, integrity)
+
+            for field, queue in queues:
+                if rows[field]:
+                    collect.put(queue, rows[field])
+
+        stages.close(collect, [queue for _, queue in queues])
+    except:
+        stages.abort()
+        raise
+    finally:
+        stages.join()
+
+    print stages.metrics()
 
 
 if __name__ == '__main__':
     # Note: Validation is ~ 10X slower. For the project consider using a small
     # sample of the map when validating.
-    process_map(OSM_PATH, validate=True)
+    tag_summary = summary.TagSummary()
+    activity_index = activity.ActivityBuilder()
+    tags = tag_index.TagIndexBuilder()
+    ref_check = integrity.RefCheck('quarantine')
+    # --pipelined runs the conversion as a pipeline, see process_map
+    process_map(OSM_PATH, validate=True, collectors=[tag_summary, activity_index, tags],
+                pipelined='--pipelined' in sys.argv, integrity=ref_check)
+    print ref_check.report()
+    tag_summary.save()
+    activity_index.save()
+    tags.save()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: dictionary.py
+---------------------------
+
+Dictionary encoding for the columns that repeat millions of times in
+the London data: tag keys (addr:street, building, source), tag types
+and user names.
+
+Dictionary assigns an integer code to each distinct value, in order
+of first appearance. data.process_map uses it to write the codes
+instead of the strings, plus a small dimension table per column
+(code, value). These columns have a few thousand distinct values at
+most, so the dictionaries are not bounded.
+"""
+
+import csv
+
+class Dictionary(object):
+    """Integer codes for the distinct values of a column"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+    def save(self, path, value_field):
+        """Write the dimension table as a (code, value_field) csv"""
+        with open(path, 'wb') as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(['code', value_field])
+            for code, value in enumerate(self.values):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                writer.writerow([code, value])
+
+
+def encode_row(row, dictionaries):
+    """
+    Usage: encode_row(tag, {'key': keys, 'type': types})
+
+    Returns a copy of row with the values of the given fields replaced
+    by their codes. None (NULL) is left as is.
+    """
+    row = dict(row)
+    for field, dictionary in dictionaries.iteritems():
+        if row[field] is not None:
+            row[field] = dictionary.encode(row[field])
+    return row
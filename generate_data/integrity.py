@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: integrity.py
+---------------------------
+
+Referential integrity of the way_nodes rows, checked while the csvs
+are written instead of by the database.
+
+The London extract is clipped at its boundary, so ways crossing it
+refer to nodes which are not in the file. Their way_nodes rows break
+the way_nodes.node_id REFERENCES nodes (id) constraint and make the
+COPY of insert_data.py fail part way through the load.
+
+RefCheck records the id of every node written in a NodeBitmap and
+checks the node ids of the way_nodes rows against it. The nodes come
+before the ways in the extracts, so every node a way can refer to has
+been seen by then. A dangling reference is
+
+- 'report': written anyway, and counted
+- 'drop': left out of way_nodes.csv
+- 'quarantine': left out of way_nodes.csv and written to
+  QUARANTINE_PATH instead
+
+The bitmap takes one bit per id, allocated in pages of 2 ** PAGE_BITS
+ids as they are used, so its memory is bounded by the id range and
+not by the number of nodes.
+"""
+
+import os
+
+import numpy as np
+
+QUARANTINE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'way_nodes_dangling.csv')
+
+POLICIES = ('report', 'drop', 'quarantine')
+
+# Ids per bitmap page, 2 ** 16 bits make an 8 kB page
+PAGE_BITS = 16
+PAGE_MASK = (1 << PAGE_BITS) - 1
+
+# Dangling references kept for the report
+EXAMPLES = 10
+
+
+class NodeBitmap(object):
+    """Set of node ids, one bit per id"""
+
+    def __init__(self):
+        self.pages = {}
+
+    def add(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        pages = ids >> PAGE_BITS
+        for page in np.unique(pages):
+            bits = self.pages.get(page)
+            if bits is None:
+                bits = self.pages[page] = np.zeros(1 << (PAGE_BITS - 3), dtype=np.uint8)
+            offsets = ids[pages == page] & PAGE_MASK
+            np.bitwise_or.at(bits, offsets >> 3, np.left_shift(1, offsets & 7).astype(np.uint8))
+
+    def contains(self, ids):
+        """Returns a boolean array, whether each of ids is in the set"""
+        ids = np.asarray(ids, dtype=np.int64)
+        found = np.zeros(len(ids), dtype=bool)
+        pages = ids >> PAGE_BITS
+        for page in np.unique(pages):
+            bits = self.pages.get(page)
+            if bits is not None:
+                selected = pages == page
+                offsets = ids[selected] & PAGE_MASK
+                found[selected] = (bits[offsets >> 3] >> (offsets & 7)) & 1 == 1
+        return found
+
+    def nbytes(self):
+        return sum(bits.nbytes for bits in self.pages.itervalues())
+
+
+class RefCheck(object):
+    """
+    Usage: process_map(OSM_PATH, validate, integrity=RefCheck('quarantine'))
+
+    Checks way_nodes rows against the nodes written before them.
+    process_map writes the quarantined rows to quarantine_path.
+    """
+
+    def __init__(self, policy='quarantine', quarantine_path=QUARANTINE_PATH):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy %s, one of %s" % (policy, ', '.join(POLICIES)))
+        self.policy = policy
+        self.quarantine_path = quarantine_path
+        self.nodes = NodeBitmap()
+        self.checked = 0
+        self.dangling = 0
+        self.examples = []
+
+    def add_nodes(self, node_rows):
+        if node_rows:
+            self.nodes.add([row['id'] for row in node_rows])
+
+    def check(self, way_nodes):
+        """
+        Returns (rows to write to way_nodes.csv, rows to quarantine)
+        """
+        if not way_nodes:
+            return way_nodes, []
+        found = self.nodes.contains([row['node_id'] for row in way_nodes])
+        self.checked += len(way_nodes)
+        if found.all():
+            return way_nodes, []
+
+        dangling = [row for row, ok in zip(way_nodes, found) if not ok]
+        self.dangling += len(dangling)
+        self.examples.extend(dangling[:EXAMPLES - len(self.examples)])
+
+        if self.policy == 'report':
+            return way_nodes, []
+        kept = [row for row, ok in zip(way_nodes, found) if ok]
+        return kept, dangling if self.policy == 'quarantine' else []
+
+    def report(self):
+        lines = ["%d of %d way_nodes refer to missing nodes (%s), bitmap of %.2f MB" % (
+            self.dangling, self.checked, self.policy, self.nodes.nbytes() / 1e6)]
+        for row in self.examples:
+            lines.append("  way %s position %s -> node %s" % (row['id'], row['position'], row['node_id']))
+        if self.policy == 'quarantine' and self.dangling:
+            lines.append("quarantined to %s" % self.quarantine_path)
+        return '\n'.join(lines)
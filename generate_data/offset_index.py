@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: offset_index.py
+---------------------------
+
+Byte offsets of the elements of an .osm file, so a single node, way or
+relation (say the way with the "<val='Cobham Avenue',<Priority; ..."
+street name) is read straight from the file instead of by parsing the
+whole of it again.
+
+The index is built in one pass over the memory-mapped file and stored
+as numpy arrays in OFFSET_INDEX_DIR, three per element type:
+
+- <type>_id.npy      element ids, sorted
+- <type>_offset.npy  byte offset of the element in the file
+- <type>_length.npy  length of the element in bytes
+
+plus source.json with the size and modification time of the file the
+index belongs to. A lookup is a binary search over the ids, and the
+element is parsed from its slice of the memory-mapped file.
+
+The refs of the tag index (see tag_index.py) are located the same way,
+which lets the audits point to where the values they report are.
+"""
+
+import json
+import mmap
+import os
+import re
+import xml.etree.cElementTree as ET
+from array import array
+
+import numpy as np
+
+import pbf
+import tag_index
+
+OFFSET_INDEX_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'offset_index')
+
+TYPES = ('node', 'way', 'relation')
+
+# Start of a top level element, whichever attribute comes first (id
+# in the files written by osm tools). Nested elements are tag, nd and
+# member only, and '<' is always escaped inside attribute values.
+ELEMENT_START = re.compile(r'<(node|way|relation)\b[^>]*?\bid=["\'](-?\d+)')
+
+
+def _source_stamp(osm_file):
+    return {'size': os.path.getsize(osm_file), 'mtime': os.path.getmtime(osm_file)}
+
+
+def _mmap(osm_file):
+    with open(osm_file, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def build(osm_file, directory=OFFSET_INDEX_DIR):
+    """
+    Usage: build(OSM_PATH)
+
+    Indexes the elements of an .osm file and saves the index.
+    """
+    if pbf.is_pbf(osm_file):
+        raise ValueError("%s: only .osm files can be indexed by offset" % osm_file)
+
+    # (ids, offsets, lengths) of each type, as compact arrays
+    columns = {element_type: (array('l'), array('l'), array('l')) for element_type in TYPES}
+
+    def add(element_type, element_id, offset, next_start):
+        # an element ends at the last '>' before the next one starts
+        ids, offsets, lengths = columns[element_type]
+        ids.append(element_id)
+        offsets.append(offset)
+        lengths.append(data.rfind('>', offset, next_start) + 1 - offset)
+
+    data = _mmap(osm_file)
+    try:
+        previous = None
+        for match in ELEMENT_START.finditer(data):
+            if previous is not None:
+                element_type, element_id, offset = previous
+                add(element_type, element_id, offset, match.start())
+            previous = (match.group(1), int(match.group(2)), match.start())
+
+        # the last one ends before </osm>
+        if previous is not None:
+            end_of_elements = data.rfind('</osm>')
+            element_type, element_id, offset = previous
+            add(element_type, element_id, offset, end_of_elements if end_of_elements >= 0 else len(data))
+    finally:
+        data.close()
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    for element_type in TYPES:
+        ids, offsets, lengths = [np.array(column, dtype=np.int64) for column in columns[element_type]]
+        order = np.argsort(ids, kind='mergesort')
+        np.save(os.path.join(directory, element_type + '_id.npy'), ids[order])
+        np.save(os.path.join(directory, element_type + '_offset.npy'), offsets[order])
+        np.save(os.path.join(directory, element_type + '_length.npy'), lengths[order].astype(np.int32))
+        del columns[element_type]
+
+    with open(os.path.join(directory, 'source.json'), 'w') as output_file:
+        json.dump(_source_stamp(osm_file), output_file)
+
+
+class OffsetIndex(object):
+    """
+    Usage: index = OffsetIndex(OSM_PATH); index.element('way', 3327053)
+
+    Memory-mapped offset index of osm_file written by build.
+    """
+
+    def __init__(self, osm_file, directory=OFFSET_INDEX_DIR):
+        with open(os.path.join(directory, 'source.json')) as input_file:
+            if json.load(input_file) != _source_stamp(osm_file):
+                raise ValueError("%s has changed since the offset index was built" % osm_file)
+
+        def load_array(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+        self.ids = {}
+        self.offsets = {}
+        self.lengths = {}
+        for element_type in TYPES:
+            self.ids[element_type] = load_array(element_type + '_id')
+            self.offsets[element_type] = load_array(element_type + '_offset')
+            self.lengths[element_type] = load_array(element_type + '_length')
+
+        self.data = _mmap(osm_file)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.ids.itervalues())
+
+    def locate(self, element_type, element_id):
+        """Returns (offset, length) of an element, or None"""
+        ids = self.ids[element_type]
+        i = np.searchsorted(ids, element_id)
+        if i < len(ids) and ids[i] == element_id:
+            return int(self.offsets[element_type][i]), int(self.lengths[element_type][i])
+        return None
+
+    def raw(self, element_type, element_id):
+        """Returns the xml of an element as it is in the file, or None"""
+        location = self.locate(element_type, element_id)
+        if location is None:
+            return None
+        offset, length = location
+        return self.data[offset:offset + length]
+
+    def element(self, element_type, element_id):
+        """Returns an element parsed to an ElementTree element, or None"""
+        raw = self.raw(element_type, element_id)
+        return ET.fromstring(raw) if raw is not None else None
+
+    def locate_refs(self, refs):
+        """
+        Usage: index.locate_refs(tags.lookup('addr', 'street', street_name))
+
+        Returns [(type, id, offset, length), ...] for refs of the tag
+        index.
+        """
+        sources = []
+        for element_type, element_id in tag_index.split_refs(refs):
+            location = self.locate(element_type, element_id)
+            if location is not None:
+                sources.append((element_type, element_id) + location)
+        return sources
+
+    def close(self):
+        self.data.close()
+
+
+if __name__ == '__main__':
+    import data
+    build(data.OSM_PATH)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: pbf.py
+---------------------------
+
+Reader for the OpenStreetMap PBF format (.osm.pbf). PBF files are
+around five times smaller than the XML and are split into blocks
+that can be decoded independently, so blocks are read sequentially
+and decoded across a pool of worker processes.
+
+Only the python standard library is used: protocol buffers are
+decoded by hand and the blob data is inflated with zlib.
+
+Each decoded element is a record tuple
+
+    (element_type, attrib, tags, refs)
+
+where attrib holds the same attributes (as strings) that the XML
+element would carry, tags is a list of (k, v) pairs and refs is the
+list of node ids of a way, or (type, ref, role) tuples for the
+members of a relation. data.shape_record turns these records into
+the same dicts shape_element produces, and iter_elements wraps them
+into ElementTree elements for the audits and create_sample.py.
+
+Format reference:
+http://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+import collections
+import multiprocessing
+import struct
+import time
+import zlib
+import xml.etree.cElementTree as ET
+
+# Features this reader knows how to decode
+SUPPORTED_FEATURES = ('OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation')
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+MAX_BLOB_HEADER_SIZE = 64 * 1024
+
+# Blocks handed to the pool ahead of the reader, per process
+BLOCKS_AHEAD = 2
+
+
+def is_pbf(osm_file):
+    """Returns whether osm_file is a path to a PBF file"""
+    return isinstance(osm_file, basestring) and osm_file.endswith('.pbf')
+
+
+# ================================================== #
+#               Protocol Buffers                     #
+# ================================================== #
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(value):
+    """Two's complement of a 64 bit varint (int32/int64 fields)"""
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def _zigzag(value):
+    """Decode a zigzag encoded varint (sint32/sint64 fields)"""
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(buf):
+    """Yield (field number, value) for each field of a message
+
+    Varints are returned as ints, length delimited fields as a
+    bytearray of the raw bytes.
+    """
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield number, value
+
+
+def _packed(buf):
+    """Decode a packed repeated varint field"""
+    values = []
+    pos, end = 0, len(buf)
+    while pos < end:
+        value, pos = _varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def _packed_zigzag(buf):
+    return [_zigzag(value) for value in _packed(buf)]
+
+
+def _delta(values):
+    """Undo the delta coding of a packed field"""
+    total = 0
+    decoded = []
+    for value in values:
+        total += value
+        decoded.append(total)
+    return decoded
+
+
+# ================================================== #
+#               Blocks                               #
+# ================================================== #
+def read_blobs(pbf_file):
+    """Yield (type, blob) for each file block of a PBF file"""
+    with open(pbf_file, 'rb') as f:
+        while True:
+            size = f.read(4)
+            if not size:
+                return
+            if len(size) < 4:
+                raise ValueError("Truncated PBF file %s" % pbf_file)
+            header_size, = struct.unpack('!I', size)
+            if header_size > MAX_BLOB_HEADER_SIZE:
+                raise ValueError("Invalid blob header size %d" % header_size)
+
+            blob_type, data_size = None, 0
+            for number, value in _fields(bytearray(f.read(header_size))):
+                if number == 1:
+                    blob_type = bytes(value).decode('utf-8')
+                elif number == 3:
+                    data_size = value
+
+            yield blob_type, f.read(data_size)
+
+
+def decode_blob(blob):
+    """Returns the uncompressed data of a blob as a bytearray"""
+    for number, value in _fields(bytearray(blob)):
+        if number == 1:
+            return value
+        elif number == 3:
+            return bytearray(zlib.decompress(bytes(value)))
+        elif number in (4, 5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression (field %d)" % number)
+    return bytearray()
+
+
+def check_header(data):
+    """Raise ValueError if the header block needs unsupported features"""
+    for number, value in _fields(data):
+        if number == 4:
+            feature = bytes(value).decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError("Unsupported PBF feature %s" % feature)
+
+
+class _Block(object):
+    """Per block settings needed to decode its primitives"""
+
+    def __init__(self, strings, granularity, lat_offset, lon_offset, date_granularity):
+        self.strings = strings
+        self.granularity = granularity
+        self.lat_offset = lat_offset
+        self.lon_offset = lon_offset
+        self.date_granularity = date_granularity
+
+    def coordinate(self, offset, value):
+        return _format_coordinate(offset + self.granularity * value)
+
+    def timestamp(self, value):
+        seconds = value * self.date_granularity // 1000
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+    def tags(self, keys, vals):
+        return [(self.strings[k], self.strings[v]) for k, v in zip(keys, vals)]
+
+    def info(self, attrib, version, timestamp, changeset, uid, user_sid):
+        # Extracts stripped of metadata leave fields out (None here),
+        # and so are the attributes, as in the XML of such extracts
+        if version is not None:
+            attrib['version'] = str(version)
+        if timestamp is not None:
+            attrib['timestamp'] = self.timestamp(timestamp)
+        if changeset is not None:
+            attrib['changeset'] = str(changeset)
+        # Anonymous edits carry no user, leave the attributes out like
+        # the XML does so shaping sets them to None
+        if uid is not None and (uid > 0 or user_sid > 0):
+            attrib['uid'] = str(uid)
+            if user_sid is not None:
+                attrib['user'] = self.strings[user_sid]
+
+
+def _format_coordinate(nanodegrees):
+    """Format nanodegrees the way the XML writes degrees"""
+    sign = '-' if nanodegrees < 0 else ''
+    degrees, fraction = divmod(abs(nanodegrees), 10 ** 9)
+    fraction = ('%09d' % fraction).rstrip('0')
+    if fraction:
+        return '%s%d.%s' % (sign, degrees, fraction)
+    return '%s%d' % (sign, degrees)
+
+
+def _decode_info(block, attrib, buf):
+    version = timestamp = changeset = uid = user_sid = None
+    for number, value in _fields(buf):
+        if number == 1:
+            version = _signed(value)
+        elif number == 2:
+            timestamp = _signed(value)
+        elif number == 3:
+            changeset = _signed(value)
+        elif number == 4:
+            uid = _signed(value)
+        elif number == 5:
+            user_sid = value
+    block.info(attrib, version, timestamp, changeset, uid, user_sid)
+
+
+def _decode_node(block, buf):
+    attrib = {}
+    keys, vals = [], []
+    lat = lon = 0
+    for number, value in _fields(buf):
+        if number == 1:
+            attrib['id'] = str(_zigzag(value))
+        elif number == 2:
+            keys = _packed(value)
+        elif number == 3:
+            vals = _packed(value)
+        elif number == 4:
+            _decode_info(block, attrib, value)
+        elif number == 8:
+            lat = _zigzag(value)
+        elif number == 9:
+            lon = _zigzag(value)
+    attrib['lat'] = block.coordinate(block.lat_offset, lat)
+    attrib['lon'] = block.coordinate(block.lon_offset, lon)
+    return ('node', attrib, block.tags(keys, vals), [])
+
+
+def _decode_dense(block, buf):
+    ids, lats, lons, keys_vals = [], [], [], []
+    info = None
+    for number, value in _fields(buf):
+        if number == 1:
+            ids = _delta(_packed_zigzag(value))
+        elif number == 5:
+            info = value
+        elif number == 8:
+            lats = _delta(_packed_zigzag(value))
+        elif number == 9:
+            lons = _delta(_packed_zigzag(value))
+        elif number == 10:
+            keys_vals = _packed(value)
+
+    versions = timestamps = changesets = uids = user_sids = None
+    if info is not None:
+        for number, value in _fields(info):
+            if number == 1:
+                versions = _packed(value)
+            elif number == 2:
+                timestamps = _delta(_packed_zigzag(value))
+            elif number == 3:
+                changesets = _delta(_packed_zigzag(value))
+            elif number == 4:
+                uids = _delta(_packed_zigzag(value))
+            elif number == 5:
+                user_sids = _delta(_packed_zigzag(value))
+
+    # every field of DenseInfo is optional
+    missing = [None] * len(ids)
+    versions, timestamps, changesets, uids, user_sids = [
+        missing if values is None else values
+            for values in (versions, timestamps, changesets, uids, user_sids)
+    ]
+
+    records = []
+    strings = block.strings
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {
+            'id': str(node_id),
+            'lat': block.coordinate(block.lat_offset, lats[i]),
+            'lon': block.coordinate(block.lon_offset, lons[i])
+        }
+        if info is not None:
+            block.info(attrib, versions[i], timestamps[i], changesets[i],
+                       uids[i], user_sids[i])
+
+        # keys_vals holds (key, value) string ids per node, each node
+        # terminated by a 0
+        tags = []
+        if keys_vals:
+            while keys_vals[kv] != 0:
+                tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+        records.append(('node', attrib, tags, []))
+    return records
+
+
+def _decode_way(block, buf):
+    attrib = {}
+    keys, vals, refs = [], [], []
+    for number, value in _fields(buf):
+        if number == 1:
+            attrib['id'] = str(_signed(value))
+        elif number == 2:
+            keys = _packed(value)
+        elif number == 3:
+            vals = _packed(value)
+        elif number == 4:
+            _decode_info(block, attrib, value)
+        elif number == 8:
+            refs = [str(ref) for ref in _delta(_packed_zigzag(value))]
+    return ('way', attrib, block.tags(keys, vals), refs)
+
+
+def _decode_relation(block, buf):
+    attrib = {}
+    keys, vals, roles, memids, types = [], [], [], [], []
+    for number, value in _fields(buf):
+        if number == 1:
+            attrib['id'] = str(_signed(value))
+        elif number == 2:
+            keys = _packed(value)
+        elif number == 3:
+            vals = _packed(value)
+        elif number == 4:
+            _decode_info(block, attrib, value)
+        elif number == 8:
+            roles = _packed(value)
+        elif number == 9:
+            memids = _delta(_packed_zigzag(value))
+        elif number == 10:
+            types = _packed(value)
+    members = [
+        (MEMBER_TYPES[member_type], str(ref), block.strings[role])
+            for member_type, ref, role in zip(types, memids, roles)
+    ]
+    return ('relation', attrib, block.tags(keys, vals), members)
+
+
+def decode_block(data, types=MEMBER_TYPES):
+    """Decode a PrimitiveBlock into a list of element records"""
+    strings = []
+    groups = []
+    granularity, date_granularity = 100, 1000
+    lat_offset = lon_offset = 0
+    for number, value in _fields(data):
+        if number == 1:
+            strings = [bytes(s).decode('utf-8') for n, s in _fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 18:
+            date_granularity = value
+        elif number == 19:
+            lat_offset = _signed(value)
+        elif number == 20:
+            lon_offset = _signed(value)
+
+    block = _Block(strings, granularity, lat_offset, lon_offset, date_granularity)
+
+    records = []
+    for group in groups:
+        for number, value in _fields(group):
+            if number == 1 and 'node' in types:
+                records.append(_decode_node(block, value))
+            elif number == 2 and 'node' in types:
+                records.extend(_decode_dense(block, value))
+            elif number == 3 and 'way' in types:
+                records.append(_decode_way(block, value))
+            elif number == 4 and 'relation' in types:
+                records.append(_decode_relation(block, value))
+    return records
+
+
+def _decode_data_blob(args):
+    blob, types = args
+    return decode_block(decode_blob(blob), types)
+
+
+# ================================================== #
+#               Readers                              #
+# ================================================== #
+def iter_records(pbf_file, types=MEMBER_TYPES, processes=None, pool=None):
+    """Yield element records of the given types in file order
+
+    Blocks are decoded by a pool of processes (one per cpu unless
+    processes is given), processes=1 decodes in this process. A pool
+    passed in is used instead of starting one, and left running. At
+    most BLOCKS_AHEAD blocks per process are read and decoded ahead of
+    the records yielded, so memory stays bounded however slow the
+    caller.
+    """
+    def data_blobs():
+        for blob_type, blob in read_blobs(pbf_file):
+            if blob_type == 'OSMHeader':
+                check_header(decode_blob(blob))
+            elif blob_type == 'OSMData':
+                yield blob, types
+
+    if processes == 1 and pool is None:
+        for args in data_blobs():
+            for record in _decode_data_blob(args):
+                yield record
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    ahead = BLOCKS_AHEAD * (processes or multiprocessing.cpu_count())
+    # pool.imap would read and decode the whole file as fast as it can
+    pending = collections.deque()
+    try:
+        for args in data_blobs():
+            pending.append(pool.apply_async(_decode_data_blob, (args,)))
+            if len(pending) >= ahead:
+                for record in pending.popleft().get():
+                    yield record
+        while pending:
+            for record in pending.popleft().get():
+                yield record
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def to_element(record):
+    """Build the ElementTree element the XML would hold for a record"""
+    element_type, attrib, tags, refs = record
+    element = ET.Element(element_type, attrib)
+    if element_type == 'way':
+        for ref in refs:
+            ET.SubElement(element, 'nd', {'ref': ref})
+    elif element_type == 'relation':
+        for member_type, ref, role in refs:
+            ET.SubElement(element, 'member', {'type': member_type, 'ref': ref, 'role': role})
+    for k, v in tags:
+        ET.SubElement(element, 'tag', {'k': k, 'v': v})
+    return element
+
+
+def iter_elements(pbf_file, tags=MEMBER_TYPES, processes=None):
+    """Yield ElementTree elements of the given types, like get_element"""
+    for record in iter_records(pbf_file, types=tags, processes=processes):
+        yield to_element(record)
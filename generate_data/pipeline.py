@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: pipeline.py
+---------------------------
+
+A small engine for running the conversion as a pipeline of stages
+instead of one element at a time. Stages run concurrently and pass
+batches of elements through bounded queues:
+
+- a source thread (parsing) batches an iterable into a queue
+- map hands the batches to a pool of worker processes (shaping and
+  validation) and yields the results in order, with at most
+  queue_size batches in flight
+- the pipeline has one pool of processes, shared by its maps and by
+  sources that decode in processes too (e.g. .osm.pbf blocks)
+- sink threads (the csv writers) handle the batches of their queue
+
+A stage that gets ahead blocks on its full output queue, so memory
+stays bounded and the slowest stage sets the pace. Every stage keeps
+metrics: batches, elements, the time it was busy, waiting for input
+and waiting for room in its output (backpressure). Whichever stage
+is busy all the time while the others wait is the one to speed up.
+
+An error in any stage stops the others and is raised again by join;
+an error in the main thread should abort the pipeline before joining.
+"""
+
+import collections
+import multiprocessing
+import threading
+import time
+import sys
+import Queue
+from contextlib import contextmanager
+
+# Elements per batch
+BATCH_SIZE = 200
+# Batches held by each queue
+QUEUE_SIZE = 8
+
+# Seconds between checks for a stopped pipeline while blocked
+POLL_INTERVAL = 0.1
+
+# End of the batches of a queue
+DONE = None
+
+
+class Stopped(Exception):
+    """Another stage of the pipeline failed"""
+
+
+class Stage(object):
+    """Metrics of a stage, and queue access that records waiting time"""
+
+    def __init__(self, name, stop):
+        self.name = name
+        self.stop = stop
+        self.batches = 0
+        self.elements = 0
+        self.busy = 0.0
+        self.waiting_in = 0.0
+        self.waiting_out = 0.0
+
+    def get(self, queue):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return queue.get(timeout=POLL_INTERVAL)
+                except Queue.Empty:
+                    if self.stop.is_set():
+                        raise Stopped()
+        finally:
+            self.waiting_in += time.time() - start
+
+    def put(self, queue, item):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return queue.put(item, timeout=POLL_INTERVAL)
+                except Queue.Full:
+                    if self.stop.is_set():
+                        raise Stopped()
+        finally:
+            self.waiting_out += time.time() - start
+
+    def receive(self, items):
+        """Yield the items of an iterator, recording the time waited for them"""
+        items = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(items)
+            finally:
+                self.waiting_in += time.time() - start
+            yield item
+
+    @contextmanager
+    def work(self, elements):
+        start = time.time()
+        yield
+        self.busy += time.time() - start
+        self.batches += 1
+        self.elements += elements
+
+
+def batches(iterable, batch_size=BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _timed((function, batch, args)):
+    """Run function(batch, *args) in a worker, returns (result, seconds)"""
+    start = time.time()
+    result = function(batch, *args)
+    return result, time.time() - start
+
+
+class Pipeline(object):
+    """
+    Usage:
+        pipeline = Pipeline()
+        parsed = pipeline.source('parse', records)
+        written = pipeline.sink('write', write_rows)
+        main = pipeline.stage('main')
+        try:
+            for batch in pipeline.map('shape', shape_batch, parsed):
+                main.put(written, batch)
+            pipeline.close(main, [written])
+        except:
+            pipeline.abort()
+            raise
+        finally:
+            pipeline.join()
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, processes=None):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.processes = processes
+        self.stop = threading.Event()
+        self.stages = []
+        self.threads = []
+        self.maps = []
+        self.errors = []
+        self._pool = None
+
+    def pool(self):
+        """
+        The pool of processes of the pipeline (one per cpu unless
+        processes is given), started on first use. Get it before
+        starting the threads of a source which uses it: the workers
+        are forked from the calling thread.
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def stage(self, name):
+        stage = Stage(name, self.stop)
+        self.stages.append(stage)
+        return stage
+
+    def queue(self):
+        return Queue.Queue(self.queue_size)
+
+    def _start(self, target, *args):
+        def run():
+            try:
+                target(*args)
+            except Stopped:
+                pass
+            except Exception:
+                self.errors.append(sys.exc_info())
+                self.stop.set()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def source(self, name, iterable):
+        """Batch iterable into a new queue from a thread, returns the queue"""
+        stage = self.stage(name)
+        queue = self.queue()
+
+        def produce():
+            items = batches(iterable, self.batch_size)
+            while True:
+                start = time.time()
+                batch = next(items, DONE)
+                stage.busy += time.time() - start
+                if batch is DONE:
+                    break
+                stage.batches += 1
+                stage.elements += len(batch)
+                stage.put(queue, batch)
+            stage.put(queue, DONE)
+
+        self._start(produce)
+        return queue
+
+    def iterate(self, stage, queue):
+        """Yield the batches of a queue until DONE"""
+        while True:
+            batch = stage.get(queue)
+            if batch is DONE:
+                return
+            yield batch
+
+    def map(self, name, function, queue, args=()):
+        """
+        Returns an iterator over function(batch, *args) for the batches
+        of queue, in order.
+
+        The batches are handed to the pool of the pipeline, function
+        has to be a module level function. The time the workers spend
+        in it is recorded as the busy time of the stage.
+        """
+        stage = self.stage(name)
+        results = self._map(stage, function, queue, args, self.pool())
+        self.maps.append(results)
+        return results
+
+    def _map(self, stage, function, queue, args, pool):
+        # pool.imap would read its input as fast as it can, instead
+        # queue_size batches are handed to the pool ahead of the one
+        # waited for, and the next one once that is taken
+        pending = collections.deque()
+
+        def take():
+            result, seconds = pending.popleft().get()
+            stage.busy += seconds
+            stage.batches += 1
+            stage.elements += len(result)
+            return result
+
+        try:
+            for batch in self.iterate(stage, queue):
+                pending.append(pool.apply_async(_timed, ((function, batch, args),)))
+                if len(pending) >= self.queue_size:
+                    yield take()
+            while pending:
+                yield take()
+        except Stopped:
+            return
+        except:
+            self.abort()
+            raise
+
+    def sink(self, name, handle):
+        """Handle the batches of a new queue in a thread, returns the queue"""
+        stage = self.stage(name)
+        queue = self.queue()
+
+        def consume():
+            for batch in self.iterate(stage, queue):
+                with stage.work(len(batch)):
+                    handle(batch)
+
+        self._start(consume)
+        return queue
+
+    def close(self, stage, queues):
+        """Mark the end of the batches of queues"""
+        for queue in queues:
+            stage.put(queue, DONE)
+
+    def abort(self):
+        """Stop every stage, e.g. after an error in the main thread"""
+        self.stop.set()
+
+    def join(self):
+        """Wait for the threads, shut down the pool, raises the first error of a stage"""
+        for results in self.maps:
+            results.close()
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(POLL_INTERVAL)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        if self.errors:
+            exc_type, exc_value, traceback = self.errors[0]
+            raise exc_type, exc_value, traceback
+
+    def metrics(self):
+        """Metrics of the stages as a table"""
+        lines = ["%-16s %8s %10s %9s %9s %9s" % (
+            'stage', 'batches', 'elements', 'busy s', 'wait in', 'wait out')]
+        for stage in self.stages:
+            lines.append("%-16s %8d %10d %9.2f %9.2f %9.2f" % (
+                stage.name, stage.batches, stage.elements,
+                stage.busy, stage.waiting_in, stage.waiting_out))
+        return '\n'.join(lines)
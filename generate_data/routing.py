@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: routing.py
+---------------------------
+
+A routable graph of the road network, built from the highway ways of
+an .osm or .osm.pbf file.
+
+Only the nodes where ways meet (used more than once) and the ends of
+the ways are kept as vertices. Each stretch of a way between two of
+them is an edge, whose length in metres is the sum of the great
+circle distances between the way's nodes along it. One way streets
+(oneway=yes or -1, roundabouts, motorways) get one directed edge, the
+others one in each direction.
+
+The file is read twice: once for the ways, and once for the
+coordinates of the nodes they use, so only those are held in memory.
+Stretches of ways with nodes outside the extract are left out.
+
+The graph is stored in compressed sparse row (CSR) form as numpy
+arrays in GRAPH_DIR:
+
+- node_id.npy   osm id of each vertex, sorted
+- lat.npy, lon.npy
+                position of each vertex
+- offsets.npy   the edges leaving vertex i are offsets[i]:offsets[i + 1]
+- targets.npy   vertex each edge leads to
+- lengths.npy   length of each edge in metres
+- way_id.npy    the way each edge is part of
+
+Everything is memory-mapped when the graph is loaded. Shortest paths
+are found with A*, the great circle distance to the target being a
+lower bound of the rest of the path.
+"""
+
+import heapq
+import math
+import os
+from array import array
+
+import numpy as np
+
+import data
+import pbf
+
+GRAPH_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'graph')
+
+# Highway values which are no roads (yet)
+NOT_ROUTABLE = frozenset(['proposed', 'construction', 'abandoned', 'disused', 'razed',
+                          'platform', 'raceway', 'bus_stop', 'rest_area', 'services'])
+
+ONEWAY_FORWARD = frozenset(['yes', 'true', '1'])
+ONEWAY_BACKWARD = frozenset(['-1', 'reverse'])
+ONEWAY_HIGHWAYS = frozenset(['motorway'])
+
+# Nodes whose coordinates are looked up at once
+NODE_BATCH_SIZE = 100000
+
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distances in metres, of scalars or numpy arrays"""
+    lat1, lon1, lat2, lon2 = [np.radians(value) for value in (lat1, lon1, lat2, lon2)]
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _records(osm_file, element_type):
+    """Yield the (element_type, attrib, tags, refs) records of one type"""
+    if pbf.is_pbf(osm_file):
+        for record in pbf.iter_records(osm_file, types=(element_type,)):
+            yield record
+    else:
+        for element in data.get_element(osm_file, tags=(element_type,)):
+            yield data.element_record(element)
+
+
+def direction(tags):
+    """
+    Usage: direction({'highway': 'primary', 'oneway': 'yes'})
+
+    Returns 1 for a one way street, -1 for one against the order of
+    its nodes, 0 for a two way street.
+    """
+    oneway = tags.get('oneway', '').lower()
+    if oneway in ONEWAY_FORWARD:
+        return 1
+    if oneway in ONEWAY_BACKWARD:
+        return -1
+    if oneway == 'no':
+        return 0
+    if tags.get('junction') == 'roundabout' or tags.get('highway') in ONEWAY_HIGHWAYS:
+        return 1
+    return 0
+
+
+def read_ways(osm_file):
+    """
+    Returns (way ids, directions, starts, refs) of the highway ways,
+    their node ids one way after another in refs, starting at starts.
+    """
+    way_ids, directions, starts, refs = array('l'), array('b'), array('l'), array('l')
+    for _, attrib, tags, way_refs in _records(osm_file, 'way'):
+        tags = dict(tags)
+        highway = tags.get('highway')
+        if highway is None or highway in NOT_ROUTABLE or tags.get('area') == 'yes' or len(way_refs) < 2:
+            continue
+        way_ids.append(int(attrib['id']))
+        directions.append(direction(tags))
+        starts.append(len(refs))
+        refs.extend(int(ref) for ref in way_refs)
+    return (np.array(way_ids, dtype=np.int64), np.array(directions, dtype=np.int8),
+            np.array(starts, dtype=np.int64), np.array(refs, dtype=np.int64))
+
+
+def read_coordinates(osm_file, node_ids):
+    """
+    Returns (lat, lon) of the nodes of the sorted array node_ids, NaN
+    for the nodes missing from the file.
+    """
+    lat = np.full(len(node_ids), np.nan)
+    lon = np.full(len(node_ids), np.nan)
+
+    def look_up(ids, lats, lons):
+        ids = np.array(ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(node_ids, ids), max(len(node_ids) - 1, 0))
+        used = node_ids[positions] == ids if len(node_ids) else np.zeros(len(ids), dtype=bool)
+        lat[positions[used]] = np.array(lats)[used]
+        lon[positions[used]] = np.array(lons)[used]
+
+    ids, lats, lons = array('l'), array('d'), array('d')
+    for _, attrib, _, _ in _records(osm_file, 'node'):
+        ids.append(int(attrib['id']))
+        lats.append(float(attrib['lat']))
+        lons.append(float(attrib['lon']))
+        if len(ids) >= NODE_BATCH_SIZE:
+            look_up(ids, lats, lons)
+            ids, lats, lons = array('l'), array('d'), array('d')
+    look_up(ids, lats, lons)
+    return lat, lon
+
+
+def build(osm_file, directory=GRAPH_DIR):
+    """
+    Usage: build(OSM_PATH)
+
+    Builds the graph of the highway ways of an osm file and saves it,
+    returns (vertices, edges).
+    """
+    way_ids, directions, starts, refs = read_ways(osm_file)
+    node_ids, inverse, uses = np.unique(refs, return_inverse=True, return_counts=True)
+    lat, lon = read_coordinates(osm_file, node_ids)
+
+    # way of each position in refs, and the vertices: nodes used twice
+    # or more (crossings, closed ways) and the ends of the ways
+    way_of = np.repeat(np.arange(len(way_ids)), np.diff(np.r_[starts, len(refs)]))
+    ends = np.r_[starts[1:] - 1, len(refs) - 1] if len(refs) else starts
+    is_vertex = uses[inverse] > 1
+    is_vertex[starts] = True
+    is_vertex[ends] = True
+
+    # length along refs, and missing coordinates so far, so the length
+    # of the stretch between positions i < j is along[j] - along[i]
+    ref_lat, ref_lon = lat[inverse], lon[inverse]
+    missing = np.isnan(ref_lat)
+    segments = haversine(ref_lat[:-1], ref_lon[:-1], ref_lat[1:], ref_lon[1:])
+    along = np.r_[0, np.cumsum(np.where(np.isnan(segments), 0, segments))]
+    missing_along = np.cumsum(missing)
+
+    # an edge runs between consecutive vertices of the same way
+    positions = np.flatnonzero(is_vertex)
+    first, second = positions[:-1], positions[1:]
+    keep = ((way_of[first] == way_of[second]) &
+            (missing_along[second] - missing_along[first] + missing[first] == 0) &
+            (refs[first] != refs[second]))
+    first, second = first[keep], second[keep]
+    lengths = along[second] - along[first]
+    edge_ways = way_of[first]
+    edge_directions = directions[edge_ways]
+
+    # vertices are numbered in order of node id
+    vertex_nodes = np.unique(np.r_[refs[first], refs[second]])
+    source = np.searchsorted(vertex_nodes, refs[first])
+    target = np.searchsorted(vertex_nodes, refs[second])
+
+    forward = edge_directions >= 0
+    backward = edge_directions <= 0
+    sources = np.r_[source[forward], target[backward]]
+    targets = np.r_[target[forward], source[backward]]
+    lengths = np.r_[lengths[forward], lengths[backward]]
+    edge_ways = np.r_[edge_ways[forward], edge_ways[backward]]
+
+    order = np.argsort(sources, kind='mergesort')
+    offsets = np.r_[0, np.cumsum(np.bincount(sources, minlength=len(vertex_nodes)))]
+    vertex_positions = np.searchsorted(node_ids, vertex_nodes)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    def save_array(name, values):
+        np.save(os.path.join(directory, name + '.npy'), values)
+
+    save_array('node_id', vertex_nodes)
+    save_array('lat', lat[vertex_positions])
+    save_array('lon', lon[vertex_positions])
+    save_array('offsets', offsets.astype(np.int64))
+    save_array('targets', targets[order].astype(np.int32))
+    save_array('lengths', lengths[order])
+    save_array('way_id', way_ids[edge_ways[order]])
+    return len(vertex_nodes), len(order)
+
+
+class Graph(object):
+    """
+    Usage: graph = Graph(); graph.shortest_path(25496583, 108097)
+
+    Memory-mapped routing graph written by build.
+    """
+
+    def __init__(self, directory=GRAPH_DIR):
+        def load_array(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+        self.node_id = load_array('node_id')
+        self.lat = load_array('lat')
+        self.lon = load_array('lon')
+        self.offsets = load_array('offsets')
+        self.targets = load_array('targets')
+        self.lengths = load_array('lengths')
+        self.way_id = load_array('way_id')
+
+    def __len__(self):
+        return len(self.node_id)
+
+    def vertex(self, node_id):
+        """Returns the vertex of a node, or None"""
+        i = np.searchsorted(self.node_id, node_id)
+        if i < len(self.node_id) and self.node_id[i] == node_id:
+            return int(i)
+        return None
+
+    def nearest(self, lat, lon):
+        """Returns the node id of the vertex nearest to a position"""
+        if not len(self):
+            return None
+        return int(self.node_id[np.argmin(haversine(lat, lon, self.lat, self.lon))])
+
+    def edges(self, node_id):
+        """Returns [(node id, length, way id), ...] of the edges leaving a node"""
+        i = self.vertex(node_id)
+        if i is None:
+            return []
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return zip(self.node_id[self.targets[lo:hi]].tolist(),
+                   self.lengths[lo:hi].tolist(), self.way_id[lo:hi].tolist())
+
+    def shortest_path(self, source, target):
+        """
+        Usage: graph.shortest_path(25496583, 108097)
+
+        Returns (length in metres, [node id, ...]) of the shortest path
+        between two nodes, or None when there is none.
+        """
+        start, goal = self.vertex(source), self.vertex(target)
+        if start is None or goal is None:
+            return None
+
+        goal_lat = math.radians(self.lat[goal])
+        goal_lon = math.radians(self.lon[goal])
+        cos_goal_lat = math.cos(goal_lat)
+
+        def remaining(i):
+            lat, lon = math.radians(self.lat[i]), math.radians(self.lon[i])
+            a = (math.sin((goal_lat - lat) / 2) ** 2 +
+                 math.cos(lat) * cos_goal_lat * math.sin((goal_lon - lon) / 2) ** 2)
+            return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1)))
+
+        distances = {start: 0.0}
+        previous = {}
+        done = set()
+        heap = [(remaining(start), start)]
+        while heap:
+            _, i = heapq.heappop(heap)
+            if i == goal:
+                path = [goal]
+                while path[-1] != start:
+                    path.append(previous[path[-1]])
+                return distances[goal], self.node_id[path[::-1]].tolist()
+            if i in done:
+                continue
+            done.add(i)
+
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            for j, length in zip(self.targets[lo:hi].tolist(), self.lengths[lo:hi].tolist()):
+                distance = distances[i] + length
+                if j not in done and distance < distances.get(j, float('inf')):
+                    distances[j] = distance
+                    previous[j] = i
+                    heapq.heappush(heap, (distance + remaining(j), j))
+        return None
+
+
+if __name__ == '__main__':
+    vertices, edges = build(data.OSM_PATH)
+    print "%d vertices, %d edges" % (vertices, edges)
@@ -9,11 +9,11 @@ schema = {
             'id': {'required': True, 'type': 'integer', 'coerce': int},
             'lat': {'required': True, 'type': 'float', 'coerce': float},
             'lon': {'required': True, 'type': 'float', 'coerce': float},
-            'user': {'required': True, 'type': 'string'},
-            'uid': {'required': True, 'type': 'integer', 'coerce': int},
-            'version': {'required': True, 'type': 'string'},
-            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
-            'timestamp': {'required': True, 'type': 'string'}
+            'user': {'required': True, 'type': 'string', 'nullable': True},
+            'uid': {'required': True, 'type': 'integer', 'nullable': True},
+            'version': {'required': True, 'type': 'integer', 'nullable': True},
+            'changeset': {'required': True, 'type': 'integer', 'nullable': True},
+            'timestamp': {'required': True, 'type': 'datetime', 'nullable': True}
         }
     },
     'node_tags': {
@@ -32,11 +32,11 @@ schema = {
         'type': 'dict',
         'schema': {
             'id': {'required': True, 'type': 'integer', 'coerce': int},
-            'user': {'required': True, 'type': 'string'},
-            'uid': {'required': True, 'type': 'integer', 'coerce': int},
-            'version': {'required': True, 'type': 'string'},
-            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
-            'timestamp': {'required': True, 'type': 'string'}
+            'user': {'required': True, 'type': 'string', 'nullable': True},
+            'uid': {'required': True, 'type': 'integer', 'nullable': True},
+            'version': {'required': True, 'type': 'integer', 'nullable': True},
+            'changeset': {'required': True, 'type': 'integer', 'nullable': True},
+            'timestamp': {'required': True, 'type': 'datetime', 'nullable': True}
         }
     },
     'way_nodes': {
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: summary.py
+---------------------------
+
+Builds the tag statistics the report is made of in a single streaming
+pass over the shaped elements, instead of scanning node_tags and
+way_tags with a UNION ALL and GROUP BY for every report query.
+
+The summary holds
+
+- the number of nodes and ways
+- tag key/value counts per element kind ('node' or 'way') and tag type
+- the number of nodes and ways contributed by each user and uid
+  (the number of distinct uids is the number of uid entries,
+  anonymous elements are not counted)
+- a histogram of street types (the last word of addr:street)
+
+The counts are plain additive counters saved as json, so a summary can
+be refreshed incrementally: shards can be merged, and the update
+scripts swap the rows they rewrite with refresh_tags instead of
+rebuilding the summary from the osm file.
+"""
+
+import csv
+import json
+import os
+from collections import Counter, defaultdict
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+SUMMARY_PATH = os.path.join(DATA_DIR, 'summary.json')
+
+
+def _tag_counts():
+    return defaultdict(lambda: defaultdict(lambda: defaultdict(Counter)))
+
+
+def _positive(counts):
+    """Drop the entries a refresh has counted down to zero"""
+    return Counter({k: v for k, v in counts.iteritems() if v > 0})
+
+
+def street_type(street_name):
+    """
+    Usage: street_type("Old Dover Road") -> "Road"
+
+    Returns the last word of a street name, same as the report's
+    regexp_replace(value, '^.* ', '').
+    """
+    return street_name.rsplit(' ', 1)[-1]
+
+
+class TagSummary(object):
+    """Additive tag, user and street type counters"""
+
+    def __init__(self):
+        self.elements = Counter()
+        self.tags = _tag_counts()
+        self.users = Counter()
+        self.uids = Counter()
+        self.street_types = Counter()
+
+    def add(self, el):
+        """Count a shaped element as returned by shape_element"""
+        if 'node' in el:
+            kind, attribs, tags = 'node', el['node'], el['node_tags']
+        elif 'way' in el:
+            kind, attribs, tags = 'way', el['way'], el['way_tags']
+        else:
+            return
+
+        self.elements[kind] += 1
+        self.add_user(attribs['user'], attribs['uid'])
+        self.add_tags(kind, tags)
+
+    def add_user(self, user, uid):
+        # anonymous elements have no user, like COUNT(DISTINCT uid)
+        # leaves out NULLs
+        if user is not None:
+            self.users[user] += 1
+        if uid is not None:
+            self.uids[str(uid)] += 1
+
+    def add_tags(self, kind, tags, count=1):
+        """Count tag rows (dicts with type, key and value) of one kind"""
+        for tag in tags:
+            self.tags[kind][tag['type']][tag['key']][tag['value']] += count
+            if tag['type'] == 'addr' and tag['key'] == 'street':
+                self.street_types[street_type(tag['value'])] += count
+
+    def remove_tags(self, kind, tags):
+        self.add_tags(kind, tags, count=-1)
+
+    def merge(self, other):
+        """Add the counts of another summary, e.g. of another shard"""
+        self.elements.update(other.elements)
+        self.users.update(other.users)
+        self.uids.update(other.uids)
+        self.street_types.update(other.street_types)
+        for kind, types in other.tags.iteritems():
+            for tag_type, keys in types.iteritems():
+                for key, values in keys.iteritems():
+                    self.tags[kind][tag_type][key].update(values)
+
+    # ================================================== #
+    #               Queries                              #
+    # ================================================== #
+    def value_counts(self, key, tag_type=None, kinds=('node', 'way')):
+        """
+        Usage: summary.value_counts('postcode', 'addr').most_common(10)
+
+        Returns a Counter of the values of a tag key over the given
+        element kinds and, if given, a single tag type.
+        """
+        counts = Counter()
+        for kind in kinds:
+            for t, keys in self.tags[kind].iteritems():
+                if tag_type is None or t == tag_type:
+                    counts.update(keys.get(key, {}))
+        return _positive(counts)
+
+    def key_counts(self, kinds=('node', 'way')):
+        """Returns a Counter of tag rows per (type, key)"""
+        counts = Counter()
+        for kind in kinds:
+            for tag_type, keys in self.tags[kind].iteritems():
+                for key, values in keys.iteritems():
+                    counts[(tag_type, key)] += sum(values.itervalues())
+        return _positive(counts)
+
+    def distinct_uids(self):
+        return sum(1 for count in self.uids.itervalues() if count > 0)
+
+    # ================================================== #
+    #               Storage                              #
+    # ================================================== #
+    def to_dict(self):
+        return {
+            'elements': self.elements,
+            'tags': self.tags,
+            'users': self.users,
+            'uids': self.uids,
+            'street_types': self.street_types
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.elements.update(data['elements'])
+        summary.users.update(data['users'])
+        summary.uids.update(data['uids'])
+        summary.street_types.update(data['street_types'])
+        for kind, types in data['tags'].iteritems():
+            for tag_type, keys in types.iteritems():
+                for key, values in keys.iteritems():
+                    summary.tags[kind][tag_type][key].update(values)
+        return summary
+
+    def save(self, path=SUMMARY_PATH):
+        with open(path, 'w') as output_file:
+            json.dump(self.to_dict(), output_file)
+
+    @classmethod
+    def load(cls, path=SUMMARY_PATH):
+        with open(path) as input_file:
+            return cls.from_dict(json.load(input_file))
+
+
+def refresh_tags(kind, old_tags, new_tags, path=SUMMARY_PATH):
+    """
+    Usage: refresh_tags('way', records, updated_records)
+
+    Swaps rewritten tag rows in a saved summary. Does nothing if no
+    summary has been built yet.
+    """
+    if not os.path.exists(path):
+        return
+    summary = TagSummary.load(path)
+    summary.remove_tags(kind, old_tags)
+    summary.add_tags(kind, new_tags)
+    summary.save(path)
+
+
+def build_from_csv(data_dir=DATA_DIR):
+    """
+    Usage: build_from_csv().save()
+
+    Builds a summary from the csv files written by data.process_map,
+    for data that was converted without a summary.
+    """
+    summary = TagSummary()
+    for kind in ('node', 'way'):
+        with open(os.path.join(data_dir, kind + 's.csv')) as f:
+            for row in csv.DictReader(f):
+                summary.elements[kind] += 1
+                summary.add_user(row['user'].decode('utf-8') or None, row['uid'] or None)
+        with open(os.path.join(data_dir, kind + '_tags.csv')) as f:
+            summary.add_tags(kind, (
+                {k: v.decode('utf-8') for k, v in row.iteritems()} for row in csv.DictReader(f)
+            ))
+    return summary
+
+
+if __name__ == '__main__':
+    build_from_csv().save()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: tag_index.py
+---------------------------
+
+Inverted index of the node and way tags, for finding all the elements
+with amenity=pub or a given post code without loading the database or
+parsing the osm file again.
+
+The index maps each (type, key, value) term to the posting list of the
+elements carrying it. An element is referenced by
+
+    ref = id << 1 | kind    (kind 0 for nodes, 1 for ways)
+
+so node and way ids do not collide. The files in TAG_INDEX_DIR are
+
+- terms.bin, term_offsets.npy   the terms, sorted, as utf-8 strings
+                                'type\\0key\\0value' one after another
+- postings.bin, posting_offsets.npy
+                                the posting list of each term: sorted
+                                refs, delta coded and written as varints
+- counts.npy                    the number of elements of each term
+
+Everything is memory-mapped when the index is loaded. Exact and prefix
+matches are binary searches over the sorted terms, and the posting
+lists decode to numpy arrays, which are combined with all_of (AND)
+and any_of (OR).
+"""
+
+import csv
+import os
+from collections import defaultdict
+from array import array
+
+import numpy as np
+
+TAG_INDEX_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'tag_index')
+DATA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+KINDS = ('node', 'way')
+
+SEPARATOR = '\0'
+
+
+def make_ref(kind, element_id):
+    return int(element_id) << 1 | KINDS.index(kind)
+
+
+def split_refs(refs):
+    """Returns [(kind, id), ...] for an array of refs"""
+    return [(KINDS[ref & 1], int(ref >> 1)) for ref in refs]
+
+
+def make_term(tag_type, key, value=''):
+    term = SEPARATOR.join((tag_type, key, value))
+    if isinstance(term, unicode):
+        term = term.encode('utf-8')
+    return term
+
+
+# ================================================== #
+#               Varint Coding                        #
+# ================================================== #
+def encode_varints(values):
+    """Encode an array of non negative integers as LEB128 varints"""
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= (np.uint64(1) << np.uint64(7 * k))
+
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    positions = np.cumsum(nbytes) - nbytes
+    for k in range(int(nbytes.max()) if len(values) else 0):
+        mask = nbytes > k
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= (nbytes[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[positions[mask] + k] = byte
+    return out
+
+
+def decode_varints(data):
+    """Decode a uint8 array of LEB128 varints to an int64 array"""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.r_[0, ends[:-1] + 1]
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    parts = (data & 0x7f).astype(np.int64) << shifts
+    return np.add.reduceat(parts, starts)
+
+
+# ================================================== #
+#               Building                             #
+# ================================================== #
+class TagIndexBuilder(object):
+    """Collects the tags of shaped elements, see data.process_map"""
+
+    def __init__(self):
+        self.postings = defaultdict(lambda: array('l'))
+
+    def add(self, el):
+        for kind, tags_field in (('node', 'node_tags'), ('way', 'way_tags')):
+            if kind in el:
+                self.add_tags(kind, el[tags_field])
+
+    def add_tags(self, kind, tags):
+        for tag in tags:
+            term = make_term(tag['type'], tag['key'], tag['value'])
+            self.postings[term].append(make_ref(kind, tag['id']))
+
+    def save(self, directory=TAG_INDEX_DIR):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        terms = sorted(self.postings)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        posting_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        counts = np.zeros(len(terms), dtype=np.int64)
+
+        with open(os.path.join(directory, 'terms.bin'), 'wb') as terms_file, \
+             open(os.path.join(directory, 'postings.bin'), 'wb') as postings_file:
+            for i, term in enumerate(terms):
+                terms_file.write(term)
+                term_offsets[i + 1] = term_offsets[i] + len(term)
+
+                refs = np.unique(np.array(self.postings[term], dtype=np.int64))
+                encoded = encode_varints(np.r_[refs[:1], np.diff(refs)])
+                postings_file.write(encoded.tobytes())
+                posting_offsets[i + 1] = posting_offsets[i] + len(encoded)
+                counts[i] = len(refs)
+
+        np.save(os.path.join(directory, 'term_offsets.npy'), term_offsets)
+        np.save(os.path.join(directory, 'posting_offsets.npy'), posting_offsets)
+        np.save(os.path.join(directory, 'counts.npy'), counts)
+
+
+def build_from_csv(data_dir=DATA_DIR):
+    """
+    Usage: build_from_csv().save()
+
+    Builds the index from the node_tags and way_tags csv files.
+    """
+    builder = TagIndexBuilder()
+    for kind in KINDS:
+        with open(os.path.join(data_dir, kind + '_tags.csv')) as f:
+            builder.add_tags(kind, csv.DictReader(f))
+    return builder
+
+
+# ================================================== #
+#               Queries                              #
+# ================================================== #
+def _memmap(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+class TagIndex(object):
+    """Memory-mapped tag index written by TagIndexBuilder.save"""
+
+    def __init__(self, directory=TAG_INDEX_DIR):
+        self.terms = _memmap(os.path.join(directory, 'terms.bin'))
+        self.postings = _memmap(os.path.join(directory, 'postings.bin'))
+        self.term_offsets = np.load(os.path.join(directory, 'term_offsets.npy'), mmap_mode='r')
+        self.posting_offsets = np.load(os.path.join(directory, 'posting_offsets.npy'), mmap_mode='r')
+        self.counts = np.load(os.path.join(directory, 'counts.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.counts)
+
+    def term(self, i):
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].tobytes()
+
+    def _bisect(self, term):
+        """Returns the position of the first term >= term"""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _prefix_range(self, prefix):
+        lo = self._bisect(prefix)
+        # every term starting with prefix sorts below prefix + '\xff'
+        hi = self._bisect(prefix + '\xff')
+        return lo, hi
+
+    def posting(self, i):
+        """Returns the sorted refs of the i-th term"""
+        data = self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]]
+        return np.cumsum(decode_varints(data))
+
+    def lookup(self, tag_type, key, value):
+        """
+        Usage: index.lookup('regular', 'amenity', 'pub')
+
+        Returns the refs of the elements with exactly this tag.
+        """
+        term = make_term(tag_type, key, value)
+        i = self._bisect(term)
+        if i < len(self) and self.term(i) == term:
+            return self.posting(i)
+        return np.zeros(0, dtype=np.int64)
+
+    def prefix(self, tag_type, key, value_prefix=''):
+        """
+        Usage: index.prefix('addr', 'postcode', 'SE1 ')
+
+        Returns the refs of the elements with a value of the tag
+        starting with value_prefix.
+        """
+        lo, hi = self._prefix_range(make_term(tag_type, key, value_prefix))
+        return any_of(*[self.posting(i) for i in range(lo, hi)])
+
+    def values(self, tag_type, key):
+        """Yields (value, number of elements) for each value of a tag"""
+        prefix = make_term(tag_type, key)
+        lo, hi = self._prefix_range(prefix)
+        for i in range(lo, hi):
+            yield self.term(i)[len(prefix):].decode('utf-8'), int(self.counts[i])
+
+
+def all_of(*postings):
+    """Refs present in every posting list (AND)"""
+    if not postings:
+        return np.zeros(0, dtype=np.int64)
+    return reduce(np.intersect1d, postings)
+
+
+def any_of(*postings):
+    """Refs present in any of the posting lists (OR)"""
+    if not postings:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate(postings))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: tiles.py
+---------------------------
+
+Density tiles of the nodes, for questions like "where are the pubs"
+or "where was the data edited since 2015" without a query over every
+row of the nodes table.
+
+The nodes are counted per pixel of the web mercator (slippy map)
+tiles, TILE_SIZE pixels a side, at zoom levels MIN_ZOOM to MAX_ZOOM:
+
+- nodes.csv is split into shards at line boundaries, and a pool of
+  processes reads one shard each. The positions of the nodes passing
+  the filters (a tag, through the tag index, and a timestamp range)
+  are projected in batches with numpy and counted per pixel of
+  MAX_ZOOM with unique.
+- the counts of the shards are summed, and each zoom level below is
+  the sum of the 2 x 2 pixel blocks of the one above.
+
+Only the pixels with nodes are kept, most of an extract is empty at
+the higher zooms. A pixel is keyed by
+
+    (tile x << zoom | tile y) << 2 * TILE_BITS | row << TILE_BITS | column
+
+so the pixels of a tile sort together, and each zoom is stored as
+numpy arrays in TILES_DIR:
+
+- z<zoom>_keys.npy     pixel keys, sorted
+- z<zoom>_counts.npy   nodes in each pixel
+
+The arrays are memory-mapped when the tiles are loaded. A tile is a
+binary search over the keys, and comes out as a TILE_SIZE x TILE_SIZE
+array of counts, ready to be rendered as a heatmap.
+"""
+
+import csv
+import multiprocessing
+import os
+import sys
+from array import array
+
+import numpy as np
+
+import tag_index
+
+TILES_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'tiles')
+NODES_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'nodes.csv')
+
+# Pixels per tile side
+TILE_BITS = 8
+TILE_SIZE = 1 << TILE_BITS
+PIXEL_MASK = TILE_SIZE - 1
+
+# A z13 pixel is about 12 m in London
+MIN_ZOOM = 8
+MAX_ZOOM = 13
+
+# Nodes projected at once
+BATCH_SIZE = 100000
+# Pixel counts a grid holds before they are summed
+COMPACT_SIZE = 1000000
+
+# Limit of the web mercator projection
+MAX_LATITUDE = 85.0511287798
+
+
+def project(lat, lon, zoom):
+    """Global pixel (x, y) of positions at a zoom level, as numpy arrays"""
+    scale = float(TILE_SIZE << zoom)
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon) + 180) / 360 * scale
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * scale
+    limit = (TILE_SIZE << zoom) - 1
+    return (np.clip(x, 0, limit).astype(np.int64),
+            np.clip(y, 0, limit).astype(np.int64))
+
+
+def pixel_keys(x, y, zoom):
+    """Keys of global pixels, see above"""
+    tiles = (x >> TILE_BITS) << zoom | (y >> TILE_BITS)
+    return tiles << (2 * TILE_BITS) | (y & PIXEL_MASK) << TILE_BITS | (x & PIXEL_MASK)
+
+
+def split_pixel_keys(keys, zoom):
+    """Global pixels (x, y) of keys"""
+    tiles = keys >> (2 * TILE_BITS)
+    x = (tiles >> zoom) << TILE_BITS | (keys & PIXEL_MASK)
+    y = (tiles & ((1 << zoom) - 1)) << TILE_BITS | (keys >> TILE_BITS & PIXEL_MASK)
+    return x, y
+
+
+def _sum_counts(keys, counts):
+    """Sorted unique keys and the sum of the counts of each"""
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+class TileGrid(object):
+    """
+    Usage: grid = TileGrid(13); grid.add(lats, lons)
+
+    Counts of positions per pixel of a zoom level. The counts of each
+    batch are kept apart and summed once there are COMPACT_SIZE.
+    """
+
+    def __init__(self, zoom):
+        self.zoom = zoom
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def _append(self, keys, counts):
+        self.pending.append((keys, counts))
+        self.pending_size += len(keys)
+        if self.pending_size >= COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        if self.pending:
+            keys, counts = zip(*self.pending)
+            self.keys, self.counts = _sum_counts(np.concatenate((self.keys,) + keys),
+                                                 np.concatenate((self.counts,) + counts))
+            self.pending = []
+            self.pending_size = 0
+
+    def add(self, lat, lon):
+        x, y = project(lat, lon, self.zoom)
+        keys, counts = np.unique(pixel_keys(x, y, self.zoom), return_counts=True)
+        self._append(keys, counts.astype(np.int64))
+
+    def merge(self, other):
+        """Add the counts of another grid of the same zoom"""
+        other.compact()
+        self._append(other.keys, other.counts)
+
+    def total(self):
+        self.compact()
+        return int(self.counts.sum())
+
+    def zoom_out(self):
+        """Returns the grid of the zoom level below"""
+        self.compact()
+        grid = TileGrid(self.zoom - 1)
+        x, y = split_pixel_keys(self.keys, self.zoom)
+        grid._append(pixel_keys(x >> 1, y >> 1, grid.zoom), self.counts)
+        grid.compact()
+        return grid
+
+    def save(self, directory=TILES_DIR):
+        self.compact()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, 'z%d_keys.npy' % self.zoom), self.keys)
+        np.save(os.path.join(directory, 'z%d_counts.npy' % self.zoom), self.counts)
+
+
+# ================================================== #
+#               Building                             #
+# ================================================== #
+def shards(path, count):
+    """Returns [(start, end), ...] byte ranges of a csv, split at line starts"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        starts = [f.tell()]
+        for i in range(1, count):
+            f.seek(max(size * i // count, starts[-1]))
+            f.readline()
+            starts.append(max(f.tell(), starts[-1]))
+    ends = starts[1:] + [size]
+    return [(start, end) for start, end in zip(starts, ends) if start < end]
+
+
+def _shard_lines(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def _grid_of_shard((path, start, end, zoom, node_ids, start_time, end_time)):
+    """Count the nodes of a shard of nodes.csv, run by the pool"""
+    grid = TileGrid(zoom)
+    with open(path, 'rb') as f:
+        header = next(csv.reader(f))
+    id_column, lat_column, lon_column, time_column = [
+        header.index(field) for field in ('id', 'lat', 'lon', 'timestamp')]
+
+    def add(ids, lats, lons, timestamps):
+        keep = np.ones(len(ids), dtype=bool)
+        if node_ids is not None:
+            keep &= np.in1d(np.array(ids, dtype=np.int64), node_ids, assume_unique=True)
+        # timestamps are written as '2010-07-22 16:16:51', like str(datetime)
+        timestamps = np.array(timestamps)
+        if start_time is not None:
+            keep &= timestamps >= str(start_time)
+        if end_time is not None:
+            keep &= timestamps < str(end_time)
+        grid.add(np.array(lats)[keep], np.array(lons)[keep])
+
+    ids, lats, lons, timestamps = array('l'), array('d'), array('d'), []
+    for row in csv.reader(_shard_lines(path, start, end)):
+        ids.append(int(row[id_column]))
+        lats.append(float(row[lat_column]))
+        lons.append(float(row[lon_column]))
+        timestamps.append(row[time_column])
+        if len(ids) >= BATCH_SIZE:
+            add(ids, lats, lons, timestamps)
+            ids, lats, lons, timestamps = array('l'), array('d'), array('d'), []
+    if ids:
+        add(ids, lats, lons, timestamps)
+    return grid
+
+
+def tagged_nodes(tag_type, key, value=None, directory=tag_index.TAG_INDEX_DIR):
+    """Returns the sorted ids of the nodes with a tag (any value if None)"""
+    index = tag_index.TagIndex(directory)
+    if value is None:
+        refs = index.prefix(tag_type, key)
+    else:
+        refs = index.lookup(tag_type, key, value)
+    return np.unique(refs[(refs & 1) == tag_index.KINDS.index('node')] >> 1)
+
+
+def build(nodes_file=NODES_PATH, directory=TILES_DIR, node_ids=None, start=None, end=None,
+          min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, processes=None):
+    """
+    Usage: build(node_ids=tagged_nodes('regular', 'amenity', 'pub'))
+
+    Counts the nodes of nodes.csv, only those in the sorted array
+    node_ids if given and with start <= timestamp < end, and saves the
+    tiles of each zoom level. Returns the number of nodes counted.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    tasks = [(nodes_file, shard_start, shard_end, max_zoom, node_ids, start, end)
+             for shard_start, shard_end in shards(nodes_file, processes)]
+
+    grid = TileGrid(max_zoom)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shard_grid in pool.imap_unordered(_grid_of_shard, tasks):
+            grid.merge(shard_grid)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    total = grid.total()
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        grid.save(directory)
+        if zoom > min_zoom:
+            grid = grid.zoom_out()
+    return total
+
+
+# ================================================== #
+#               Queries                              #
+# ================================================== #
+class Tiles(object):
+    """Memory-mapped density tiles written by build"""
+
+    def __init__(self, directory=TILES_DIR):
+        self.keys = {}
+        self.counts = {}
+        for name in os.listdir(directory):
+            if name.endswith('_keys.npy'):
+                zoom = int(name[1:-len('_keys.npy')])
+                self.keys[zoom] = np.load(os.path.join(directory, name), mmap_mode='r')
+                self.counts[zoom] = np.load(os.path.join(directory, 'z%d_counts.npy' % zoom), mmap_mode='r')
+
+    def zooms(self):
+        return sorted(self.keys)
+
+    def tile(self, zoom, x, y):
+        """Returns the TILE_SIZE x TILE_SIZE counts of a tile"""
+        keys = self.keys[zoom]
+        first = (x << zoom | y) << (2 * TILE_BITS)
+        lo, hi = np.searchsorted(keys, [first, first + TILE_SIZE * TILE_SIZE])
+        counts = np.zeros(TILE_SIZE * TILE_SIZE, dtype=np.int64)
+        counts[keys[lo:hi] & (TILE_SIZE * TILE_SIZE - 1)] = self.counts[zoom][lo:hi]
+        return counts.reshape(TILE_SIZE, TILE_SIZE)
+
+    def count(self, zoom, lat, lon):
+        """Returns the count of the pixel of a position"""
+        x, y = project(lat, lon, zoom)
+        key = int(pixel_keys(x, y, zoom))
+        keys = self.keys[zoom]
+        i = np.searchsorted(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return int(self.counts[zoom][i])
+        return 0
+
+    def busiest(self, zoom, n=10):
+        """Returns [(count, x, y), ...] of the n tiles with the most nodes"""
+        tiles = np.asarray(self.keys[zoom]) >> (2 * TILE_BITS)
+        if not len(tiles):
+            return []
+        starts = np.r_[0, np.flatnonzero(np.diff(tiles)) + 1]
+        totals = np.add.reduceat(np.asarray(self.counts[zoom]), starts)
+        top = np.argsort(-totals, kind='mergesort')[:n]
+        return [(int(totals[i]), int(tiles[starts[i]] >> zoom), int(tiles[starts[i]] & ((1 << zoom) - 1)))
+                for i in top]
+
+    def heatmap(self, zoom, x, y):
+        """Returns a tile as a uint8 image, counts scaled logarithmically"""
+        counts = np.log1p(self.tile(zoom, x, y).astype(np.float64))
+        peak = counts.max()
+        if peak == 0:
+            return np.zeros(counts.shape, dtype=np.uint8)
+        return (counts / peak * 255).astype(np.uint8)
+
+
+if __name__ == '__main__':
+    # python tiles.py [type key [value]], e.g. regular amenity pub
+    node_ids = tagged_nodes(*sys.argv[1:4]) if len(sys.argv) > 2 else None
+    total = build(node_ids=node_ids)
+
+    tiles = Tiles()
+    print "%d nodes counted" % total
+    for count, x, y in tiles.busiest(MAX_ZOOM):
+        print "z%d %6d %6d %8d" % (MAX_ZOOM, x, y, count)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: generate_report.py
+---------------------------
+
+This script runs the queries of the data overview section of the
+report and renders their results as markdown, instead of pasting the
+output of each query by hand.
+
+The queries run concurrently, each on its own connection from a
+connection pool of the backend (see db/backend.py). Results are cached
+together with a data-version stamp of the tables a query reads (the
+versions of the tables for postgres, see db/create_db.py, the database
+file for sqlite), so on a rerun only the sections whose tables or sql
+changed are queried again; without stamps every query is run. The time
+each query took is reported at the end of the rendered markdown.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'db'))
+import backend
+
+CACHE_FILE = os.path.join(os.path.dirname(__file__), 'report_cache.json')
+OUTPUT_FILE = os.path.join(os.path.dirname(__file__), 'data_overview.md')
+MAX_CONNECTIONS = 4
+
+Query = namedtuple('Query', ['name', 'title', 'tables', 'sql'])
+
+QUERIES = [
+    Query('nodes', 'Number of nodes', ['nodes'], """
+SELECT COUNT(*) FROM nodes;
+"""),
+    Query('ways', 'Number of ways', ['ways'], """
+SELECT COUNT(*) FROM ways;
+"""),
+    Query('unique_users', 'Number of unique users', ['nodes', 'ways'], """
+SELECT COUNT(DISTINCT(users.uid))
+FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) users;
+"""),
+    Query('top_users', 'Top 10 contributing users', ['nodes', 'ways'], """
+SELECT users.username, COUNT(*) as num
+FROM (SELECT username FROM nodes UNION ALL SELECT username FROM ways) users
+GROUP BY users.username
+ORDER BY num DESC
+LIMIT 10;
+"""),
+    Query('top_amenities', 'Top 10 amenities', ['node_tags', 'way_tags'], """
+SELECT tags.value, COUNT(*) as count
+FROM (SELECT * FROM node_tags UNION ALL
+      SELECT * FROM way_tags) tags
+WHERE tags.key = 'amenity' AND tags.type = 'regular'
+GROUP BY tags.value
+ORDER BY count DESC
+LIMIT 10;
+"""),
+    Query('top_cities', 'Top 10 cities', ['node_tags', 'way_tags'], """
+SELECT tags.value, COUNT(*) as count
+FROM (SELECT * FROM node_tags UNION ALL
+      SELECT * FROM way_tags) tags
+WHERE tags.key = 'city'
+GROUP BY tags.value
+ORDER BY count DESC
+LIMIT 10;
+"""),
+    Query('top_street_types', 'Top 10 street name types', ['node_tags', 'way_tags'], """
+SELECT street_type, COUNT(*) as count
+FROM (SELECT regexp_replace(value, '^.* ', '') AS street_type
+      FROM (SELECT * FROM node_tags UNION ALL
+            SELECT * FROM way_tags) tags
+      WHERE key = 'street' AND type = 'addr') street_types
+GROUP BY street_type
+ORDER BY count DESC
+LIMIT 10;
+"""),
+    Query('top_post_codes', 'Top 10 postal codes', ['node_tags', 'way_tags'], """
+SELECT tags.value, COUNT(*) as count
+FROM (SELECT * FROM node_tags UNION ALL
+      SELECT * FROM way_tags) tags
+WHERE tags.key = 'postcode' AND tags.type = 'addr'
+GROUP BY tags.value
+ORDER BY count DESC
+LIMIT 10;
+"""),
+    Query('post_codes', 'Number of postal codes', ['node_tags', 'way_tags'], """
+SELECT COUNT(*), COUNT(DISTINCT(tags.value))
+FROM (SELECT * FROM node_tags UNION ALL
+      SELECT * FROM way_tags) tags
+WHERE tags.key = 'postcode' AND tags.type = 'addr';
+"""),
+    Query('phone_numbers', 'Number of phone numbers in database', ['node_tags', 'way_tags'], """
+SELECT COUNT(*)
+FROM (SELECT * FROM node_tags UNION ALL
+      SELECT * FROM way_tags) tags
+WHERE tags.key = 'phone';
+"""),
+    Query('london_phone_numbers', 'Number of phone numbers from London area', ['node_tags', 'way_tags'], """
+SELECT COUNT(*)
+FROM (SELECT * FROM node_tags UNION ALL
+      SELECT * FROM way_tags) tags
+WHERE tags.key = 'phone'
+AND tags.value LIKE '20%';
+""")
+]
+
+def query_stamp(query, stamps):
+    """Returns the stamp of a query: its sql and the stamps of its tables"""
+    if stamps is None:
+        return None
+    stamp = hashlib.sha1(query.sql.encode('utf-8'))
+    for table in sorted(query.tables):
+        stamp.update('%s=%s;' % (table, stamps.get(table)))
+    return stamp.hexdigest()
+
+
+def load_cache(cache_file=CACHE_FILE):
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as input_file:
+        return json.load(input_file)
+
+
+def save_cache(cache, cache_file=CACHE_FILE):
+    with open(cache_file, 'w') as output_file:
+        json.dump(cache, output_file, indent=2)
+
+
+def run_query(pool, query):
+    """Run a query on a pooled connection, returns its result and time"""
+    con = pool.getconn()
+    try:
+        start = time.time()
+        cur = con.cursor()
+        cur.execute(query.sql)
+        columns = [column[0] for column in cur.description]
+        rows = [list(row) for row in cur.fetchall()]
+        con.rollback()
+        return {'columns': columns, 'rows': rows, 'seconds': time.time() - start}
+    finally:
+        pool.putconn(con)
+
+
+def run_queries(pool, queries, stamps, cache, processes=MAX_CONNECTIONS):
+    """
+    Usage: run_queries(pool, QUERIES, stamps, cache)
+
+    Runs the queries whose stamp differs from the cached one concurrently
+    and stores their results in the cache. Returns the names of the
+    queries that were run.
+    """
+    stale = [query for query in queries
+             if stamps is None or cache.get(query.name, {}).get('stamp') != query_stamp(query, stamps)]
+
+    thread_pool = ThreadPool(processes)
+    try:
+        results = thread_pool.map(lambda query: run_query(pool, query), stale)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    for query, result in zip(stale, results):
+        result['stamp'] = query_stamp(query, stamps)
+        cache[query.name] = result
+
+    return [query.name for query in stale]
+
+
+# ================================================== #
+#               Rendering                            #
+# ================================================== #
+def to_text(value):
+    """unicode of a value, psycopg2 returns text as utf-8 encoded str"""
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def format_table(columns, rows):
+    """Format rows the way psql prints them, numbers right aligned"""
+    cells = [[to_text(value) for value in row] for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in cells])
+              for i, column in enumerate(columns)]
+    numeric = [bool(rows) and all(isinstance(row[i], (int, long, float)) for row in rows)
+               for i in range(len(columns))]
+
+    lines = [u' | '.join(column.center(width) for column, width in zip(columns, widths)).rstrip(),
+             u'-+-'.join(u'-' * width for width in widths)]
+    for row in cells:
+        lines.append(u' | '.join(
+            value.rjust(width) if right else value.ljust(width)
+            for value, width, right in zip(row, widths, numeric)
+        ).rstrip())
+    return u'\n'.join(lines)
+
+
+def render_section(query, result):
+    lines = ['### %s' % query.title, '```sql', query.sql.strip(), '```', '']
+    rows = result['rows']
+    if len(rows) == 1 and len(rows[0]) == 1:
+        lines.append(to_text(rows[0][0]))
+    else:
+        lines.extend(['```sql', format_table(result['columns'], rows), '```'])
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def render_report(queries, cache, ran):
+    sections = [u'# Data Overview', u'']
+    for query in queries:
+        sections.append(render_section(query, cache[query.name]))
+
+    sections.extend([u'### Query times', u'```'])
+    for query in queries:
+        sections.append(u'%-24s %9.3f s%s' % (
+            query.name, cache[query.name]['seconds'],
+            '' if query.name in ran else ' (cached)'))
+    sections.extend([u'```', u''])
+    return u'\n'.join(sections)
+
+
+def generate_report(db, queries=QUERIES, output_file=OUTPUT_FILE, cache_file=CACHE_FILE):
+    cache = load_cache(cache_file)
+    pool = db.pool(MAX_CONNECTIONS)
+    try:
+        con = pool.getconn()
+        try:
+            stamps = db.table_stamps(con)
+        finally:
+            pool.putconn(con)
+
+        ran = run_queries(pool, queries, stamps, cache)
+    finally:
+        pool.closeall()
+
+    save_cache(cache, cache_file)
+    with open(output_file, 'w') as output:
+        output.write(render_report(queries, cache, ran).encode('utf-8'))
+
+    for query in queries:
+        status = '%.3f s' % cache[query.name]['seconds'] if query.name in ran else 'unchanged'
+        print "%-24s %s" % (query.name, status)
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+
+    try:
+        generate_report(db)
+    except db.DatabaseError, e:
+        print "Error %s" % e
+        sys.exit(1)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: test_activity.py
+---------------------------
+
+Tests of the activity index built from edits added by hand: spilled
+in small runs and merged, it holds the same arrays as built in one
+run, and answers the same queries.
+
+Usage: python -m unittest discover tests
+"""
+
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import activity
+
+START = datetime.datetime(2012, 1, 1)
+
+ARRAYS = ['user_uid', 'user_timestamp', 'user_kind', 'user_id', 'changeset', 'changeset_kind',
+          'changeset_id', 'month_uid', 'month', 'month_count']
+
+
+def edits(count):
+    random.seed(3)
+    for element_id in range(count):
+        uid = random.choice([1, 2, 3, None])
+        yield {random.choice(activity.KINDS): {
+            'id': element_id,
+            'uid': uid,
+            'user': None if uid is None else 'user%d' % uid,
+            # few distinct times and changesets, so keys repeat across runs
+            'timestamp': START + datetime.timedelta(days=random.randint(0, 90)),
+            'changeset': random.choice([10, 11, 12, None])}}
+
+
+class ActivityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, name, run_size, merge_chunk, count=500):
+        builder = activity.ActivityBuilder(run_size, merge_chunk)
+        for el in edits(count):
+            builder.add(el)
+        builder.save(os.path.join(self.directory, name))
+        return activity.ActivityIndex(os.path.join(self.directory, name))
+
+    def test_runs_merge_to_one_run(self):
+        whole = self.build('whole', 1000, 1000)
+        for run_size, merge_chunk in ((37, 5), (100, 1), (7, 100)):
+            merged = self.build('merged', run_size, merge_chunk)
+            for name in ARRAYS:
+                self.assertTrue(np.array_equal(getattr(whole, name), getattr(merged, name)), name)
+            self.assertEqual(whole.users, merged.users)
+
+    def test_queries(self):
+        index = self.build('index', 37, 5)
+        everything = list(edits(500))
+        user1 = [el.values()[0] for el in everything if el.values()[0]['uid'] == 1]
+
+        self.assertEqual(index.count_edits('user1'), len(user1))
+        self.assertEqual(sum(count for _, count in index.monthly(1)), len(user1))
+        found = index.edits('user1', START + datetime.timedelta(days=30),
+                            START + datetime.timedelta(days=60))
+        expected = sorted((attribs['timestamp'], kind, attribs['id'])
+                          for el in everything for kind, attribs in el.items()
+                          if attribs['uid'] == 1 and 30 <= (attribs['timestamp'] - START).days < 60)
+        self.assertEqual([(timestamp, kind, element_id) for kind, element_id, timestamp in found],
+                         expected)
+
+        self.assertEqual(len(index.changeset_elements(activity.NO_CHANGESET)),
+                         sum(1 for el in everything if el.values()[0]['changeset'] is None))
+
+    def test_empty(self):
+        index = self.build('empty', 10, 10, count=0)
+        self.assertEqual(len(index.user_uid), 0)
+        self.assertEqual(index.monthly(1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
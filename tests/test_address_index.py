@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: test_address_index.py
+---------------------------
+
+Tests of the address index built from addresses added by hand, with
+the values as unicode (sqlite) and as utf-8 encoded str (psycopg2).
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'db'))
+import address_index
+
+
+class AddressIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        builder = address_index.AddressIndexBuilder()
+        builder.add('node', 1, {'street': u'Baker Street', 'housenumber': u'221B',
+                                'postcode': u'NW1 6XE'}, 51.5237, -0.1585)
+        builder.add('node', 2, {'street': 'Rue de l\xe2\x80\x99\xc3\x89glise', 'housenumber': '3'},
+                    51.5240, -0.1590)
+        builder.add('way', 3, {'street': 'Bak\xc3\xabr Mews', 'postcode': 'NW1 6XF'}, 51.5300, -0.1600)
+        builder.save(self.directory)
+        self.index = address_index.AddressIndex(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_normalize_encoded_str(self):
+        self.assertEqual(address_index.normalize_street('Caf\xc3\xa9  St.'), u'caf\xe9 st')
+        self.assertEqual(address_index.normalize_street(u'Caf\xe9  St.'), u'caf\xe9 st')
+        self.assertEqual(address_index.normalize_post_code('nw1 6xe'), u'NW16XE')
+
+    def test_accented_streets(self):
+        for street in ('Rue de l\xe2\x80\x99\xc3\x89glise', u'rue de l\xc9glise'):
+            address, = self.index.by_street(street)
+            self.assertEqual((address['type'], address['id']), ('node', 2))
+            self.assertEqual(address['street'], u'Rue de l’\xc9glise')
+
+        address, = self.index.by_street('bak\xc3\xabr', prefix=True)
+        self.assertEqual((address['type'], address['id']), ('way', 3))
+        self.assertEqual(sorted(a['id'] for a in self.index.by_street('Bak', prefix=True)), [1, 3])
+
+    def test_post_codes(self):
+        self.assertEqual([a['id'] for a in self.index.by_post_code('nw1 6xe')], [1])
+        self.assertEqual(sorted(a['id'] for a in self.index.by_post_code('NW1', prefix=True)), [1, 3])
+
+    def test_nearest(self):
+        (metres, address), = self.index.nearest(51.5238, -0.1586)
+        self.assertEqual(address['id'], 1)
+        self.assertTrue(metres < 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: test_duplicate_nodes.py
+---------------------------
+
+Tests of the grid hash of find_pairs and of the clusters of
+find_duplicates, on nodes placed by hand.
+
+Usage: python -m unittest discover tests
+"""
+
+import itertools
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'audit'))
+import duplicate_nodes
+
+LAT, LON = 51.5, -0.1
+
+# degrees of latitude per metre
+METRE = 1 / duplicate_nodes.METRES_PER_DEGREE
+
+
+def node(node_id, north, user, name=None, east=0.0, lat=LAT, **categories):
+    """A point of interest north and east metres away from (lat, LON)"""
+    tags = dict(categories)
+    if name is not None:
+        tags['name'] = name
+    return {'id': node_id, 'lat': lat + north * METRE, 'lon': LON + east * METRE * 1.6,
+            'user': user, 'tags': tags, 'categories': categories,
+            'name': duplicate_nodes.normalize_name(name) if name is not None else None}
+
+
+def pairs(nodes):
+    return sorted((min(nodes[i]['id'], nodes[j]['id']), max(nodes[i]['id'], nodes[j]['id']), kind)
+                  for i, j, kind, _ in duplicate_nodes.find_pairs(nodes))
+
+
+def all_pairs(nodes):
+    """The pairs of find_pairs, comparing every two nodes"""
+    found = []
+    for a, b in itertools.combinations(nodes, 2):
+        kind = duplicate_nodes.pair_kind(a, b, duplicate_nodes.distance(a, b))
+        if kind is not None:
+            found.append((min(a['id'], b['id']), max(a['id'], b['id']), kind))
+    return sorted(found)
+
+
+class FindPairsTest(unittest.TestCase):
+
+    def test_cell_boundaries(self):
+        # cells as find_pairs lays them out
+        cell_lat = duplicate_nodes.DISTANCE * METRE
+        row = (math.floor(LAT / cell_lat) + 1) * cell_lat
+        nodes = [
+            # either side of a row boundary
+            node(1, -2, 'alice', 'The Crown', lat=row),
+            node(2, 2, 'bob', 'The Crown', lat=row),
+            # either side of a row and a column boundary
+            node(3, -1, 'alice', 'Costa', lat=row + cell_lat),
+            node(4, 1, 'bob', 'Costa', lat=row + cell_lat),
+        ]
+        cell_lon = cell_lat / math.cos(math.radians(max(n['lat'] for n in nodes)))
+        column = (math.floor(LON / cell_lon) + 1) * cell_lon
+        nodes[2]['lon'], nodes[3]['lon'] = column - cell_lon / 20, column + cell_lon / 20
+
+        (row_1, column_1), (row_2, column_2), (row_3, column_3), (row_4, column_4) = [
+            (math.floor(n['lat'] / cell_lat), math.floor(n['lon'] / cell_lon)) for n in nodes]
+        self.assertEqual((row_2 - row_1, column_2 - column_1), (1, 0))
+        self.assertEqual((row_4 - row_3, column_4 - column_3), (1, 1))
+        self.assertEqual(pairs(nodes), [(1, 2, 'duplicate'), (3, 4, 'duplicate')])
+
+    def test_same_pairs_as_every_two_nodes(self):
+        random.seed(1)
+        nodes = []
+        for node_id in range(400):
+            nodes.append(node(node_id, random.uniform(0, 300), random.choice(['alice', 'bob', None]),
+                              random.choice(['The Crown', 'Costa', None]),
+                              east=random.uniform(0, 300),
+                              **random.choice([{'amenity': 'pub'}, {'amenity': 'cafe'}, {}])))
+        self.assertEqual(pairs(nodes), all_pairs(nodes))
+
+    def test_pair_kinds(self):
+        benches = [node(1, 0, 'alice', amenity='bench'), node(2, 11, 'bob', amenity='bench')]
+        self.assertEqual(pairs(benches), [(1, 2, 'similar')])
+
+        same_user = [node(1, 0, 'alice', 'The Crown'), node(2, 5, 'alice', 'The Crown')]
+        self.assertEqual(pairs(same_user), [(1, 2, 'similar')])
+
+        anonymous = [node(1, 0, None, 'The Crown'), node(2, 5, None, 'The Crown')]
+        self.assertEqual(pairs(anonymous), [(1, 2, 'similar')])
+
+        other_name = [node(1, 0, 'alice', 'The Crown'), node(2, 5, 'bob', 'The Anchor')]
+        self.assertEqual(pairs(other_name), [])
+
+        stacked = [node(1, 0, 'alice', 'Post Box', amenity='post_box'),
+                   node(2, 0.2, 'bob', 'Greggs', shop='bakery')]
+        self.assertEqual(pairs(stacked), [(1, 2, 'co-located')])
+
+
+class FindDuplicatesTest(unittest.TestCase):
+
+    def test_duplicate(self):
+        nodes = [node(1, 0, 'alice', 'The Crown', amenity='pub'), node(2, 10, 'bob', 'The Crown')]
+        cluster, = duplicate_nodes.find_duplicates(nodes)
+        self.assertEqual((cluster['kind'], cluster['keep'], cluster['remove'], cluster['review']),
+                         ('duplicate', 1, [2], []))
+        self.assertEqual(cluster['users'], ['alice', 'bob'])
+
+    def test_benches_are_not_removed(self):
+        nodes = [node(1, 0, 'alice', amenity='bench'), node(2, 11, 'alice', amenity='bench')]
+        cluster, = duplicate_nodes.find_duplicates(nodes)
+        self.assertEqual((cluster['kind'], cluster['remove'], cluster['review']), ('similar', [], [2]))
+
+    def test_chain_is_split(self):
+        # shops of a chain every 22 m, each a duplicate of the next
+        nodes = [node(i, 22 * (i - 1), 'user%d' % (i % 2), 'Costa') for i in range(1, 5)]
+        clusters = duplicate_nodes.find_duplicates(nodes)
+        self.assertEqual(sorted((c['keep'], c['remove'], c['review']) for c in clusters),
+                         [(1, [2], []), (3, [4], [])])
+        for cluster in clusters:
+            self.assertTrue(cluster['spread'] <= duplicate_nodes.DISTANCE)
+
+        # the far end of a chain of three is reviewed, not removed
+        cluster, = duplicate_nodes.find_duplicates(nodes[:3])
+        self.assertEqual((cluster['keep'], cluster['remove'], cluster['review']), (1, [2], [3]))
+
+    def test_co_located(self):
+        post_box = node(1, 0, 'alice', amenity='post_box')
+        bakery = node(2, 0.2, 'bob', 'Greggs', shop='bakery')
+        bakery_again = node(3, 8, 'carol', 'Greggs', shop='bakery')
+        cluster, = duplicate_nodes.find_duplicates([post_box, bakery, bakery_again])
+        self.assertEqual((cluster['kind'], cluster['keep'], cluster['remove'], cluster['review']),
+                         ('duplicate', 2, [3], [1]))
+
+        cluster, = duplicate_nodes.find_duplicates([post_box, bakery])
+        self.assertEqual((cluster['kind'], cluster['remove'], cluster['review']), ('co-located', [], [1]))
+
+    def test_removed_nodes_are_within_distance(self):
+        random.seed(2)
+        nodes = [node(node_id, random.uniform(0, 200), random.choice(['alice', 'bob', 'carol']),
+                      random.choice(['The Crown', 'Costa']), east=random.uniform(0, 200))
+                 for node_id in range(300)]
+        by_id = dict((n['id'], n) for n in nodes)
+        removed = []
+        for cluster in duplicate_nodes.find_duplicates(nodes):
+            keep = by_id[cluster['keep']]
+            for node_id in cluster['remove']:
+                self.assertTrue(duplicate_nodes.distance(keep, by_id[node_id]) <= duplicate_nodes.DISTANCE)
+                self.assertNotEqual(keep['user'], by_id[node_id]['user'])
+            self.assertNotIn(cluster['keep'], removed)
+            removed.extend(cluster['remove'])
+        self.assertEqual(len(removed), len(set(removed)))
+
+
+if __name__ == '__main__':
+    unittest.main()
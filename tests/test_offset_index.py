@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: test_offset_index.py
+---------------------------
+
+Tests of the offset index on id_first.osm, which has the attributes
+in the order osm tools write them (id first).
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import offset_index
+
+ID_FIRST_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'osm', 'id_first.osm')
+
+
+class OffsetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        offset_index.build(ID_FIRST_PATH, self.directory)
+        self.index = offset_index.OffsetIndex(ID_FIRST_PATH, self.directory)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_indexes_every_element(self):
+        self.assertEqual(len(self.index), 7)
+        self.assertEqual(self.index.ids['node'].tolist(), [101, 102, 103, 104])
+        self.assertEqual(self.index.ids['way'].tolist(), [201, 202])
+        self.assertEqual(self.index.ids['relation'].tolist(), [301])
+
+    def test_id_after_uid(self):
+        # uid= is not taken for id=
+        element = self.index.element('node', 104)
+        self.assertEqual(element.attrib['id'], '104')
+        self.assertEqual(element.attrib['uid'], '1003')
+
+    def test_elements_parse(self):
+        node = self.index.element('node', 102)
+        self.assertEqual(dict((tag.attrib['k'], tag.attrib['v']) for tag in node.iter('tag'))['name'],
+                         'The Crown')
+        way = self.index.element('way', 201)
+        self.assertEqual([nd.attrib['ref'] for nd in way.iter('nd')], ['101', '102', '103'])
+        self.assertEqual(self.index.element('relation', 301).tag, 'relation')
+
+    def test_missing_element(self):
+        self.assertIsNone(self.index.locate('node', 105))
+        self.assertIsNone(self.index.element('way', 101))
+
+
+if __name__ == '__main__':
+    unittest.main()
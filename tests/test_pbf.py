@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: test_pbf.py
+---------------------------
+
+Tests of the PBF reader on a small PrimitiveBlock encoded by hand,
+shaped and compared with the shape_element output of the same
+elements written as XML.
+
+Usage: python -m unittest discover tests
+"""
+
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+import xml.etree.cElementTree as ET
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import data
+import pbf
+
+
+# ================================================== #
+#               Protocol Buffers                     #
+# ================================================== #
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, value):
+    """A varint field, or a length delimited one for bytes"""
+    if isinstance(value, bytes):
+        return varint(number << 3 | 2) + varint(len(value)) + value
+    return varint(number << 3) + varint(value)
+
+
+def packed(number, values, signed=False, delta=False):
+    if delta:
+        values = [value - previous for value, previous in zip(values, [0] + values[:-1])]
+    if signed:
+        values = [zigzag(value) for value in values]
+    return field(number, b''.join(varint(value) for value in values))
+
+
+def blob(blob_type, payload):
+    """A file block: header size, BlobHeader and a zlib Blob"""
+    body = field(2, len(payload)) + field(3, zlib.compress(payload))
+    header = field(1, blob_type) + field(3, len(body))
+    return struct.pack('!I', len(header)) + header + body
+
+
+# ================================================== #
+#               Test Data                            #
+# ================================================== #
+STRINGS = ['', 'amenity', 'pub', 'name', 'The Crown', 'alice',
+           'highway', 'residential', 'addr:street', 'Baker Street']
+STRING = dict((s, i) for i, s in enumerate(STRINGS))
+
+GRANULARITY = 100
+LAT_OFFSET = 1000000000
+LON_OFFSET = -500000000
+
+
+def lat(nanodegrees):
+    return (nanodegrees - LAT_OFFSET) // GRANULARITY
+
+
+def lon(nanodegrees):
+    return (nanodegrees - LON_OFFSET) // GRANULARITY
+
+
+def dense(nodes, keys_vals, info=None):
+    ids, lats, lons = zip(*nodes)
+    message = (packed(1, list(ids), signed=True, delta=True) +
+               packed(8, [lat(value) for value in lats], signed=True, delta=True) +
+               packed(9, [lon(value) for value in lons], signed=True, delta=True))
+    if info is not None:
+        message += field(5, info)
+    return field(2, message + packed(10, keys_vals))
+
+
+# dense nodes with DenseInfo, the second one edited anonymously
+DENSE_WITH_INFO = dense(
+    [(101, 51500000000, -100000000), (102, 51500123400, -99876500)],
+    [0, STRING['amenity'], STRING['pub'], STRING['name'], STRING['The Crown'], 0],
+    packed(1, [2, 1]) +
+    packed(2, [1335866400, 1335870000], signed=True, delta=True) +
+    packed(3, [11, 12], signed=True, delta=True) +
+    packed(4, [7, 0], signed=True, delta=True) +
+    packed(5, [STRING['alice'], 0], signed=True, delta=True))
+
+# DenseInfo stripped down to versions and timestamps
+DENSE_STRIPPED_INFO = dense(
+    [(103, 51499000000, -101000000)], [0],
+    packed(1, [3]) + packed(2, [1335873600], signed=True, delta=True))
+
+DENSE_WITHOUT_INFO = dense([(104, 51498000000, -102000000)], [0])
+
+WAY = field(3, (
+    field(1, 201) +
+    packed(2, [STRING['highway'], STRING['addr:street']]) +
+    packed(3, [STRING['residential'], STRING['Baker Street']]) +
+    field(4, field(1, 4) + field(2, 1335877200) + field(3, 13) +
+          field(4, 7) + field(5, STRING['alice'])) +
+    packed(8, [101, 102, 103], signed=True, delta=True)))
+
+GROUPS = [DENSE_WITH_INFO, DENSE_STRIPPED_INFO, DENSE_WITHOUT_INFO, WAY]
+
+XML = [
+    '<node id="101" lat="51.5" lon="-0.1" version="2" timestamp="2012-05-01T10:00:00Z" '
+    'changeset="11" uid="7" user="alice"/>',
+    '<node id="102" lat="51.5001234" lon="-0.0998765" version="1" '
+    'timestamp="2012-05-01T11:00:00Z" changeset="12">'
+    '<tag k="amenity" v="pub"/><tag k="name" v="The Crown"/></node>',
+    '<node id="103" lat="51.499" lon="-0.101" version="3" timestamp="2012-05-01T12:00:00Z"/>',
+    '<node id="104" lat="51.498" lon="-0.102"/>',
+    '<way id="201" version="4" timestamp="2012-05-01T13:00:00Z" changeset="13" uid="7" '
+    'user="alice"><nd ref="101"/><nd ref="102"/><nd ref="103"/>'
+    '<tag k="highway" v="residential"/><tag k="addr:street" v="Baker Street"/></way>',
+]
+
+
+def primitive_block(groups):
+    strings = field(1, b''.join(field(1, s.encode('utf-8')) for s in STRINGS))
+    return (strings + b''.join(field(2, group) for group in groups) +
+            field(17, GRANULARITY) + field(19, LAT_OFFSET) + field(20, LON_OFFSET))
+
+
+class PbfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.expected = [data.shape_element(ET.fromstring(xml)) for xml in XML]
+
+    def test_decode_block(self):
+        records = pbf.decode_block(bytearray(primitive_block(GROUPS)))
+        self.assertEqual([data.shape_record(*record) for record in records], self.expected)
+
+    def test_stripped_metadata(self):
+        records = pbf.decode_block(bytearray(primitive_block(GROUPS[1:3])))
+        shaped = [data.shape_record(*record)['node'] for record in records]
+        self.assertEqual([node['version'] for node in shaped], [3, None])
+        self.assertEqual([node['changeset'] for node in shaped], [None, None])
+        self.assertEqual([node['uid'] for node in shaped], [None, None])
+
+    def test_decode_types(self):
+        records = pbf.decode_block(bytearray(primitive_block(GROUPS)), types=('way',))
+        self.assertEqual([record[1]['id'] for record in records], ['201'])
+
+    def test_iter_records(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.osm.pbf')
+            with open(path, 'wb') as f:
+                f.write(blob('OSMHeader', field(4, 'OsmSchema-V0.6') + field(4, 'DenseNodes')))
+                # a block per group, more than the pool decodes ahead
+                for group in GROUPS:
+                    f.write(blob('OSMData', primitive_block([group])))
+
+            blocks_ahead = pbf.BLOCKS_AHEAD
+            pbf.BLOCKS_AHEAD = 1
+            pool = multiprocessing.Pool(2)
+            try:
+                for processes in (1, 2):
+                    records = list(pbf.iter_records(path, processes=processes))
+                    self.assertEqual([data.shape_record(*record) for record in records],
+                                     self.expected)
+
+                    # a pool passed in is shared, and left running
+                    records = list(pbf.iter_records(path, processes=processes, pool=pool))
+                    self.assertEqual([data.shape_record(*record) for record in records],
+                                     self.expected)
+                self.assertEqual(pool.apply(len, ('pool',)), 4)
+            finally:
+                pool.terminate()
+                pool.join()
+                pbf.BLOCKS_AHEAD = blocks_ahead
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+File: test_sample_audit.py
+---------------------------
+
+Tests of the sampling audit on id_first.osm, which has the attributes
+in the order osm tools write them (id first).
+
+Usage: python -m unittest discover tests
+"""
+
+import mmap
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'audit'))
+import sample_audit
+
+ID_FIRST_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'osm', 'id_first.osm')
+
+
+class SampleAuditTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(ID_FIRST_PATH, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def tearDown(self):
+        self.data.close()
+
+    def test_element_range(self):
+        first, end = sample_audit.element_range(self.data)
+        self.assertTrue(self.data[first:].startswith('<node id="101"'))
+        self.assertTrue(self.data[end:].startswith('</osm>'))
+
+    def test_element_at_resynchronises(self):
+        first, end = sample_audit.element_range(self.data)
+        inside = self.data.find('Baker Strret')
+        start, span = sample_audit.element_at(self.data, inside, first, end)
+        element = sample_audit.parse_element(self.data, start, span)
+        self.assertEqual((element.tag, element.attrib['id']), ('node', '102'))
+
+        start, span = sample_audit.element_at(self.data, end - 1, first, end)
+        element = sample_audit.parse_element(self.data, start, span)
+        self.assertEqual((element.tag, element.attrib['id']), ('relation', '301'))
+
+    def test_sample_audit(self):
+        results = sample_audit.sample_audit(ID_FIRST_PATH, 500, seed=1)
+        self.assertEqual(results['samples'], 500)
+        # 'nw16' is the only invalid post code of three
+        self.assertTrue(0 < results['invalid_post_code_rate'] < 1)
+        self.assertIn('nw16', [value for value, _, _ in results['top_post_codes']])
+        self.assertIn('Strret', [value for value, _, _ in results['top_street_types']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,10 +33,21 @@ telephone code, ie redundant information.
 4. Push the phone number back into database
 """
 import pprint
-import psycopg2
-import psycopg2.extras
 import sys
 import re
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'db'))
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import backend
+import summary
+
+# There are many fields where key instead of just being 'phone' is
+# 'telephone' or 'phone_1' (type = 'regular'). To cover all the telephone
+# numbers the query contains LIKE for key phone.
+SELECT_PHONE_NUMBERS = "SELECT * FROM node_tags WHERE key LIKE '%phone%' AND type IN ('regular', 'contact');"
+DELETE_PHONE_NUMBERS = "DELETE FROM node_tags WHERE key LIKE '%phone%' AND type IN ('regular', 'contact');"
+INSERT_PHONE_NUMBER = """INSERT INTO node_tags(node_id, key, value, type) VALUES (%(node_id)s, %(key)s, %(value)s, %(type)s)"""
 
 def update_phone_number(record):
     # a single row of phone number
@@ -103,40 +114,47 @@ def update_numbers(records):
 
     return updated_records
 
-try:
-    # Get connection to database
-    con = psycopg2.connect("dbname=osm_playground user=abkds")
-
+def update_phone_numbers(db, con):
     # Use a dictionary cursor
-    dict_cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cur = db.dict_cursor(con)
 
     # Fetch telephone information from db
-    #
-    # There are many fields where key instead of just being 'phone' is
-    # 'telephone' or 'phone_1' (type = 'regular'). To cover all the telephone
-    # numbers the query contains LIKE for key phone.
-    #
-    dict_cur.execute("SELECT * FROM node_tags WHERE key LIKE '%phone%' AND type = any(array['regular', 'contact']);")
+    dict_cur.execute(SELECT_PHONE_NUMBERS)
     records = dict_cur.fetchall()
     updated_records = update_numbers(records)
 
     # delete old records
-    dict_cur.execute("DELETE FROM node_tags WHERE key LIKE '%phone%' AND type = any(array['regular', 'contact']);")
+    dict_cur.execute(DELETE_PHONE_NUMBERS)
     pprint.pprint(updated_records)
 
     # push updated records
-    dict_cur.executemany("""INSERT INTO node_tags(node_id, key, value, type) VALUES (%(node_id)s, %(key)s, %(value)s, %(type)s)""", updated_records)
+    dict_cur.executemany(db.sql(INSERT_PHONE_NUMBER), updated_records)
     con.commit()
 
-except psycopg2.DatabaseError, e:
+    # keep the report summary in step with the rewritten rows
+    summary.refresh_tags('node', records, updated_records)
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Get connection to database
+        con = db.connect()
+        backend.check_plain_layout(db, con)
+
+        update_phone_numbers(db, con)
+
+    except db.DatabaseError, e:
 
-    if con:
-        con.rollback()
+        if con:
+            con.rollback()
 
-    print "Error %s" % e
-    sys.exit(1)
+        print "Error %s" % e
+        sys.exit(1)
 
-finally:
+    finally:
 
-    if con:
-        con.close()
+        if con:
+            con.close()
@@ -24,13 +24,21 @@ before the back, and then validate.
 """
 
 import pprint
-import psycopg2
-import psycopg2.extras
 import sys
 import re
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'db'))
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import backend
+import summary
 
 MIN_VALID_POST_CODE_LENGTH = 5
 
+SELECT_POST_CODES = "SELECT * FROM way_tags WHERE key = 'postcode' and type = 'addr';"
+DELETE_POST_CODES = "DELETE FROM way_tags WHERE key = 'postcode' AND type = 'addr';"
+INSERT_POST_CODE = """INSERT INTO way_tags(way_id, key, value, type) VALUES (%(way_id)s, %(key)s, %(value)s, %(type)s)"""
+
 POST_CODES = re.compile(r"""^[A-Z]{2}\d[A-Z]\ \d[A-Z]{2}$
                         |   ^[A-Z]\d[A-Z]\ \d[A-Z]{2}$
                         |   ^[A-Z]\d\ \d[A-Z]{2}$
@@ -78,36 +86,48 @@ def update_post_codes(records):
 
     return updated_records
 
-try:
-    # Get connection to database
-    con = psycopg2.connect("dbname=osm_playground user=abkds")
-
+def update_db_post_codes(db, con):
     # Use a dictionary cursor
-    dict_cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cur = db.dict_cursor(con)
 
     # Fetch post codes information from db
-    dict_cur.execute("SELECT * FROM way_tags WHERE key = 'postcode' and type = 'addr';")
+    dict_cur.execute(SELECT_POST_CODES)
     records = dict_cur.fetchall()
     updated_records = update_post_codes(records)
 
     # delete old records
-    dict_cur.execute("DELETE FROM way_tags WHERE key = 'postcode' AND type = 'addr';")
+    dict_cur.execute(DELETE_POST_CODES)
     pprint.pprint(updated_records)
 
     print len(updated_records)
     # push updated records
-    dict_cur.executemany("""INSERT INTO way_tags(way_id, key, value, type) VALUES (%(way_id)s, %(key)s, %(value)s, %(type)s)""", updated_records)
+    dict_cur.executemany(db.sql(INSERT_POST_CODE), updated_records)
     con.commit()
 
-except psycopg2.DatabaseError, e:
+    # keep the report summary in step with the rewritten rows
+    summary.refresh_tags('way', records, updated_records)
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # Get connection to database
+        con = db.connect()
+        backend.check_plain_layout(db, con)
+
+        update_db_post_codes(db, con)
+
+    except db.DatabaseError, e:
 
-    if con:
-        con.rollback()
+        if con:
+            con.rollback()
 
-    print "Error %s" % e
-    sys.exit(1)
+        print "Error %s" % e
+        sys.exit(1)
 
-finally:
+    finally:
 
-    if con:
-        con.close()
+        if con:
+            con.close()
@@ -20,13 +20,24 @@ uniformity in names.
 There are data points of the following types within the data,
 <val='Cobham Avenue',<Priority; inDataSet: false, inStandard: false, selected: false>>
 
+Corrections proposed by audit/suggest_street_types.py are added to the
+mapping only when asked for with --suggested-mapping, once
+data/street_mapping.json has been reviewed:
+
+    python update_street_names.py --suggested-mapping
+
 """
 
+import json
 import pprint
-import psycopg2
-import psycopg2.extras
 import sys
 import re
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'db'))
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, 'generate_data'))
+import backend
+import summary
 
 mapping = {
     "Ave": "Avenue",
@@ -53,8 +64,32 @@ mapping = {
     "N": "North"
 }
 
+# Ranked corrections written by audit/suggest_street_types.py
+SUGGESTED_MAPPING_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'street_mapping.json')
+
+def load_suggested_mapping(path=SUGGESTED_MAPPING_PATH):
+    """
+    Usage: mapping.update(load_suggested_mapping())
+
+    Returns the best suggestion of each street type. The keys are
+    capitalized like the street types update_street looks up.
+    """
+    with open(path) as input_file:
+        suggestions = json.load(input_file)
+    return {street_type.capitalize(): ranked[0]['type']
+            for street_type, ranked in suggestions.iteritems() if ranked}
+
+def use_suggested_mapping(path=SUGGESTED_MAPPING_PATH):
+    """Add the reviewed suggestions to mapping, which takes precedence"""
+    for street_type, correction in load_suggested_mapping(path).iteritems():
+        mapping.setdefault(street_type, correction)
+
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
+SELECT_STREETS = "SELECT * FROM way_tags WHERE key = 'street' AND type = 'addr';"
+DELETE_STREETS = "DELETE FROM way_tags WHERE key = 'street' AND type = 'addr';"
+INSERT_STREET = """INSERT INTO way_tags(way_id, key, value, type) VALUES (%(way_id)s, %(key)s, %(value)s, %(type)s)"""
+
 def update_street(record):
     street_name = record['value']
 
@@ -111,38 +146,54 @@ def update_streets(records):
 
     return updated_records
 
-try:
-    # Get connection to database
-    con = psycopg2.connect("dbname=osm_playground user=abkds")
-
+def update_db_streets(db, con):
     # Use a dictionary cursor
-    dict_cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    dict_cur = db.dict_cursor(con)
 
     # Fetch street name from db
     #
     # Update the street names as per the mapping of incorrect names
     # created by auditing the osm file.
-    dict_cur.execute("SELECT * FROM way_tags WHERE key = 'street' AND type = 'addr';")
+    dict_cur.execute(SELECT_STREETS)
     records = dict_cur.fetchall()
     updated_records = update_streets(records)
 
     # delete old records
-    dict_cur.execute("DELETE FROM way_tags WHERE key = 'street' AND type = 'addr';")
+    dict_cur.execute(DELETE_STREETS)
     pprint.pprint(updated_records)
 
     # push updated records
-    dict_cur.executemany("""INSERT INTO way_tags(way_id, key, value, type) VALUES (%(way_id)s, %(key)s, %(value)s, %(type)s)""", updated_records)
+    dict_cur.executemany(db.sql(INSERT_STREET), updated_records)
     con.commit()
 
-except psycopg2.DatabaseError, e:
+    # keep the report summary in step with the rewritten rows
+    summary.refresh_tags('way', records, updated_records)
+
+
+if __name__ == '__main__':
+    db = backend.get_backend()
+    con = None
+
+    try:
+        # The suggestions are applied only once they have been reviewed
+        if '--suggested-mapping' in sys.argv:
+            use_suggested_mapping()
+
+        # Get connection to database
+        con = db.connect()
+        backend.check_plain_layout(db, con)
+
+        update_db_streets(db, con)
+
+    except db.DatabaseError, e:
 
-    if con:
-        con.rollback()
+        if con:
+            con.rollback()
 
-    print "Error %s" % e
-    sys.exit(1)
+        print "Error %s" % e
+        sys.exit(1)
 
-finally:
+    finally:
 
-    if con:
-        con.close()
+        if con:
+            con.close()